@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from archive_storage import decompress
+from usage_series import UsageSeries
+
+# Read-through cache of an S3 archive (open_archive(..., cache_dir=...)): every object read is kept on disk
+# under cache_dir (raw bytes as stored, Content-Encoding and ETag in a one-line JSON header) and files parsed
+# with read_series() are also kept in memory. Both are bounded in bytes and evict the least recently used
+# objects first (the disk cache is shared by runs: recency survives as the file mtime).
+# A cached object is revalidated with a conditional GET (If-None-Match: <ETag>) once it is older than
+# max_age seconds in this process, which transfers no body when the object is unchanged (304 Not Modified).
+# Writes and deletes through the cache invalidate the cached copies.
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+MEMORY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_MAX_AGE = 60
+CACHE_COUNTERS = ('hits', 'revalidated', 'misses', 'memory_hits', 'memory_misses', 'evictions',
+                  'bytes_downloaded')
+
+
+def not_modified(error) -> bool:
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304 or \
+        error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+
+class CachedArchive():
+    def __init__(self, archive, cache_dir, max_bytes=CACHE_MAX_BYTES, max_memory_bytes=MEMORY_CACHE_MAX_BYTES,
+                 max_age=CACHE_MAX_AGE):
+        self.archive = archive
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.max_age = max_age
+        self.stats = dict.fromkeys(CACHE_COUNTERS, 0)
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # cache file name -> size, least recently used first
+        files = [e for e in os.scandir(cache_dir) if e.is_file() and not e.name.endswith('.tmp')]
+        self.files = OrderedDict((e.name, e.stat().st_size) for e in sorted(files, key=lambda e: e.stat().st_mtime))
+        # relative path -> (etag, series, size), least recently used first
+        self.series = OrderedDict()
+        # relative path -> (etag, monotonic time of the last validation)
+        self.validated = {}
+
+    def __getattr__(self, name):
+        # listing, keys, compression, ... are the wrapped archive's
+        return getattr(self.archive, name)
+
+    def cache_file(self, relative_path):
+        return hashlib.sha256(f"{self.archive.storage_path}/{relative_path}".encode()).hexdigest()
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.stats[counter] += value
+
+    def read_header(self, name):
+        try:
+            with open(os.path.join(self.cache_dir, name), 'rb') as f:
+                return json.loads(f.readline())
+        except FileNotFoundError:
+            return None
+
+    def read_body(self, name, start=0, end=None):
+        # raw bytes [start, end) of a cached object, None when it has been evicted meanwhile
+        try:
+            with open(os.path.join(self.cache_dir, name), 'rb') as f:
+                f.readline()
+                f.seek(start, os.SEEK_CUR)
+                return f.read() if end is None else f.read(max(end - start, 0))
+        except FileNotFoundError:
+            return None
+
+    def store(self, name, header, body):
+        if len(body) > self.max_bytes:
+            return
+        path = os.path.join(self.cache_dir, name)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            f.write(body)
+        os.replace(temporary_path, path)
+        with self.lock:
+            self.files[name] = os.path.getsize(path)
+            self.files.move_to_end(name)
+            self.evict()
+
+    def evict(self):
+        # (lock held) removes least recently used files until the cache fits in max_bytes
+        total = sum(self.files.values())
+        while total > self.max_bytes and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.stats['evictions'] += 1
+
+    def touch(self, name):
+        with self.lock:
+            if name in self.files:
+                self.files.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, relative_path):
+        name = self.cache_file(relative_path)
+        with self.lock:
+            self.files.pop(name, None)
+            self.series.pop(relative_path, None)
+            self.validated.pop(relative_path, None)
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, relative_path):
+        # header {'etag', 'content_encoding'} of the object, cached on disk and revalidated when older than
+        # max_age, (None, None) when the object does not exist. The body is returned when it was downloaded.
+        from botocore.exceptions import ClientError
+        name = self.cache_file(relative_path)
+        header = self.read_header(name)
+        validated = self.validated.get(relative_path)
+        if header is not None and validated is not None and validated[0] == header['etag'] \
+                and time.monotonic() - validated[1] < self.max_age:
+            self.count('hits')
+            self.touch(name)
+            return header, None
+        arguments = {'Bucket': self.archive.bucket_name, 'Key': self.archive.key(relative_path)}
+        if header is not None:
+            arguments['IfNoneMatch'] = header['etag']
+        try:
+            response = self.archive.client.get_object(**arguments)
+        except self.archive.client.exceptions.NoSuchKey:
+            self.invalidate(relative_path)
+            return None, None
+        except ClientError as error:
+            if header is None or not not_modified(error):
+                raise
+            self.count('revalidated')
+            self.touch(name)
+            self.validated[relative_path] = (header['etag'], time.monotonic())
+            return header, None
+        body = response['Body'].read()
+        header = {'etag': response['ETag'], 'content_encoding': response.get('ContentEncoding')}
+        self.count('misses')
+        self.count('bytes_downloaded', len(body))
+        self.store(name, header, body)
+        self.validated[relative_path] = (header['etag'], time.monotonic())
+        return header, body
+
+    def read(self, relative_path):
+        # contents of the object (decompressed) or None when it does not exist
+        header, body = self.fetch(relative_path)
+        if header is None:
+            return None
+        if body is None:
+            body = self.read_body(self.cache_file(relative_path))
+            if body is None:  # evicted by another process
+                self.invalidate(relative_path)
+                return self.read(relative_path)
+        return decompress(body, header['content_encoding'])
+
+    def read_range(self, relative_path, start, end):
+        # bytes [start, end) of an uncompressed object, read from the cached copy
+        if end <= start:
+            return b''
+        header, body = self.fetch(relative_path)
+        if body is not None:
+            return body[start:end]
+        body = self.read_body(self.cache_file(relative_path), start, end)
+        return self.archive.read_range(relative_path, start, end) if body is None else body
+
+    def read_series(self, relative_path) -> UsageSeries:
+        # parsed HDF file, kept in memory while its ETag is unchanged
+        header, body = self.fetch(relative_path)
+        if header is None:
+            raise ValueError(f"{relative_path} does not exist")
+        with self.lock:
+            cached = self.series.get(relative_path)
+            if cached is not None and cached[0] == header['etag']:
+                self.series.move_to_end(relative_path)
+                self.stats['memory_hits'] += 1
+                return cached[1]
+        self.count('memory_misses')
+        if body is None:
+            body = self.read_body(self.cache_file(relative_path))
+        if body is None:
+            self.invalidate(relative_path)
+            return self.read_series(relative_path)
+        data = decompress(body, header['content_encoding'])
+        series = UsageSeries.from_csv(data)
+        if len(data) <= self.max_memory_bytes:
+            with self.lock:
+                self.series[relative_path] = (header['etag'], series, len(data))
+                total = sum(size for _, _, size in self.series.values())
+                while total > self.max_memory_bytes:
+                    _, (_, _, size) = self.series.popitem(last=False)
+                    total -= size
+        return series
+
+    def write(self, relative_path, body, compress=False):
+        self.invalidate(relative_path)
+        self.archive.write(relative_path, body, compress)
+
+    def write_lines(self, relative_path, lines, compress=False):
+        self.invalidate(relative_path)
+        self.archive.write_lines(relative_path, lines, compress)
+
+    def write_from(self, relative_path, reader, compress=False):
+        self.invalidate(relative_path)
+        self.archive.write_from(relative_path, reader, compress)
+
+    def delete(self, relative_path):
+        self.invalidate(relative_path)
+        self.archive.delete(relative_path)
+
+    def log_stats(self):
+        logging.info(f"Archive cache {self.cache_dir}: {json.dumps(self.stats)}")
+
+
+def read_series(archive, filename) -> UsageSeries:
+    # parsed HDF file of an archive, from the in-memory cache of a CachedArchive
+    if isinstance(archive, CachedArchive):
+        return archive.read_series(filename)
+    return UsageSeries.from_csv(archive.read(filename))
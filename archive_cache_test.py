@@ -0,0 +1,78 @@
+from datetime import datetime
+import os
+from archive_cache import CachedArchive, read_series
+from archive_storage import open_archive, S3Archive
+from electricity_usage_collector_test import mock_collection_data_as_list
+from time_range_index import TimeRangeIndex
+from usage_analytics import UsageAnalytics
+
+
+def hdf_file(day):
+    return '\n'.join(mock_collection_data_as_list(datetime(2023, 1, day, 0, 0), datetime(2023, 1, day, 23, 30)))
+
+
+def counting_gets(archive):
+    # number of GetObject requests sent by the archive client
+    gets = []
+    archive.client.meta.events.register('before-call.s3.GetObject', lambda **kwargs: gets.append(kwargs))
+    return gets
+
+
+def test_read_through_cache_revalidates_with_etag(s3_bucket, tmp_path):
+    S3Archive("s3://bucket/usage").write('HDF-2023-01-01T2330.csv', hdf_file(1))
+    archive = open_archive("s3://bucket/usage", cache_dir=str(tmp_path / 'cache'))
+    assert isinstance(archive, CachedArchive)
+    gets = counting_gets(archive)
+    body = archive.read('HDF-2023-01-01T2330.csv')
+    assert body.decode() == hdf_file(1)
+    assert archive.read('HDF-2023-01-01T2330.csv') == body  # within max_age: no request
+    assert len(gets) == 1
+    # a new process revalidates its disk copy: 304 without body
+    archive = CachedArchive(S3Archive("s3://bucket/usage"), str(tmp_path / 'cache'))
+    assert archive.read('HDF-2023-01-01T2330.csv') == body
+    assert archive.stats['revalidated'] == 1 and archive.stats['bytes_downloaded'] == 0
+    # an object changed by another writer is downloaded again once max_age is over
+    S3Archive("s3://bucket/usage").write('HDF-2023-01-01T2330.csv', hdf_file(2))
+    archive.max_age = 0
+    assert archive.read('HDF-2023-01-01T2330.csv').decode() == hdf_file(2)
+    assert archive.stats['misses'] == 1
+    assert archive.read('missing.json') is None
+    # writes through the cache invalidate it
+    archive.write('HDF-2023-01-01T2330.csv', hdf_file(3))
+    assert archive.read('HDF-2023-01-01T2330.csv').decode() == hdf_file(3)
+    assert archive.list_files() == ['HDF-2023-01-01T2330.csv']
+
+
+def test_parsed_series_and_range_reads(s3_bucket, tmp_path):
+    archive = open_archive("s3://bucket/usage", cache_dir=str(tmp_path / 'cache'))
+    for day in [1, 2]:
+        archive.write(f'HDF-2023-01-0{day}T2330.csv', hdf_file(day))
+    series = read_series(archive, 'HDF-2023-01-01T2330.csv')
+    assert read_series(archive, 'HDF-2023-01-01T2330.csv') is series
+    assert archive.stats['memory_hits'] == 1 and archive.stats['memory_misses'] == 1
+    TimeRangeIndex(archive).update()
+    index = TimeRangeIndex(archive)
+    gets = counting_gets(archive)
+    query = index.query(datetime(2023, 1, 1, 12, 0), datetime(2023, 1, 2, 12, 0))
+    assert len(query) == 48 and len(gets) == 0  # byte ranges served from the cached copies
+    assert UsageAnalytics(archive).update() == ['HDF-2023-01-01T2330.csv', 'HDF-2023-01-02T2330.csv']
+    assert [g['params']['url_path'] for g in gets] == ['/usage/analytics/rollups.npz']  # not cached yet
+    assert archive.stats['memory_hits'] == 2 and archive.stats['memory_misses'] == 2
+
+
+def test_size_bounded_eviction(s3_bucket, tmp_path):
+    s3 = S3Archive("s3://bucket/usage")
+    for day in range(1, 6):
+        s3.write(f'HDF-2023-01-0{day}T2330.csv', hdf_file(day))
+    size = len(hdf_file(1)) + 100
+    archive = CachedArchive(S3Archive("s3://bucket/usage"), str(tmp_path), max_bytes=3 * size,
+                            max_memory_bytes=2 * size)
+    for day in [1, 2, 3, 1, 4, 5]:
+        read_series(archive, f'HDF-2023-01-0{day}T2330.csv')
+    assert archive.stats['evictions'] == 2
+    assert len(os.listdir(tmp_path)) == 3
+    assert sum(os.path.getsize(tmp_path / f) for f in os.listdir(tmp_path)) <= 3 * size
+    assert list(archive.series) == ['HDF-2023-01-04T2330.csv', 'HDF-2023-01-05T2330.csv']
+    # the least recently used file (day 2, then day 3) were evicted, day 1 was read again before day 4
+    assert archive.cache_file('HDF-2023-01-01T2330.csv') in os.listdir(tmp_path)
+    assert archive.cache_file('HDF-2023-01-02T2330.csv') not in os.listdir(tmp_path)
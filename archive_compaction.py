@@ -0,0 +1,118 @@
+import argparse
+import json
+import logging
+import numpy as np
+from archive_cache import read_series
+from archive_storage import open_archive, compacted_filename, hdf_filename_datetime, COMPACTED_FILENAME_PATTERN, \
+    COMPRESSIONS, MANIFEST_FILENAME
+from columnar_storage import partitions
+from series_validation import validate
+from time_range_index import TimeRangeIndex, index_entry
+from usage_analytics import UsageAnalytics, ROLLUPS_PATH
+from usage_series import UsageSeries
+
+# Merges the files written by collection runs (HDF-2023-01-02T2330.csv) into one file per MPRN and month
+# named after its latest read datetime (HDF-2023-01-31T2330-M10305914213.csv), rows sorted newest first as
+# in the HDF files. A read present in more than one file is taken from the newest file.
+# $ python archive_compaction.py -s s3://bucket/prefix
+# The merged files are written (atomically) and indexed before the merged files are deleted, so a failed
+# compaction leaves duplicated reads at worst, which are removed by the next compaction (queries already
+# keep the newest). The watermark is the latest read datetime of the archive which compaction never changes.
+# The validation report (gap index, see series_validation.py) of every compacted file is written in its index entry.
+# Compaction must not run while the same storage path is being collected.
+
+
+def month_key(filename):
+    # (mprn, year, month) of a compacted file
+    latest = hdf_filename_datetime(filename)
+    return COMPACTED_FILENAME_PATTERN.match(filename).group(1), latest.year, latest.month
+
+
+def newest_first(series: UsageSeries) -> UsageSeries:
+    return series.select(np.argsort(-series.timestamps.astype(np.int64), kind='stable'))
+
+
+def compact_archive(archive, dry_run=False):
+    # returns {'merged': [files merged and deleted], 'written': [compacted files]}
+    files = archive.list_files()
+    run_files = [f for f in files if not COMPACTED_FILENAME_PATTERN.match(f)]
+    if not run_files:
+        logging.info("Nothing to compact")
+        return {'merged': [], 'written': []}
+    # newest file first so that deduplication keeps its reads
+    run_series = [read_series(archive, f) for f in sorted(run_files, reverse=True)]
+    affected = {(mprn, year, month) for s in run_series for mprn, year, month, _ in partitions(s)}
+    compacted_files = [f for f in files if COMPACTED_FILENAME_PATTERN.match(f) and month_key(f) in affected]
+    sources = sorted(run_files + compacted_files, reverse=True)
+    series = UsageSeries.merge(run_series + [read_series(archive, f) for f in sorted(compacted_files, reverse=True)])
+    logging.info(f"Compacting {len(sources)} files ({len(series)} reads) into {len(affected)} MPRN months")
+    written, reports = {}, {}
+    for mprn, year, month, partition in partitions(series):
+        partition = newest_first(partition)
+        filename = compacted_filename(partition.max_timestamp(), mprn)
+        written[filename] = partition.to_csv()
+        reports[filename] = validate(partition)
+    if dry_run:
+        return {'merged': sources, 'written': sorted(written)}
+    index = TimeRangeIndex(archive)
+    for filename, body in written.items():
+        logging.info(f"Writing {filename}")
+        archive.write(filename, body, compress=True)
+        index.files[filename] = {**index_entry(body.encode(), archive.compression),
+                                 'validation': reports[filename].to_dict()}
+    index.save()
+    superseded = [f for f in sources if f not in written]
+    update_rollups(archive, sources, list(written))
+    latest = max(list(written) + [f for f in files if f not in sources], key=hdf_filename_datetime)
+    update_manifest(archive, latest)
+    for filename in superseded:
+        logging.info(f"Deleting {filename}")
+        archive.delete(filename)
+    index.remove(superseded)
+    return {'merged': sources, 'written': sorted(written)}
+
+
+def update_rollups(archive, sources, written):
+    # the compacted files hold the same reads as their sources, they need no processing when all sources had been
+    if archive.read(ROLLUPS_PATH) is None:
+        return
+    analytics = UsageAnalytics(archive)
+    processed_files = analytics.rollups.processed_files
+    if all(f in processed_files for f in sources):
+        processed_files.difference_update(sources)
+        processed_files.update(written)
+        analytics.save()
+
+
+def update_manifest(archive, latest_file):
+    # the manifest refers to the compacted file holding the latest read (same watermark), a manifest with a later
+    # watermark is left untouched as watermarks never move backwards
+    body = archive.read(MANIFEST_FILENAME)
+    manifest = None if body is None else json.loads(body)
+    if manifest is not None and hdf_filename_datetime(manifest['latest_file']) > hdf_filename_datetime(latest_file):
+        return
+    archive.write(MANIFEST_FILENAME, json.dumps({'latest_file': latest_file,
+                                                 'last_updated_datetime':
+                                                     hdf_filename_datetime(latest_file).isoformat()}))
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(description="Merges the persisted HDF files into one file per MPRN and month",
+                                     epilog="Usage: archive_compaction.py -s s3://bucket/prefix")
+    parser.add_argument('-s', '--storage-path', required=True, help='Storage path of the HDF files')
+    parser.add_argument('-d', '--dry-run', action='store_true', help='List the files that would be merged/written')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='none',
+                        help='Compression of the compacted files uploaded to S3')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Local read-through cache of the objects read from S3 (see archive_cache.py)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+    args = parse_cli_args()
+    archive = open_archive(args.storage_path, compression=args.compression, cache_dir=args.cache_dir)
+    report = compact_archive(archive, dry_run=args.dry_run)
+    if args.cache_dir is not None and hasattr(archive, 'log_stats'):
+        archive.log_stats()
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,99 @@
+from datetime import datetime
+from archive_compaction import compact_archive
+from archive_storage import open_archive
+from conftest import create_collector
+from electricity_usage_collector_test import mock_collection_data_as_list
+from time_range_index import TimeRangeIndex
+from series_validation import validate
+from usage_analytics import UsageAnalytics
+from usage_series import UsageSeries, HDF_HEADER
+import pytest
+
+
+def collection_until(end):
+    collection = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), end, fixed_usage=False)
+    other_meter = [row.replace('10305914213', '10305914214') for row in collection[1:]]
+    return collection + other_meter
+
+
+def collect(storage_path, end, update_analytics=False):
+    collector = create_collector(storage_path, collection_until(end), update_analytics=update_analytics)
+    filename, _ = collector.persist_collected_data()
+    return collector, filename
+
+
+def test_compaction_merges_runs_into_mprn_months(tmp_path):
+    storage_path = str(tmp_path)
+    for end in [datetime(2023, 1, 20, 23, 30), datetime(2023, 1, 31, 23, 30), datetime(2023, 2, 3, 12, 0)]:
+        collect(storage_path, end, update_analytics=True)
+    archive = open_archive(storage_path)
+    # a newer run file overlapping the persisted reads, with a corrected read
+    archive.write('HDF-2023-02-03T1300.csv', '\n'.join(collection_until(datetime(2023, 2, 3, 12, 0))[:1] + [
+        "10305914213,31774820,1.000000,Active Import Interval (kW),03-02-2023 13:00",
+        "10305914213,31774820,1.000000,Active Import Interval (kW),03-02-2023 12:30",
+        "10305914213,31774820,9.000000,Active Import Interval (kW),03-02-2023 12:00"]))
+    assert UsageAnalytics(archive).update() == ['HDF-2023-02-03T1300.csv']
+    report = compact_archive(archive)
+    assert report['written'] == ['HDF-2023-01-31T2330-M10305914213.csv', 'HDF-2023-01-31T2330-M10305914214.csv',
+                                 'HDF-2023-02-03T1200-M10305914214.csv', 'HDF-2023-02-03T1300-M10305914213.csv']
+    assert archive.list_files() == report['written']
+    january = archive.read('HDF-2023-01-31T2330-M10305914214.csv').decode().splitlines()
+    expected = [r for r in collection_until(datetime(2023, 1, 31, 23, 30))[1:] if r.startswith('10305914214')]
+    assert january[1:] == expected  # sorted newest first, no duplicates
+    february = archive.read('HDF-2023-02-03T1300-M10305914213.csv').decode().splitlines()
+    assert february[3] == "10305914213,31774820,9.000000,Active Import Interval (kW),03-02-2023 12:00"
+    assert len(february) == 1 + 2 * 48 + 25 + 2
+    # watermark, index and rollups follow the compacted files
+    collector, filename = collect(storage_path, datetime(2023, 2, 4, 23, 30))
+    assert collector.last_updated_datetime == datetime(2023, 2, 3, 13, 0)
+    assert filename == 'HDF-2023-02-04T2330.csv'
+    assert sorted(TimeRangeIndex(archive).files) == report['written'] + [filename]
+    series = TimeRangeIndex(archive).query(datetime(2023, 1, 31, 20, 0), datetime(2023, 2, 4, 0, 0),
+                                           mprn='10305914213')
+    assert len(series) == 8 + 3 * 48 and series.read_values.max() == 9.0
+    assert UsageAnalytics(archive).update() == [filename]
+    # next compaction rewrites February only
+    report = compact_archive(archive)
+    assert report['merged'] == ['HDF-2023-02-04T2330.csv', 'HDF-2023-02-03T1300-M10305914213.csv',
+                                'HDF-2023-02-03T1200-M10305914214.csv']
+    assert report['written'] == ['HDF-2023-02-04T2330-M10305914213.csv', 'HDF-2023-02-04T2330-M10305914214.csv']
+    assert archive.list_files() == ['HDF-2023-01-31T2330-M10305914213.csv', 'HDF-2023-01-31T2330-M10305914214.csv',
+                                    'HDF-2023-02-04T2330-M10305914213.csv', 'HDF-2023-02-04T2330-M10305914214.csv']
+    assert collect(storage_path, datetime(2023, 2, 4, 23, 30))[1] is None
+    assert compact_archive(archive) == {'merged': [], 'written': []}
+
+
+def test_compaction_in_s3(s3_bucket):
+    storage_path = "s3://bucket/usage"
+    for end in [datetime(2023, 1, 2, 23, 30), datetime(2023, 1, 4, 23, 30)]:
+        collect(storage_path, end)
+    archive = open_archive(storage_path, compression='gzip')
+    report = compact_archive(archive, dry_run=True)
+    assert len(archive.list_files()) == 2
+    assert compact_archive(archive) == report
+    assert archive.list_files() == ['HDF-2023-01-04T2330-M10305914213.csv', 'HDF-2023-01-04T2330-M10305914214.csv']
+    response = s3_bucket.get_object(Bucket='bucket', Key='usage/HDF-2023-01-04T2330-M10305914213.csv')
+    assert response['ContentEncoding'] == 'gzip'
+    assert len(archive.read('HDF-2023-01-04T2330-M10305914213.csv').decode().splitlines()) == 1 + 4 * 48
+    collector, _ = collect(storage_path, datetime(2023, 1, 4, 23, 30))
+    assert collector.last_updated_datetime == datetime(2023, 1, 4, 23, 30)
+
+
+@pytest.mark.parametrize('filename', ['HDF-2023-01-04T2330.csv', 'HDF-2023-01-04T2330-M10305914213.csv'])
+def test_listing_accepts_compacted_files(tmp_path, filename):
+    archive = open_archive(str(tmp_path))
+    archive.write(filename, 'header')
+    archive.write('HDF-2023-01-04T2330.csv.tmp', 'header')
+    assert archive.list_files() == [filename]
+
+
+def test_compaction_keeps_the_repeated_october_hour(tmp_path):
+    archive = open_archive(str(tmp_path))
+    rows = [f"10305914213,31774820,0.{i}00000,Active Import Interval (kW),29-10-2023 {end}"
+            for i, end in enumerate(['03:00', '02:30', '02:00', '01:30', '02:00', '01:30', '01:00'])]
+    archive.write('HDF-2023-10-29T0300.csv', '\n'.join([HDF_HEADER] + rows))
+    compact_archive(archive)
+    assert archive.list_files() == ['HDF-2023-10-29T0300-M10305914213.csv']
+    compacted = archive.read('HDF-2023-10-29T0300-M10305914213.csv').decode().splitlines()
+    assert sorted(compacted[1:]) == sorted(rows)
+    assert validate(UsageSeries.from_csv('\n'.join(compacted))).counts()['duplicates'] == 0
@@ -0,0 +1,298 @@
+import io
+import itertools
+import logging
+import mmap
+import os
+import re
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Storage of the persisted HDF files (the archive), either a local directory or an S3 prefix:
+# local/path, ./relative/path, s3://bucket/prefix
+# Objects are addressed by paths relative to the storage path ("HDF-2023-01-02T2330.csv",
+# "columnar/mprn=.../part-....parquet") and every write is atomic: S3 PUT / CompleteMultipartUpload
+# only expose complete objects and local files are written to a temporary file, fsynced and renamed.
+# Files written by collection runs are named after their latest read datetime, files merged by
+# archive_compaction.py (one per MPRN and month) also carry the MPRN: HDF-2023-01-31T2330-M10305914213.csv
+HDF_FILENAME_FORMAT = "HDF-%Y-%m-%dT%H%M.csv"
+HDF_FILENAME_PATTERN = re.compile(r'^HDF-\d{4}-\d{2}-\d{2}T\d{4}(-M\d+)?\.csv$')
+COMPACTED_FILENAME_PATTERN = re.compile(r'^HDF-\d{4}-\d{2}-\d{2}T\d{4}-M(\d+)\.csv$')
+MANIFEST_FILENAME = 'manifest.json'
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+S3_MAX_CONNECTIONS = 10
+S3_MAX_ATTEMPTS = 5
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def hdf_filename_datetime(filename) -> datetime:
+    # latest read datetime of the rows of an HDF file
+    return datetime.strptime(filename[:len("HDF-2023-01-02T2330")], HDF_FILENAME_FORMAT[:-len(".csv")])
+
+
+def compacted_filename(latest_datetime: datetime, mprn) -> str:
+    return f"{latest_datetime.strftime(HDF_FILENAME_FORMAT)[:-len('.csv')]}-M{mprn}.csv"
+
+
+class LineReader(io.RawIOBase):
+    # Readable file object over an iterable of lines (joined with '\n') so that
+    # lines can be streamed into boto3 upload_fileobj without building the whole body
+    def __init__(self, lines, encoding='utf-8'):
+        self.lines = iter(lines)
+        self.encoding = encoding
+        self.pending = bytearray()
+        self.first = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.pending) < len(buffer):
+            line = next(self.lines, None)
+            if line is None:
+                break
+            separator = '' if self.first else '\n'
+            self.first = False
+            self.pending.extend((separator + line).encode(self.encoding))
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        del self.pending[:size]
+        return size
+
+
+def compressor(compression):
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unexpected compression {compression}")
+
+
+def decompress(data: bytes, content_encoding) -> bytes:
+    if content_encoding in (None, '', 'identity'):
+        return data
+    elif content_encoding == 'gzip':
+        return zlib.decompress(data, 47)
+    elif content_encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError(f"Unexpected content encoding {content_encoding}")
+
+
+class CompressingReader(io.RawIOBase):
+    # Readable file object compressing (gzip/zstd) another readable file object on the fly
+    def __init__(self, reader, compression):
+        self.reader = reader
+        self.compressor = compressor(compression)
+        self.pending = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.pending) < len(buffer) and not self.eof:
+            chunk = self.reader.read(READ_CHUNK_SIZE)
+            if chunk:
+                self.pending.extend(self.compressor.compress(chunk))
+            else:
+                self.pending.extend(self.compressor.flush())
+                self.eof = True
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        del self.pending[:size]
+        return size
+
+
+def fsync_directory(path):
+    # persists a rename in path (directories cannot be opened on Windows, where renames are journaled)
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    descriptor = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class FilesystemArchive():
+    def __init__(self, storage_path):
+        self.storage_path = storage_path
+        self.compression = None  # local files are never compressed
+
+    def exists(self):
+        return os.path.exists(self.storage_path)
+
+    def path(self, relative_path):
+        return os.path.join(self.storage_path, *relative_path.split('/'))
+
+    def list_files(self):
+        return sorted(f for f in os.listdir(self.storage_path) if HDF_FILENAME_PATTERN.match(f))
+
+    def read(self, relative_path):
+        # contents of the file or None when it does not exist
+        file_path = self.path(relative_path)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "rb") as file:
+            return file.read()
+
+    def read_range(self, relative_path, start, end):
+        # bytes [start, end) of the file, read through a memory map so only the touched pages are loaded
+        with open(self.path(relative_path), "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[start:end]
+
+    def write(self, relative_path, body, compress=False):
+        self.write_from(relative_path, io.BytesIO(body.encode() if isinstance(body, str) else body))
+
+    def write_lines(self, relative_path, lines, compress=False):
+        self.write_from(relative_path, LineReader(lines))
+
+    def write_from(self, relative_path, reader):
+        file_path = self.path(relative_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        temporary_path = f"{file_path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, "wb") as file:
+                chunk = reader.read(READ_CHUNK_SIZE)
+                while chunk:
+                    file.write(chunk)
+                    chunk = reader.read(READ_CHUNK_SIZE)
+                # the data must be on disk before the rename makes it visible, or a crash could
+                # leave a complete name with truncated contents
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, file_path)
+            fsync_directory(os.path.dirname(file_path))
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def delete(self, relative_path):
+        # like S3 deletes, deleting a missing file is not an error
+        if os.path.exists(self.path(relative_path)):
+            os.remove(self.path(relative_path))
+
+
+class S3Archive():
+    # Uses one pooled client per archive. Uploads are streamed and switch to multipart above
+    # multipart_threshold; data files are optionally compressed (gzip/zstd) with a matching
+    # Content-Encoding. A failed multipart upload is aborted, so no partial object is ever visible.
+    def __init__(self, storage_path, compression=None, max_connections=S3_MAX_CONNECTIONS,
+                 max_attempts=S3_MAX_ATTEMPTS, multipart_threshold=MULTIPART_THRESHOLD):
+        # "s3://{bucket_name}/{s3_path}"
+        # s3://jdvhome-dev-data/raw-landing/energia/usage-timeseries
+        path_parts = storage_path.split('/')
+        self.storage_path = storage_path
+        self.bucket_name = path_parts[2]
+        self.s3_path = '/'.join(path_parts[3:])
+        self.compression = None if compression in (None, 'none') else compression
+        if self.compression is not None:
+            compressor(self.compression)  # fail early (e.g. zstandard not installed)
+        self.max_connections = max_connections
+        self.max_attempts = max_attempts
+        self.multipart_threshold = multipart_threshold
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # created on first use, often in a worker thread (accounts, sinks, listing): from a session of its
+        # own, boto3's default session is not thread-safe. Clients are thread-safe once created.
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+                from botocore.config import Config
+                self._client = boto3.session.Session().client(
+                    's3', config=Config(max_pool_connections=self.max_connections,
+                                        retries={'max_attempts': self.max_attempts, 'mode': 'standard'}))
+            return self._client
+
+    def exists(self):
+        return True
+
+    def key(self, relative_path):
+        return f"{self.s3_path}/{relative_path}"
+
+    def list_keys(self, prefix, delimiter=None):
+        # all keys (or common prefixes when delimiter is given) under prefix, following pagination
+        paginator = self.client.get_paginator('list_objects_v2')
+        pagination_args = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if delimiter is not None:
+            pagination_args['Delimiter'] = delimiter
+        keys = []
+        for page in paginator.paginate(**pagination_args):
+            if delimiter is None:
+                keys.extend([e['Key'] for e in page.get('Contents', [])])
+            else:
+                keys.extend([e['Prefix'] for e in page.get('CommonPrefixes', [])])
+        return keys
+
+    def list_files(self, max_workers=8):
+        # HDF file names are listed by month prefix (HDF-2023-01-) in parallel. Year and month
+        # prefixes are discovered using '-' as delimiter, which costs one LIST per year.
+        year_prefixes = self.list_keys(self.key("HDF-"), delimiter='-')
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            month_prefixes = itertools.chain.from_iterable(executor.map(
+                lambda prefix: self.list_keys(prefix, delimiter='-'), year_prefixes))
+            keys = itertools.chain.from_iterable(executor.map(self.list_keys, list(month_prefixes)))
+            files = [key.split('/')[-1] for key in keys]
+        return sorted(f for f in files if HDF_FILENAME_PATTERN.match(f))
+
+    def read(self, relative_path):
+        # contents of the object (decompressed) or None when it does not exist
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=self.key(relative_path))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return decompress(response['Body'].read(), response.get('ContentEncoding'))
+
+    def read_range(self, relative_path, start, end):
+        # bytes [start, end) of an uncompressed object with a ranged GET
+        if end <= start:
+            return b''
+        response = self.client.get_object(Bucket=self.bucket_name, Key=self.key(relative_path),
+                                          Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+
+    def write(self, relative_path, body, compress=False):
+        self.write_from(relative_path, io.BytesIO(body.encode() if isinstance(body, str) else body), compress)
+
+    def write_lines(self, relative_path, lines, compress=False):
+        self.write_from(relative_path, LineReader(lines), compress)
+
+    def write_from(self, relative_path, reader, compress=False):
+        from boto3.s3.transfer import TransferConfig
+        extra_args = {}
+        if compress and self.compression is not None:
+            reader = CompressingReader(reader, self.compression)
+            extra_args['ContentEncoding'] = self.compression
+        config = TransferConfig(multipart_threshold=self.multipart_threshold,
+                                multipart_chunksize=max(self.multipart_threshold, 5 * 1024 * 1024),
+                                max_concurrency=min(self.max_connections, 10))
+        logging.debug(f"Uploading s3://{self.bucket_name}/{self.key(relative_path)}")
+        self.client.upload_fileobj(reader, self.bucket_name, self.key(relative_path), ExtraArgs=extra_args,
+                                   Config=config)
+
+    def delete(self, relative_path):
+        self.client.delete_object(Bucket=self.bucket_name, Key=self.key(relative_path))
+
+
+def open_archive(storage_path, compression=None, s3_max_connections=S3_MAX_CONNECTIONS,
+                 multipart_threshold=MULTIPART_THRESHOLD, cache_dir=None):
+    # cache_dir keeps the objects read from S3 in a local read-through cache (archive_cache.py)
+    if storage_path.startswith("s3://"):
+        archive = S3Archive(storage_path, compression=compression, max_connections=s3_max_connections,
+                            multipart_threshold=multipart_threshold)
+        if cache_dir is not None:
+            from archive_cache import CachedArchive
+            return CachedArchive(archive, cache_dir)
+        return archive
+    return FilesystemArchive(storage_path)
@@ -0,0 +1,140 @@
+from datetime import datetime
+from conftest import create_collector
+from electricity_usage_collector_test import mock_collection_data_as_list
+from archive_storage import LineReader, S3Archive, FilesystemArchive
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+import threading
+import pytest
+
+
+def test_line_reader_streams_joined_lines():
+    lines = ['header'] + [f'row {i}' for i in range(1000)]
+    reader = LineReader(lines)
+    chunks = []
+    chunk = reader.read(7)
+    while chunk:
+        chunks.append(chunk)
+        chunk = reader.read(7)
+    assert b''.join(chunks).decode() == '\n'.join(lines)
+
+
+def test_s3_archive_compressed_multipart_upload(s3_bucket):
+    archive = S3Archive("s3://bucket/usage", compression='gzip', multipart_threshold=5 * 1024 * 1024)
+    lines = [f"10305914213,31774820,{i / 1000:.6f},Active Import Interval (kW),05-04-2023 01:30"
+             for i in range(300000)]
+    archive.write_lines("HDF-2023-04-05T0130.csv", lines, compress=True)
+    response = s3_bucket.get_object(Bucket='bucket', Key='usage/HDF-2023-04-05T0130.csv')
+    assert response['ContentEncoding'] == 'gzip'
+    assert gzip.decompress(response['Body'].read()).decode() == '\n'.join(lines)
+    assert archive.read("HDF-2023-04-05T0130.csv").decode() == '\n'.join(lines)
+    # uncompressed and larger than the threshold: multipart
+    archive.write_lines("HDF-2023-04-06T0130.csv", lines)
+    response = s3_bucket.head_object(Bucket='bucket', Key='usage/HDF-2023-04-06T0130.csv')
+    assert response['ETag'].strip('"').endswith('-5')  # multipart ETags end with the number of parts
+    assert archive.read("missing.csv") is None
+
+
+def test_s3_clients_created_concurrently(s3_bucket):
+    # clients are first created in worker threads (accounts, sinks), each from a session of its own
+    archives = [S3Archive(f"s3://bucket/usage{i}") for i in range(8)]
+    barrier = threading.Barrier(len(archives))
+
+    def first_use(archive):
+        barrier.wait()
+        archive.write("manifest.json", "{}")
+        return archive.client
+    with ThreadPoolExecutor(max_workers=len(archives)) as executor:
+        clients = list(executor.map(first_use, archives))
+    assert len({id(c) for c in clients}) == len(archives)
+    assert all(archive.client is client for archive, client in zip(archives, clients))
+    assert all(archive.read("manifest.json") == b"{}" for archive in archives)
+
+
+def test_failed_upload_leaves_no_object_nor_manifest(s3_bucket):
+    collector = create_collector("s3://bucket/usage", multipart_threshold=5 * 1024 * 1024)
+
+    def lines():
+        for i in range(300000):
+            yield f"10305914213,31774820,{i / 1000:.6f},Active Import Interval (kW),05-04-2023 01:30"
+        raise ConnectionError("HDF download interrupted")
+    with pytest.raises(ConnectionError):
+        collector.persist_lines_in_s3("HDF-2023-04-05T0130.csv", lines())
+    assert 'Contents' not in s3_bucket.list_objects_v2(Bucket='bucket')
+    assert 'Uploads' not in s3_bucket.list_multipart_uploads(Bucket='bucket')
+    assert collector.retireve_last_updated_datetime() is None
+
+
+def test_collector_uses_a_single_pooled_client(s3_bucket):
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=2, hour=23, minute=30))
+    collector = create_collector("s3://bucket/usage", collection, compression='gzip', s3_max_connections=4)
+    filename, _ = collector.persist_collected_data()
+    assert collector.s3_client() is collector.s3_client()
+    assert collector.s3_client().meta.config.max_pool_connections == 4
+    assert collector.archive.read(filename).decode().splitlines() == collection
+    assert collector.retireve_last_updated_datetime() == datetime(year=2023, month=1, day=2, hour=23, minute=30)
+
+
+def sinks_collector(storage_paths, collection):
+    return create_collector(storage_paths, collection, sink_backoff=0)
+
+
+def test_persist_into_several_sinks_with_their_own_watermark(s3_bucket, tmp_path):
+    local_path = str(tmp_path)
+    first_day = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 1, 23, 30))
+    collection = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 2, 23, 30))
+    sinks_collector(local_path, first_day).persist_collected_data()
+    # the S3 sink is added later: it gets both days, the local sink only the second one
+    collector = sinks_collector([local_path, "s3://bucket/usage"], collection)
+    assert collector.last_updated_datetime is None
+    assert [s.last_updated_datetime for s in collector.sinks] == [datetime(2023, 1, 1, 23, 30), None]
+    filename, _ = collector.persist_collected_data()
+    assert filename == "HDF-2023-01-02T2330.csv"
+    local, s3 = [sink.archive for sink in collector.sinks]
+    assert local.list_files() == ["HDF-2023-01-01T2330.csv", "HDF-2023-01-02T2330.csv"]
+    assert len(local.read(filename).decode().splitlines()) == 1 + 48
+    assert s3.list_files() == [filename]
+    assert s3.read(filename).decode().splitlines() == collection
+    collector = sinks_collector([local_path, "s3://bucket/usage"], collection)
+    assert collector.last_updated_datetime == datetime(2023, 1, 2, 23, 30)
+    assert collector.persist_collected_data() == (None, None)
+
+
+def test_sinks_are_written_concurrently_and_retried(tmp_path, monkeypatch):
+    paths = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    for path in paths:
+        os.makedirs(path)
+    collection = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 1, 23, 30))
+    collector = sinks_collector(paths, collection)
+    original_write = FilesystemArchive.write
+
+    def write(archive, relative_path, body, compress=False):
+        if relative_path.endswith('.csv'):
+            both_writing.wait()  # raises BrokenBarrierError unless both sinks write at the same time
+            if failures.get(archive.storage_path, 0) > 0:
+                failures[archive.storage_path] -= 1
+                raise OSError("transient failure")
+        original_write(archive, relative_path, body, compress)
+    monkeypatch.setattr(FilesystemArchive, 'write', write)
+    both_writing, failures = threading.Barrier(2, timeout=10), {}
+    collector.persist_collected_data()
+    assert [sink.archive.list_files() for sink in collector.sinks] == [["HDF-2023-01-01T2330.csv"]] * 2
+
+    # a failing sink is retried on its own, then fails the run without stopping the other sink
+    collection = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 2, 23, 30))
+    collector = sinks_collector(paths, collection)
+    both_writing, failures = threading.Barrier(1), {paths[1]: 3}
+    with pytest.raises(OSError):
+        collector.persist_collected_data()
+    assert failures[paths[1]] == 0
+    assert [sink.archive.list_files()[-1] for sink in collector.sinks] == \
+        ["HDF-2023-01-02T2330.csv", "HDF-2023-01-01T2330.csv"]
+    assert not [f for f in os.listdir(paths[1]) if f.endswith('.tmp')]
+    failures = {paths[1]: 1}  # retried once
+    collector = sinks_collector(paths, collection)
+    assert collector.last_updated_datetime == datetime(2023, 1, 1, 23, 30)
+    assert collector.persist_collected_data()[0] == "HDF-2023-01-02T2330.csv"
+    assert [sink.archive.list_files()[-1] for sink in collector.sinks] == ["HDF-2023-01-02T2330.csv"] * 2
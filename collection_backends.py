@@ -0,0 +1,423 @@
+import json
+import logging
+import os
+import re
+import socket
+import time
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from http.cookiejar import Cookie, CookieJar
+from tempfile import mkdtemp
+from urllib.parse import urljoin, urlencode
+from urllib.request import Request
+
+# Collection backends download the HDF file of an account into a download directory.
+# ElectricityUsageCollector.collect() only depends on CollectionBackend.download_hdf()
+# so that the browser based flow (SeleniumBackend) can be replaced by plain HTTP
+# requests (HttpBackend) where the portal allows it.
+
+PORTAL_URL = 'https://www.esbnetworks.ie'
+DOWNLOAD_TIMEOUT = 60  # seconds
+PARTIAL_DOWNLOAD_SUFFIXES = ('.crdownload', '.part', '.tmp')
+SESSION_MAX_AGE = timedelta(hours=12)
+
+
+class CollectionBackend():
+    def download_hdf(self, download_file_path) -> str:
+        # downloads the HDF file into download_file_path and returns the path of the file
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+def wait_for_download(directory, prefix, timeout=DOWNLOAD_TIMEOUT, poll_interval=0.2, ignore=()):
+    # Waits until a complete file starting with prefix is in directory and returns its path.
+    # A download is complete when there are no partial (.crdownload) files left and the
+    # file size did not change between two consecutive polls.
+    deadline = time.monotonic() + timeout
+    candidate, candidate_size = None, None
+    while True:
+        files = [f for f in os.listdir(directory) if f not in ignore]
+        downloading = [f for f in files if f.endswith(PARTIAL_DOWNLOAD_SUFFIXES)]
+        downloaded = [f for f in files if f.startswith(prefix) and not f.endswith(PARTIAL_DOWNLOAD_SUFFIXES)]
+        if len(downloaded) > 1:
+            raise ValueError(f"Found {len(downloaded)} {prefix} files in {directory}")
+        if len(downloaded) == 1 and len(downloading) == 0:
+            file = os.path.join(directory, downloaded[0])
+            size = os.path.getsize(file)
+            if file == candidate and size == candidate_size:
+                return file
+            candidate, candidate_size = file, size
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Found {len(downloaded)} {prefix} files in {directory} after {timeout} seconds "
+                               + f"({len(downloading)} downloads in progress)")
+        time.sleep(poll_interval)
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Warm webdriver shared by the invocations handled by the same (Lambda) container
+_warm_driver = None
+
+
+def driver_is_alive(driver) -> bool:
+    try:
+        driver.current_url  # any command fails once the browser or the chromedriver session is gone
+        return True
+    except Exception:
+        return False
+
+
+def get_warm_driver(start_driver):
+    global _warm_driver
+    if _warm_driver is not None and not driver_is_alive(_warm_driver):
+        logging.info("Warm webdriver is not responsive, restarting it")
+        try:
+            _warm_driver.quit()
+        except Exception:
+            pass
+        _warm_driver = None
+    if _warm_driver is None:
+        _warm_driver = start_driver()
+    else:
+        logging.info("Reusing warm webdriver")
+    return _warm_driver
+
+
+class SeleniumBackend(CollectionBackend):
+    # Logs in and downloads the HDF file using Chrome (started on first use)
+    def __init__(self, username, password, chrome_driver_path, headless_chrome=True, keep_driver_warm=False,
+                 download_timeout=DOWNLOAD_TIMEOUT, portal_url=PORTAL_URL):
+        self.username = username
+        self.password = password
+        self.chrome_driver_path = chrome_driver_path
+        self.headless_chrome = headless_chrome
+        self.keep_driver_warm = keep_driver_warm
+        self.download_timeout = download_timeout
+        self.portal_url = portal_url
+        self.download_file_path = None
+        self._driver = None
+
+    def start_driver(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service
+        logging.info("Starting webdriver")
+        options = webdriver.ChromeOptions()
+        if self.headless_chrome:
+            options.binary_location = '/opt/chrome/chrome'
+            options.add_argument('--headless')
+            options.add_argument('--no-sandbox')
+            options.add_argument("--disable-gpu")
+            options.add_argument("--window-size=1280x1696")
+            options.add_argument("--single-process")
+            options.add_argument("--disable-dev-shm-usage")
+            options.add_argument("--disable-dev-tools")
+            options.add_argument("--no-zygote")
+            options.add_argument(f"--user-data-dir={mkdtemp()}")
+            options.add_argument(f"--data-path={mkdtemp()}")
+            options.add_argument(f"--disk-cache-dir={mkdtemp()}")
+            # a free port rather than the usual 9222 so that concurrent collections do not clash
+            options.add_argument(f"--remote-debugging-port={free_port()}")
+        # on every OS, so that each account downloads into its own directory rather than ~/Downloads
+        options.add_experimental_option("prefs", {"download.default_directory": self.download_file_path,
+                                                  "download.prompt_for_download": False})
+        service = Service(self.chrome_driver_path)
+        driver = webdriver.Chrome(service=service, options=options)
+        logging.info("Started webdriver")
+        return driver
+
+    def set_download_directory(self):
+        # a warm driver was started with the download directory of a previous invocation
+        self.driver.execute_cdp_cmd('Page.setDownloadBehavior',
+                                    {'behavior': 'allow', 'downloadPath': self.download_file_path})
+
+    @property
+    def driver(self):
+        # webdriver is started on first use (or reused from a previous invocation in warm mode)
+        if self._driver is None:
+            if self.keep_driver_warm:
+                self._driver = get_warm_driver(self.start_driver)
+            else:
+                self._driver = self.start_driver()
+        return self._driver
+
+    def release_driver(self):
+        if self._driver is None:
+            return
+        if self.keep_driver_warm:
+            # keep the browser (and its profile) for the next invocation but not the session
+            self._driver.delete_all_cookies()
+            self._driver.get('about:blank')
+        else:
+            self._driver.quit()
+        self._driver = None
+
+    def close(self):
+        self.release_driver()
+
+    def download_hdf(self, download_file_path):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        self.download_file_path = download_file_path
+        if self.keep_driver_warm:
+            self.set_download_directory()
+        wait = WebDriverWait(self.driver, 30)
+        self.driver.get(self.portal_url)
+        logging.info("Accepting cookies")
+        wait.until(EC.element_to_be_clickable((By.ID, "onetrust-accept-btn-handler"))).click()
+        wait.until(EC.invisibility_of_element_located((By.ID, "onetrust-accept-btn-handler")))
+        logging.info("Accepted cookies")
+        logging.info("Selecting Log in")
+        wait.until(EC.element_to_be_clickable((By.CLASS_NAME, "esb-navbar__navigation-base__login"))).click()
+        logging.info("Selected Log in")
+        logging.info("Opening Login page")
+        logging.info("Filling in username")
+        wait.until(EC.element_to_be_clickable((By.ID, "signInName"))).send_keys(self.username)
+        logging.info("Filled in username")
+        logging.info("Filling in password")
+        wait.until(EC.element_to_be_clickable((By.ID, "password"))).send_keys(self.password)
+        logging.info("Filled in password")
+        logging.info("Clicking Login button")
+        wait.until(EC.element_to_be_clickable((By.ID, "next"))).click()
+        logging.info("Clicked Login button")
+        logging.info("Selecting My energy consumption")
+        wait.until(EC.element_to_be_clickable((By.CLASS_NAME, "icon-dataconsumption"))).click()
+        logging.info("Selected My energy consumption")
+        download_hdf = wait.until(EC.presence_of_element_located((By.ID, "download-hdf")))
+        logging.info("Scrolling to download element")
+        self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", download_hdf)
+        download_hdf = wait.until(EC.element_to_be_clickable((By.ID, "download-hdf")))
+        previous_files = set(os.listdir(download_file_path))
+        logging.info("Downloading HDF")
+        download_hdf.click()
+        file = wait_for_download(download_file_path, "HDF", timeout=self.download_timeout,
+                                 ignore=previous_files)
+        logging.info("Downloaded HDF")
+        logging.info("Web collection completed")
+        self.release_driver()
+        return file
+
+
+class SessionCache():
+    # Session cookies encrypted at rest (Fernet, from the optional cryptography package)
+    # key is a urlsafe base64 encoded 32 byte key, e.g. from Fernet.generate_key()
+    def __init__(self, path, key, max_age=SESSION_MAX_AGE):
+        from cryptography.fernet import Fernet
+        self.path = path
+        self.fernet = Fernet(key)
+        self.max_age = max_age
+
+    def load(self, username):
+        from cryptography.fernet import InvalidToken
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as file:
+            try:
+                session = json.loads(self.fernet.decrypt(file.read()))
+            except InvalidToken:
+                logging.warning(f"Ignoring session cache {self.path} which can not be decrypted")
+                return None
+        if session['username'] != username:
+            return None
+        if datetime.now() - datetime.fromisoformat(session['saved_at']) > self.max_age:
+            return None
+        return session['cookies']
+
+    def save(self, username, cookies):
+        session = {'username': username, 'saved_at': datetime.now().isoformat(), 'cookies': cookies}
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as file:
+            file.write(self.fernet.encrypt(json.dumps(session).encode()))
+        os.replace(temporary_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def create_session_cache(path, key):
+    # session cache is optional: it requires both a key and the cryptography package
+    if path is None:
+        return None
+    if key is None:
+        logging.warning("SESSION_CACHE_KEY not defined, session cookies will not be cached")
+        return None
+    try:
+        return SessionCache(path, key)
+    except ImportError:
+        logging.warning("cryptography not installed, session cookies will not be cached")
+        return None
+
+
+class LoginFormParser(HTMLParser):
+    # action and input values of the first form of an HTML page
+    def __init__(self):
+        super().__init__()
+        self.action = None
+        self.inputs = {}
+        self.in_form = False
+        self.form_found = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form' and not self.form_found:
+            self.in_form = True
+            self.form_found = True
+            self.action = attrs.get('action')
+        elif tag == 'input' and self.in_form and attrs.get('name'):
+            self.inputs[attrs['name']] = attrs.get('value') or ''
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self.in_form = False
+
+
+class CookieResponse():
+    # Set-Cookie headers of a urllib3 response in the shape http.cookiejar expects (response.info().get_all())
+    def __init__(self, headers):
+        self.headers = headers
+
+    def info(self):
+        return self
+
+    def get_all(self, name, default=None):
+        return self.headers.getlist(name) or default
+
+
+COOKIE_ATTRIBUTES = ('version', 'name', 'value', 'port', 'port_specified', 'domain', 'domain_specified',
+                     'domain_initial_dot', 'path', 'path_specified', 'secure', 'expires', 'discard', 'comment',
+                     'comment_url')
+
+
+def cookies_to_list(cookies: CookieJar) -> list:
+    # cookies with their domain, path, expiry and HttpOnly flag (JSON serializable, for the session cache)
+    return [{**{a: getattr(c, a) for a in COOKIE_ATTRIBUTES}, 'httponly': c.has_nonstandard_attr('HttpOnly')}
+            for c in cookies]
+
+
+def cookies_from_list(values) -> CookieJar:
+    cookies = CookieJar()
+    for value in values:
+        cookies.set_cookie(Cookie(**{a: value[a] for a in COOKIE_ATTRIBUTES},
+                                  rest={'HttpOnly': None} if value['httponly'] else {}))
+    return cookies
+
+
+class HttpBackend(CollectionBackend):
+    # Logs in by submitting the sign in form (including its hidden fields, e.g. CSRF tokens)
+    # and downloads the HDF file with a pooled HTTP connection, without a browser.
+    # Session cookies can be cached (encrypted) to skip the login while the session is valid.
+    def __init__(self, username, password, login_url, download_url, username_field='signInName',
+                 password_field='password', session_cache=None, timeout=DOWNLOAD_TIMEOUT, max_redirects=10):
+        if login_url is None or download_url is None:
+            raise ValueError('HttpBackend requires login_url and download_url')
+        self.username = username
+        self.password = password
+        self.login_url = login_url
+        self.download_url = download_url
+        self.username_field = username_field
+        self.password_field = password_field
+        self.session_cache = session_cache
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        # cookies are only sent to the domain and path they were set for (redirects may leave the portal)
+        self.cookies = CookieJar()
+        self._http = None
+
+    @property
+    def http(self):
+        if self._http is None:
+            import urllib3
+            self._http = urllib3.PoolManager(num_pools=2, maxsize=4, timeout=self.timeout,
+                                             retries=urllib3.Retry(total=3, redirect=False, backoff_factor=0.5))
+        return self._http
+
+    def request(self, method, url, fields=None, preload_content=True):
+        # cookies are captured on every response, so redirects are followed here and not by urllib3
+        for _ in range(self.max_redirects + 1):
+            cookie_request = Request(url, method=method)
+            self.cookies.add_cookie_header(cookie_request)
+            headers = {}
+            if cookie_request.has_header('Cookie'):
+                headers['Cookie'] = cookie_request.get_header('Cookie')
+            body = None
+            if fields is not None:
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                body = urlencode(fields)
+            response = self.http.request(method, url, body=body, headers=headers, redirect=False,
+                                         preload_content=preload_content)
+            self.cookies.extract_cookies(CookieResponse(response.headers), cookie_request)
+            if response.status not in (301, 302, 303, 307, 308):
+                return response, url
+            response.drain_conn()
+            url = urljoin(url, response.headers['Location'])
+            if response.status != 307 and response.status != 308:
+                method, fields = 'GET', None
+        raise RuntimeError(f"Too many redirects requesting {url}")
+
+    def login(self):
+        logging.info("Opening Login page")
+        response, url = self.request('GET', self.login_url)
+        form = LoginFormParser()
+        form.feed(response.data.decode('utf-8', errors='replace'))
+        if not form.form_found:
+            raise RuntimeError(f"No login form found in {url}")
+        fields = dict(form.inputs)
+        fields[self.username_field] = self.username
+        fields[self.password_field] = self.password
+        logging.info("Submitting login form")
+        response, url = self.request('POST', urljoin(url, form.action or url), fields=fields)
+        if response.status >= 400:
+            raise RuntimeError(f"Login failed with HTTP status {response.status}")
+        logging.info("Logged in")
+        if self.session_cache is not None:
+            self.session_cache.save(self.username, cookies_to_list(self.cookies))
+
+    def download(self, download_file_path):
+        # returns the path of the downloaded file or None when the session is not (or no longer) valid
+        response, url = self.request('GET', self.download_url, preload_content=False)
+        content_disposition = response.headers.get('Content-Disposition', '')
+        if response.status != 200 or 'text/html' in response.headers.get('Content-Type', ''):
+            response.release_conn()
+            return None
+        match = re.search(r'filename="?([^";]+)"?', content_disposition)
+        filename = os.path.basename(match.group(1)) if match else 'HDF.csv'
+        if not filename.startswith('HDF'):
+            filename = f"HDF_{filename}"
+        file = os.path.join(download_file_path, filename)
+        with open(f"{file}.part", "wb") as f:
+            for chunk in response.stream(64 * 1024):
+                f.write(chunk)
+        response.release_conn()
+        os.replace(f"{file}.part", file)
+        return file
+
+    def download_hdf(self, download_file_path):
+        cached_cookies = self.session_cache.load(self.username) if self.session_cache is not None else None
+        if cached_cookies is not None:
+            logging.info("Reusing cached session")
+            self.cookies = cookies_from_list(cached_cookies)
+            file = self.download(download_file_path)
+            if file is not None:
+                logging.info("Downloaded HDF")
+                return file
+            logging.info("Cached session expired")
+            self.cookies = CookieJar()
+            self.session_cache.clear()
+        self.login()
+        file = self.download(download_file_path)
+        if file is None:
+            raise RuntimeError(f"HDF download from {self.download_url} failed after login")
+        logging.info("Downloaded HDF")
+        return file
+
+    def close(self):
+        if self._http is not None:
+            self._http.clear()
+            self._http = None
@@ -0,0 +1,392 @@
+from datetime import datetime
+from electricity_usage_collector import ElectricityUsageCollector, RuntimeMode
+from electricity_usage_collector_test import mock_collection_data_as_list
+from collection_backends import SeleniumBackend, HttpBackend, SessionCache, wait_for_download
+from html.parser import HTMLParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+import collection_backends
+import os
+import re
+import shutil
+import threading
+import time
+import pytest
+
+
+class FakeDriver():
+    def __init__(self):
+        self.alive = True
+        self.quit_calls = 0
+
+    @property
+    def current_url(self):
+        if not self.alive:
+            raise RuntimeError("chrome not reachable")
+        return 'about:blank'
+
+    def delete_all_cookies(self):
+        pass
+
+    def get(self, url):
+        pass
+
+    def quit(self):
+        self.quit_calls += 1
+
+
+def test_warm_driver_is_reused_and_restarted_when_unresponsive(monkeypatch):
+    monkeypatch.setattr(collection_backends, '_warm_driver', None)
+    started = []
+
+    def start_driver():
+        started.append(FakeDriver())
+        return started[-1]
+    backend = SeleniumBackend("username", "password", "chromedriver", keep_driver_warm=True)
+    monkeypatch.setattr(backend, 'start_driver', start_driver)
+    driver = backend.driver
+    backend.release_driver()
+    assert driver.quit_calls == 0
+    backend = SeleniumBackend("username", "password", "chromedriver", keep_driver_warm=True)
+    monkeypatch.setattr(backend, 'start_driver', start_driver)
+    assert backend.driver is driver
+    backend.release_driver()
+    driver.alive = False
+    assert collection_backends.get_warm_driver(start_driver) is not driver
+    assert driver.quit_calls == 1
+    assert len(started) == 2
+
+
+@pytest.mark.parametrize('headless_chrome', [True, False])
+def test_driver_downloads_into_account_directory(tmp_path, monkeypatch, headless_chrome):
+    webdriver = pytest.importorskip("selenium.webdriver")
+    started = []
+    monkeypatch.setattr(webdriver, 'Chrome', lambda service, options: started.append(options) or FakeDriver())
+    backend = SeleniumBackend("username", "password", "chromedriver", headless_chrome=headless_chrome)
+    backend.download_file_path = str(tmp_path)
+    backend.start_driver()
+    assert started[0].experimental_options['prefs']['download.default_directory'] == str(tmp_path)
+
+
+def test_wait_for_download_waits_for_complete_file(tmp_path):
+    (tmp_path / 'HDF_old.csv').write_text('previous run')
+
+    def download():
+        partial = tmp_path / 'HDF_10305914213.csv.crdownload'
+        with open(partial, 'w') as f:
+            for i in range(5):
+                f.write('row\n' * 1000)
+                f.flush()
+                time.sleep(0.05)
+        os.rename(partial, tmp_path / 'HDF_10305914213.csv')
+    downloader = threading.Thread(target=download)
+    downloader.start()
+    file = wait_for_download(str(tmp_path), 'HDF', timeout=10, poll_interval=0.02, ignore={'HDF_old.csv'})
+    downloader.join()
+    assert file == str(tmp_path / 'HDF_10305914213.csv')
+    assert os.path.getsize(file) == 5 * 4000
+
+
+def test_wait_for_download_times_out(tmp_path):
+    (tmp_path / 'HDF_10305914213.csv.crdownload').write_text('')
+    with pytest.raises(TimeoutError):
+        wait_for_download(str(tmp_path), 'HDF', timeout=0.1, poll_interval=0.02)
+
+
+STAND_IN_PORTAL = """<html><body>
+<button id="onetrust-accept-btn-handler" onclick="this.style.display='none';
+  setTimeout(() => document.getElementById('login').style.display='block', 300)">Accept</button>
+<a id="login" class="esb-navbar__navigation-base__login" style="display:none" href="#"
+  onclick="setTimeout(() => document.getElementById('form').style.display='block', 300)">Log in</a>
+<div id="form" style="display:none">
+  <input id="signInName"><input id="password" type="password">
+  <button id="next" onclick="setTimeout(() => document.getElementById('consumption').style.display='block', 300)">
+    Sign in</button>
+</div>
+<a id="consumption" class="icon-dataconsumption" style="display:none" href="#"
+  onclick="setTimeout(() => document.getElementById('download-hdf').style.display='block', 300)">My energy</a>
+<div style="height:3000px"></div>
+<a id="download-hdf" style="display:none" href="HDF_10305914213.csv" download>Download</a>
+</body></html>"""
+
+
+@pytest.mark.skipif(shutil.which('chromedriver') is None, reason="Requires chromedriver and chrome")
+def test_collect_against_stand_in_portal(tmp_path, monkeypatch):
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+    from functools import partial
+    from selenium import webdriver
+    site = tmp_path / 'site'
+    site.mkdir()
+    downloads = tmp_path / 'downloads'
+    downloads.mkdir()
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=2, hour=23, minute=30))
+    (site / 'index.html').write_text(STAND_IN_PORTAL)
+    (site / 'HDF_10305914213.csv').write_text('\n'.join(collection))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(SimpleHTTPRequestHandler, directory=str(site)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def start_driver():
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless=new')
+        options.add_experimental_option("prefs", {"download.default_directory": str(downloads)})
+        return webdriver.Chrome(options=options)
+    collector = ElectricityUsageCollector(username="username", password="password", storage_path=None,
+                                          dry_run=False, runtime_mode=RuntimeMode.TEST, download_timeout=10,
+                                          portal_url=f'http://127.0.0.1:{server.server_port}/index.html')
+    collector.download_file_path = str(downloads)
+    monkeypatch.setattr(collector.backend, 'start_driver', start_driver)
+    try:
+        collector.collect()
+    finally:
+        server.shutdown()
+    assert collector.collected_csv_data.splitlines() == collection
+    assert os.listdir(downloads) == []
+
+
+class StandInPage(HTMLParser):
+    # Elements (with an id) of STAND_IN_PORTAL and the effects of their onclick handlers: hidden elements
+    # are shown setTimeout milliseconds after the click, "this" is hidden right away
+    def __init__(self, html):
+        super().__init__()
+        self.elements, self.parents = {}, []
+        self.feed(html)
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if 'id' in attrs:
+            shows = re.findall(r"setTimeout\(\(\) => document.getElementById\('([^']+)'\)"
+                               r"\.style\.display='block', (\d+)\)", attrs.get('onclick') or '')
+            self.elements[attrs['id']] = FakeElement(
+                attrs, self.parents[-1] if self.parents else None, hides_itself="this.style.display='none'"
+                in (attrs.get('onclick') or ''), shows=[(element_id, int(ms) / 1000) for element_id, ms in shows])
+        if tag != 'input':
+            self.parents.append(self.elements.get(attrs.get('id'), self.parents[-1] if self.parents else None))
+
+    def handle_endtag(self, tag):
+        self.parents.pop()
+
+
+class FakeElement():
+    def __init__(self, attrs, parent, hides_itself, shows):
+        self.attrs, self.parent, self.hides_itself, self.shows = attrs, parent, hides_itself, shows
+        self.hidden = 'display:none' in (attrs.get('style') or '')
+        self.browser = None
+
+    def is_displayed(self):
+        return not self.hidden and (self.parent is None or self.parent.is_displayed())
+
+    def is_enabled(self):
+        return True
+
+    def send_keys(self, value):
+        self.browser.typed[self.attrs['id']] = self.browser.typed.get(self.attrs['id'], '') + value
+
+    def click(self):
+        from selenium.common.exceptions import ElementNotInteractableException
+        if not self.is_displayed():
+            raise ElementNotInteractableException(f"element {self.attrs['id']} not interactable")
+        self.hidden = self.hidden or self.hides_itself
+        for element_id, delay in self.shows:
+            threading.Timer(delay, setattr, [self.browser.page.elements[element_id], 'hidden', False]).start()
+        if 'download' in self.attrs:
+            threading.Thread(target=self.browser.download, args=[self.attrs['href']]).start()
+
+
+class FakeBrowser(FakeDriver):
+    # Chrome driven by SeleniumBackend: renders STAND_IN_PORTAL at url and downloads files of site
+    # (as partial .crdownload files renamed once complete) into the download directory
+    def __init__(self, options, url, site):
+        super().__init__()
+        self.download_directory = options.experimental_options['prefs']['download.default_directory']
+        self.url, self.site, self.page, self.scrolled, self.typed = url, site, None, [], {}
+
+    def get(self, url):
+        self.page = StandInPage(STAND_IN_PORTAL) if url == self.url else None
+        for element in self.page.elements.values() if self.page else []:
+            element.browser = self
+
+    def find_element(self, by, value):
+        from selenium.common.exceptions import NoSuchElementException
+        for element_id, element in (self.page.elements.items() if self.page else []):
+            if (by, value) in [('id', element_id), ('class name', element.attrs.get('class'))]:
+                return element
+        raise NoSuchElementException(f"no element {by}={value}")
+
+    def execute_script(self, script, element):
+        self.scrolled.append(element.attrs['id'])
+
+    def execute_cdp_cmd(self, command, parameters):
+        assert command == 'Page.setDownloadBehavior'
+        self.download_directory = parameters['downloadPath']
+
+    def download(self, filename):
+        partial = os.path.join(self.download_directory, f"{filename}.crdownload")
+        with open(partial, 'w') as f:
+            for line in self.site[filename]:
+                f.write(line + '\n')
+                f.flush()
+                time.sleep(0.001)
+        os.rename(partial, os.path.join(self.download_directory, filename))
+
+
+@pytest.mark.parametrize('keep_driver_warm', [False, True])
+def test_collect_against_stand_in_page(tmp_path, monkeypatch, keep_driver_warm):
+    webdriver = pytest.importorskip("selenium.webdriver")
+    monkeypatch.setattr(collection_backends, '_warm_driver', None)
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=2, hour=23, minute=30))
+    browsers = []
+    monkeypatch.setattr(webdriver, 'Chrome', lambda service, options: browsers.append(FakeBrowser(
+        options, 'https://portal/', {'HDF_10305914213.csv': collection})) or browsers[-1])
+    for account in ['first', 'second']:
+        downloads = tmp_path / account
+        downloads.mkdir()
+        (downloads / 'HDF_previous.csv.crdownload').write_text('abandoned download of a previous run')
+        collector = ElectricityUsageCollector(username="username", password="password", storage_path=None,
+                                              dry_run=False, runtime_mode=RuntimeMode.TEST, download_timeout=10,
+                                              portal_url='https://portal/', keep_driver_warm=keep_driver_warm,
+                                              download_file_path=str(downloads))
+        collector.collect()
+        assert collector.collected_csv_data.splitlines() == collection
+        assert os.listdir(downloads) == ['HDF_previous.csv.crdownload']
+        assert browsers[-1].scrolled[-1] == 'download-hdf'
+        assert browsers[-1].typed == {'signInName': 'username', 'password': 'password'}
+        browsers[-1].typed.clear()
+    # a warm browser is reused (and pointed at the download directory of every account)
+    assert len(browsers) == (1 if keep_driver_warm else 2)
+    assert browsers[-1].quit_calls == (0 if keep_driver_warm else 1)
+
+
+class StandInPortal(BaseHTTPRequestHandler):
+    # Mimics a form based sign in (with a hidden CSRF field) and an authenticated HDF download
+    hdf = ''
+    sessions = set()
+    logins = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def redirect(self, location, cookie=None):
+        self.send_response(302)
+        self.send_header('Location', location)
+        if cookie is not None:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+
+    def session(self):
+        cookies = dict(c.strip().split('=', 1) for c in self.headers.get('Cookie', '').split(';') if '=' in c)
+        return cookies.get('session')
+
+    def do_GET(self):
+        if self.path == '/login':
+            body = b'<html><form method="post" action="/login/submit"><input type="hidden" name="csrf" ' \
+                   b'value="token"><input name="signInName"><input name="password" type="password"></form></html>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Set-Cookie', 'csrf_cookie=token; Path=/')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/cookies':
+            body = self.headers.get('Cookie', '').encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/download' and self.session() in StandInPortal.sessions:
+            body = StandInPortal.hdf.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Disposition', 'attachment; filename="HDF_10305914213.csv"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.redirect('/login')
+
+    def do_POST(self):
+        fields = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        if self.path == '/login/submit' and fields.get('csrf') == ['token'] \
+                and fields.get('signInName') == ['username'] and fields.get('password') == ['password']:
+            StandInPortal.logins += 1
+            session = f"session{StandInPortal.logins}"
+            StandInPortal.sessions.add(session)
+            self.redirect('/', cookie=f'session={session}; Path=/; HttpOnly')
+        else:
+            self.send_response(403)
+            self.end_headers()
+
+
+@pytest.fixture
+def stand_in_portal():
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=2, hour=23, minute=30))
+    StandInPortal.hdf = '\n'.join(collection)
+    StandInPortal.sessions = set()
+    StandInPortal.logins = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInPortal)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', collection
+    server.shutdown()
+
+
+def test_http_backend_collects_without_browser(tmp_path, stand_in_portal):
+    url, collection = stand_in_portal
+    backend = HttpBackend("username", "password", login_url=f'{url}/login', download_url=f'{url}/download')
+    collector = ElectricityUsageCollector(username="username", password="password", storage_path=None,
+                                          dry_run=False, runtime_mode=RuntimeMode.TEST, backend=backend)
+    collector.download_file_path = str(tmp_path)
+    collector.collect()
+    assert collector.collected_csv_data.splitlines() == collection
+    assert os.listdir(tmp_path) == []
+    assert StandInPortal.logins == 1
+
+
+def test_http_backend_reuses_cached_session(tmp_path, stand_in_portal):
+    cryptography = pytest.importorskip("cryptography.fernet")
+    url, collection = stand_in_portal
+    key = cryptography.Fernet.generate_key()
+    cache_path = str(tmp_path / 'session')
+
+    def download():
+        backend = HttpBackend("username", "password", login_url=f'{url}/login', download_url=f'{url}/download',
+                              session_cache=SessionCache(cache_path, key))
+        file = backend.download_hdf(str(tmp_path))
+        backend.close()
+        with open(file) as f:
+            assert f.read().splitlines() == collection
+        os.remove(file)
+    download()
+    download()
+    assert StandInPortal.logins == 1
+    with open(cache_path, 'rb') as f:
+        assert b'session1' not in f.read()  # encrypted at rest
+    assert [c['httponly'] for c in SessionCache(cache_path, key).load("username") if c['name'] == 'session'] == [True]
+    # server side session expiry
+    StandInPortal.sessions.clear()
+    download()
+    assert StandInPortal.logins == 2
+    # a cache encrypted with another key is ignored
+    assert SessionCache(cache_path, cryptography.Fernet.generate_key()).load("username") is None
+
+
+def test_http_backend_sends_cookies_to_their_host_only(tmp_path, stand_in_portal):
+    url, _ = stand_in_portal
+    backend = HttpBackend("username", "password", login_url=f'{url}/login', download_url=f'{url}/download')
+    backend.login()
+    response, _ = backend.request('GET', f'{url}/cookies')
+    assert sorted(response.data.decode().split('; ')) == ['csrf_cookie=token', 'session=session1']
+    # same server under another host name (e.g. a redirect to another domain)
+    response, _ = backend.request('GET', f"{url.replace('127.0.0.1', 'localhost')}/cookies")
+    assert response.data == b''
+
+
+def test_http_backend_login_failure(tmp_path, stand_in_portal):
+    url, _ = stand_in_portal
+    backend = HttpBackend("username", "wrong", login_url=f'{url}/login', download_url=f'{url}/download')
+    with pytest.raises(RuntimeError):
+        backend.download_hdf(str(tmp_path))
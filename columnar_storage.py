@@ -0,0 +1,121 @@
+import io
+import logging
+import numpy as np
+from usage_series import UsageSeries
+
+# Columnar copy of the persisted HDF data, partitioned by mprn/year/month:
+# columnar/mprn=10305914213/year=2023/month=01/part-HDF-2023-01-02T2330.parquet
+# MPRN, meter serial and read type are dictionary-encoded, read values are float64 (or float32)
+# and timestamps int64 (seconds since epoch, timestamp[s] in parquet).
+# Parquet requires pyarrow, otherwise partitions are written as compressed numpy archives (.npz).
+COLUMNAR_DIRECTORY = 'columnar'
+PARQUET_EXTENSION = '.parquet'
+NUMPY_EXTENSION = '.npz'
+
+
+def pyarrow_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def partition_path(mprn, year, month) -> str:
+    return f"{COLUMNAR_DIRECTORY}/mprn={mprn}/year={year}/month={month:02d}"
+
+
+def partitions(series: UsageSeries):
+    # yields (mprn, year, month, series of the partition), grouping all rows in a single vectorized pass
+    if len(series) == 0:
+        return
+    months = series.timestamps.astype('datetime64[M]').astype(np.int64)
+    keys = series.mprn_codes.astype(np.int64) * (months.max() + 1) + months
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    boundaries = np.flatnonzero(np.diff(inverse[order])) + 1
+    for key, indices in zip(unique_keys, np.split(order, boundaries)):
+        mprn_code, month = divmod(int(key), int(months.max() + 1))
+        year, month_of_year = divmod(month, 12)
+        yield str(series.mprn_categories[mprn_code]), 1970 + year, month_of_year + 1, \
+            series.select(indices).compacted()
+
+
+def encode_parquet(series: UsageSeries, value_dtype=np.float64) -> bytes:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.table({
+        'mprn': pa.DictionaryArray.from_arrays(series.mprn_codes.astype(np.int32), series.mprn_categories),
+        'meter_serial': pa.DictionaryArray.from_arrays(series.serial_codes.astype(np.int32),
+                                                       series.serial_categories),
+        'read_value': pa.array(series.read_values.astype(value_dtype)),
+        'read_type': pa.DictionaryArray.from_arrays(series.read_type_codes.astype(np.int32),
+                                                    series.read_type_categories),
+        'read_datetime': pa.array(series.timestamps.astype('datetime64[s]'), type=pa.timestamp('s')),
+    })
+    buffer = io.BytesIO()
+    # dictionaries only for the repeated columns, delta encoded timestamps and byte stream split
+    # values compress ~20x better than the csv text
+    pq.write_table(table, buffer, compression='zstd', use_dictionary=['mprn', 'meter_serial', 'read_type'],
+                   column_encoding={'read_datetime': 'DELTA_BINARY_PACKED', 'read_value': 'BYTE_STREAM_SPLIT'})
+    return buffer.getvalue()
+
+
+def decode_parquet(data: bytes) -> UsageSeries:
+    import pyarrow.parquet as pq
+    table = pq.read_table(io.BytesIO(data))
+    columns = {}
+    for name in ['mprn', 'meter_serial', 'read_type']:
+        column = table.column(name).combine_chunks()
+        if not hasattr(column, 'dictionary'):
+            column = column.dictionary_encode()
+        columns[name] = (column.dictionary.to_numpy(zero_copy_only=False).astype(str),
+                         column.indices.to_numpy(zero_copy_only=False))
+    return UsageSeries(*columns['mprn'], *columns['meter_serial'],
+                       table.column('read_value').to_numpy().astype(np.float64),
+                       *columns['read_type'],
+                       table.column('read_datetime').to_numpy().astype('datetime64[m]'))
+
+
+def encode_numpy(series: UsageSeries, value_dtype=np.float64) -> bytes:
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer,
+                        mprn_categories=series.mprn_categories, mprn_codes=series.mprn_codes,
+                        serial_categories=series.serial_categories, serial_codes=series.serial_codes,
+                        read_values=series.read_values.astype(value_dtype),
+                        read_type_categories=series.read_type_categories, read_type_codes=series.read_type_codes,
+                        timestamps=series.timestamps.astype('datetime64[s]').astype(np.int64))
+    return buffer.getvalue()
+
+
+def decode_numpy(data: bytes) -> UsageSeries:
+    with np.load(io.BytesIO(data)) as arrays:
+        return UsageSeries(arrays['mprn_categories'], arrays['mprn_codes'],
+                           arrays['serial_categories'], arrays['serial_codes'],
+                           arrays['read_values'].astype(np.float64),
+                           arrays['read_type_categories'], arrays['read_type_codes'],
+                           arrays['timestamps'].astype('datetime64[s]').astype('datetime64[m]'))
+
+
+def columnar_files(series: UsageSeries, filename, use_parquet=None, value_dtype=np.float64):
+    # yields (relative path, bytes) of the partition files holding the series persisted as filename
+    if use_parquet is None:
+        use_parquet = pyarrow_available()
+        if not use_parquet:
+            logging.info("pyarrow not installed, writing columnar partitions as numpy archives")
+    stem = filename.rsplit('.', 1)[0]
+    for mprn, year, month, partition in partitions(series):
+        if use_parquet:
+            yield f"{partition_path(mprn, year, month)}/part-{stem}{PARQUET_EXTENSION}", \
+                encode_parquet(partition, value_dtype)
+        else:
+            yield f"{partition_path(mprn, year, month)}/part-{stem}{NUMPY_EXTENSION}", \
+                encode_numpy(partition, value_dtype)
+
+
+def read_columnar_file(path, data: bytes) -> UsageSeries:
+    if path.endswith(PARQUET_EXTENSION):
+        return decode_parquet(data)
+    elif path.endswith(NUMPY_EXTENSION):
+        return decode_numpy(data)
+    raise ValueError(f"Unexpected columnar file: {path}")
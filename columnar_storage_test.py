@@ -0,0 +1,51 @@
+from datetime import datetime
+from conftest import create_collector
+from electricity_usage_collector_test import mock_collection_data_as_list
+from columnar_storage import columnar_files, partitions, read_columnar_file
+from usage_series import UsageSeries
+import numpy as np
+import pytest
+
+
+def two_meter_series():
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=30, hour=0, minute=0),
+        datetime(year=2023, month=2, day=2, hour=23, minute=30), fixed_usage=False)
+    other_meter = [row.replace('10305914213', '10305914214') for row in collection[1:]]
+    return UsageSeries.from_csv('\n'.join(collection + other_meter))
+
+
+def test_partitions_by_mprn_year_month():
+    series = two_meter_series()
+    keys = [(mprn, year, month, len(partition)) for mprn, year, month, partition in partitions(series)]
+    assert keys == [('10305914213', 2023, 1, 96), ('10305914213', 2023, 2, 96),
+                    ('10305914214', 2023, 1, 96), ('10305914214', 2023, 2, 96)]
+
+
+@pytest.mark.parametrize("use_parquet", [False, True])
+def test_columnar_files_round_trip(use_parquet):
+    if use_parquet:
+        pytest.importorskip("pyarrow")
+    series = two_meter_series()
+    files = list(columnar_files(series, "HDF-2023-02-02T2330.csv", use_parquet=use_parquet))
+    extension = 'parquet' if use_parquet else 'npz'
+    assert files[0][0] == f"columnar/mprn=10305914213/year=2023/month=01/part-HDF-2023-02-02T2330.{extension}"
+    restored = [read_columnar_file(path, body) for path, body in files]
+    assert sum(len(r) for r in restored) == len(series)
+    first = restored[0]
+    assert first.read_values.dtype == np.float64
+    assert first.mprn_categories.tolist() == ['10305914213']
+    # columnar partitions render the same rows as the original csv
+    assert first.to_csv().splitlines()[1:] == [r for r in series.rows.tolist()
+                                               if r.startswith('10305914213') and '-01-2023' in r]
+    assert sum(len(body) for _, body in files) < len(series.to_csv()) / 2
+
+
+def test_persist_collected_data_in_both_formats(tmp_path):
+    collector = create_collector(str(tmp_path), two_meter_series().to_csv().splitlines(), storage_format='both')
+    filename, _ = collector.persist_collected_data()
+    assert (tmp_path / filename).exists()
+    partition_files = sorted(p.relative_to(tmp_path).as_posix() for p in (tmp_path / 'columnar').rglob('part-*'))
+    assert len(partition_files) == 4
+    assert partition_files[-1].startswith("columnar/mprn=10305914214/year=2023/month=02/part-HDF-2023-02-02T2330")
+    assert collector.retireve_last_updated_datetime() == datetime(year=2023, month=2, day=2, hour=23, minute=30)
@@ -0,0 +1,33 @@
+from electricity_usage_collector import ElectricityUsageCollector, RuntimeMode
+from instrumentation import RunMetrics
+import pytest
+
+# Fixtures and helpers shared by the *_test.py modules
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='bucket')
+        yield s3
+
+
+def create_collector(storage_path, rows=None, **options):
+    # collector of storage_path (one path or a list of sinks) with its watermark read and, when given, rows
+    # (HDF lines, header first) collected; options are ElectricityUsageCollector keyword arguments
+    collector = ElectricityUsageCollector(username="username", password="password", storage_path=storage_path,
+                                          dry_run=False, runtime_mode=RuntimeMode.TEST,
+                                          **{'metrics': RunMetrics(output='off'), **options})
+    collector.retireve_last_updated_datetime()
+    if rows is not None:
+        collector.simulate_collection('\n'.join(rows))
+    return collector
+
+
+def collect(storage_path, rows, **options):
+    # persists rows newer than the watermark of storage_path, returns the persisted file (None without new rows)
+    return create_collector(storage_path, rows, **options).persist_collected_data()[0]
@@ -1,17 +1,29 @@
-import time
+import collections
+import copy
+import functools
+import itertools
 import logging
 import argparse
 import os
 import platform
-import boto3
+import json
+import hashlib
+import random
+import sys
+import time
 from datetime import datetime
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 from enum import Enum
+from collection_backends import SeleniumBackend, HttpBackend, create_session_cache, DOWNLOAD_TIMEOUT, PORTAL_URL
+from archive_storage import open_archive, hdf_filename_datetime, HDF_FILENAME_FORMAT, MANIFEST_FILENAME, \
+    COMPACTED_FILENAME_PATTERN, COMPRESSIONS, S3_MAX_CONNECTIONS, MULTIPART_THRESHOLD
+from columnar_storage import columnar_files
+from instrumentation import RunMetrics, instrumented
+from usage_analytics import UsageAnalytics
+from time_range_index import TimeRangeIndex, IndexEntryBuilder, index_entry
+from series_validation import validate, parse_policies, CHECKS, DEFAULT_POLICIES
+from usage_series import UsageSeries, HDF_DATETIME_FORMAT, iter_rows_newer_than, hdf_datetime_key
 
 # HDF file returns usage data since installation of smart meter until the last
 # available time (~12 hours ago)
@@ -20,19 +32,59 @@ from enum import Enum
 # 1. Collect usage up until two-days-ago if in catchup mode or
 # just the two-days-ago day if not in catchup mode
 # 2. Append usage to output
+# Catch-up (--backfill day|month) writes the new data as one file per day or month instead of a single file,
+# concurrently and resumably (see persist_partitions)
 
 # Installation steps
 # 1. Download and install Chrome driver from https://sites.google.com/chromium.org/driver/home
 # (script assumes it is installed in your Downloads folder)
-# 2. Install selenium `pip install selenium`
+# 2. Install selenium `pip install selenium` (and `pip install boto3 numpy`)
 # 3. Instantiate webdriver.Crome() using the path to chromdriver
+# selenium and boto3 are imported on first use so that importing this module (tests,
+# Lambda cold starts) does not pay for them, and Chrome is only started when collecting
+
+# csv: raw HDF-*.csv files, columnar: mprn/year/month partitioned parquet (or npz), both: csv and columnar
+STORAGE_FORMATS = ('csv', 'columnar', 'both')
+BACKFILL_PARTITIONS = {'day': 'D', 'month': 'M'}
+# written while a backfill is in progress, holds the watermark from before the backfill so that an
+# interrupted backfill is resumed from it (the partitions are written out of order)
+BACKFILL_MARKER_FILENAME = 'backfill.json'
+BACKFILL_WORKERS = 8
+# Several storage paths (-s repeated, e.g. local disk and S3) are sinks persisted concurrently (see fan_out)
+SINK_ATTEMPTS = 3
+SINK_BACKOFF = 1.0
 
 
 class ElectricityUsageCollector():
-    def __init__(self, username, password, storage_path, dry_run, runtime_mode):
+    def __init__(self, username, password, storage_path, dry_run, runtime_mode, keep_driver_warm=False,
+                 download_timeout=DOWNLOAD_TIMEOUT, portal_url=PORTAL_URL, backend=None, download_file_path=None,
+                 storage_format='csv', compression=None, s3_max_connections=S3_MAX_CONNECTIONS,
+                 multipart_threshold=MULTIPART_THRESHOLD, metrics=None, update_analytics=False, backfill=None,
+                 backfill_workers=BACKFILL_WORKERS, validation_policies=None, cache_dir=None,
+                 sink_attempts=SINK_ATTEMPTS, sink_backoff=SINK_BACKOFF):
         self.username = username
         self.password = password
-        self.storage_path = storage_path
+        # storage_path is a path or a list of paths (sinks), the first one is the primary sink
+        storage_paths = [storage_path] if storage_path is None or isinstance(storage_path, str) else list(storage_path)
+        self.storage_path = storage_paths[0]
+        self.sink_attempts = sink_attempts
+        self.sink_backoff = sink_backoff
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f"Unexpected storage format {storage_format}")
+        self.storage_format = storage_format
+        # keeps the analytics rollups (usage_analytics) up to date with every persisted file
+        self.update_analytics = update_analytics
+        if backfill is not None and backfill not in BACKFILL_PARTITIONS:
+            raise ValueError(f"Unexpected backfill partitioning {backfill}")
+        self.backfill = backfill
+        self.backfill_workers = backfill_workers
+        # fail/warn/ignore policy of every validation check (series_validation.py)
+        self.validation_policies = DEFAULT_POLICIES if validation_policies is None else validation_policies
+        self.validation_enabled = any(self.validation_policies.get(c, 'warn') != 'ignore' for c in CHECKS)
+        archives = [open_archive(path, compression=compression, s3_max_connections=s3_max_connections,
+                                 multipart_threshold=multipart_threshold, cache_dir=cache_dir)
+                    if path is not None else None for path in storage_paths]
+        self.archive = archives[0]
         self.runtime_mode = runtime_mode
         self.collected_csv_data = None
         self.last_updated_datetime = None
@@ -50,29 +102,52 @@ class ElectricityUsageCollector():
                 rf'C:\Users\{os.environ.get("USERNAME")}\Downloads'
             chrome_driver_path =\
                 rf'C:\Users\{os.environ.get("USERNAME")}\Downloads\chromedriver'
-            options = None
         elif os_name == 'Linux':
             self.download_file_path = '/var/task'
             chrome_driver_path = '/opt/chromedriver'
-            options = webdriver.ChromeOptions()
-            options.binary_location = '/opt/chrome/chrome'
-            options.add_argument('--headless')
-            options.add_argument('--no-sandbox')
-            options.add_argument("--disable-gpu")
-            options.add_argument("--window-size=1280x1696")
-            options.add_argument("--single-process")
-            options.add_argument("--disable-dev-shm-usage")
-            options.add_argument("--disable-dev-tools")
-            options.add_argument("--no-zygote")
-            options.add_argument(f"--user-data-dir={mkdtemp()}")
-            options.add_argument(f"--data-path={mkdtemp()}")
-            options.add_argument(f"--disk-cache-dir={mkdtemp()}")
-            options.add_argument("--remote-debugging-port=9222")
         else:
             raise ValueError(f"Unexpected os {os_name}")
-        if runtime_mode != RuntimeMode.TEST:
-            service = Service(chrome_driver_path)
-            self.driver = webdriver.Chrome(service=service, options=options)
+        if download_file_path is not None:
+            self.download_file_path = download_file_path
+        if backend is None:
+            backend = SeleniumBackend(username, password, chrome_driver_path, headless_chrome=os_name == 'Linux',
+                                      keep_driver_warm=keep_driver_warm, download_timeout=download_timeout,
+                                      portal_url=portal_url)
+        self.backend = backend
+        # per-stage timings, row/byte counts and peak RSS (COLLECTOR_METRICS, COLLECTOR_PROFILE)
+        self.metrics = metrics if metrics is not None else RunMetrics.from_environment()
+        self.sinks = None
+        if len(storage_paths) > 1:
+            self.sinks = [self.sink_collector(path, archive) for path, archive in zip(storage_paths, archives)]
+
+    def sink_collector(self, storage_path, archive):
+        # collector persisting into one of the sinks, with its own watermark (and metrics, stages of
+        # concurrent sinks cannot nest)
+        sink = copy.copy(self)
+        sink.storage_path, sink.archive = storage_path, archive
+        sink.metrics = RunMetrics(output=self.metrics.output, stream=self.metrics.stream,
+                                  dimensions={**self.metrics.dimensions, 'sink': storage_path})
+        return sink
+
+    def fan_out(self, function):
+        # function(sink) for every sink concurrently (so persisting takes as long as the slowest sink), each
+        # sink retried on its own on transient errors. Returns the results in sink order, raises the error
+        # of the first failed sink once every sink is done (the others are persisted meanwhile).
+        with ThreadPoolExecutor(max_workers=len(self.sinks)) as executor:
+            futures = [executor.submit(retry, functools.partial(function, sink), self.sink_attempts, self.sink_backoff)
+                       for sink in self.sinks]
+            wait(futures)
+        errors = [(sink, future.exception()) for sink, future in zip(self.sinks, futures)
+                  if future.exception() is not None]
+        for sink, error in errors:
+            logging.error(f"Persisting in {sink.storage_path} failed: {type(error).__name__}: {error}")
+        if errors:
+            raise errors[0][1]
+        return [future.result()[0] for future in futures]
+
+    def s3_client(self):
+        # pooled client shared by every S3 request of the collector
+        return self.archive.client
 
     def simulate_last_updated_datetime(self, last_updated_datetime: datetime):
         # Use this function only for testing purposes
@@ -85,6 +160,8 @@ class ElectricityUsageCollector():
         if self.runtime_mode != RuntimeMode.TEST:
             raise RuntimeError("simulate_last_updated_datetime only supported in test mode")
         self.last_updated_datetime = last_updated_datetime
+        for sink in self.sinks or []:
+            sink.last_updated_datetime = last_updated_datetime
 
     def bucket_and_path(self):
         path_parts = self.storage_path.split('/')
@@ -92,39 +169,59 @@ class ElectricityUsageCollector():
         s3_path = '/'.join(path_parts[3:])
         return bucket_name, s3_path
 
-    def list_s3_objects(self):
+    def list_s3_objects(self, max_workers=8):
         # "s3://{bucket_name}/{s3_path}"
         # s3://jdvhome-dev-data/raw-landing/energia/usage-timeseries
-        s3 = boto3.client('s3')
-        bucket_name, s3_path = self.bucket_and_path()
-        files = []
-        # FIXME: pagination not implemented yet (only required when more than 1000 files in bucket)
-        # pages_left = True
-        # continuation_token = None
-        # while pages_left:
-        #    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=s3_path, MaxKeys=1000,
-        #       ContinuationToken=continuation_token)
-        #    files.extend([e['Key'].split('/')[-1] for e in response.get('Contents', [])])
-        #    pages_left = response.get('IsTruncated')
-        #    continuation_token = response.get('NextContinuationToken')
-        response = s3.list_objects_v2(Bucket=bucket_name, Prefix=s3_path, MaxKeys=1000)
-        files.extend([e['Key'].split('/')[-1] for e in response.get(
-            'Contents', [])])
-        return files
+        return self.archive.list_files(max_workers=max_workers)
+
+    def list_filesystem_files(self):
+        return self.archive.list_files()
+
+    def read_manifest(self):
+        # manifest holds the latest persisted file so that the watermark lookup is a single read
+        # {"latest_file": "HDF-2023-01-02T2330.csv", "last_updated_datetime": "2023-01-02T23:30:00"}
+        body = self.archive.read(MANIFEST_FILENAME)
+        return None if body is None else json.loads(body)
+
+    def update_manifest(self, filename):
+        # atomically replaces the manifest unless it already refers to a more recent file
+        manifest = self.read_manifest()
+        if manifest is not None and hdf_filename_datetime(manifest['latest_file']) >= hdf_filename_datetime(filename):
+            return manifest
+        manifest = {'latest_file': filename,
+                    'last_updated_datetime': hdf_filename_datetime(filename).isoformat()}
+        self.archive.write(MANIFEST_FILENAME, json.dumps(manifest))
+        return manifest
 
+    @instrumented('retrieve_last_updated_datetime')
     def retireve_last_updated_datetime(self):
-        # detection of latest data collected from file/object name HDF-2023-01-02T2330.csv
-        if self.storage_path.startswith("s3://"):
-            persisted_files = self.list_s3_objects()
-        elif os.path.exists(self.storage_path):
-            persisted_files = os.listdir(self.storage_path)
-        else:
+        # detection of latest data collected from the manifest or, when there is no manifest yet,
+        # from the latest file/object name HDF-2023-01-02T2330.csv
+        if self.sinks is not None:
+            # every sink has its own watermark and only persists the rows newer than it, rows newer than the
+            # oldest one are collected
+            watermarks = self.fan_out(lambda sink: sink.retireve_last_updated_datetime())
+            self.last_updated_datetime = None if None in watermarks else min(watermarks)
+            return self.last_updated_datetime
+        if not self.archive.exists():
             raise RuntimeError("retrieve_last_updated_datetime Invalid or inexistent "
                                + f"storage path: {self.storage_path}")
-        if len(persisted_files) > 0:
-            latest_file = persisted_files[-1]
+        marker = self.archive.read(BACKFILL_MARKER_FILENAME)
+        if marker is not None:
+            last_updated_datetime = json.loads(marker)['last_updated_datetime']
+            logging.info(f"Resuming interrupted backfill from {last_updated_datetime}")
+            self.last_updated_datetime = None if last_updated_datetime is None \
+                else datetime.fromisoformat(last_updated_datetime)
+            return self.last_updated_datetime
+        manifest = self.read_manifest()
+        if manifest is not None:
+            latest_file = manifest['latest_file']
+        else:
+            persisted_files = self.archive.list_files()
+            latest_file = persisted_files[-1] if len(persisted_files) > 0 else None
+        if latest_file is not None:
             logging.info(f"latest file persisted was {latest_file}")
-            self.last_updated_datetime = datetime.strptime(latest_file, "HDF-%Y-%m-%dT%H%M.csv")
+            self.last_updated_datetime = hdf_filename_datetime(latest_file)
         return self.last_updated_datetime
 
     def simulate_collection(self, csv_data: str):
@@ -133,49 +230,17 @@ class ElectricityUsageCollector():
             raise RuntimeError("simulate_collection only supported in test mode")
         self.collected_csv_data = csv_data
 
+    @instrumented('download')
+    def download_hdf(self):
+        # returns the path of the HDF file downloaded by the collection backend
+        try:
+            return self.backend.download_hdf(self.download_file_path)
+        finally:
+            self.backend.close()
+
+    @instrumented('collect')
     def collect(self):
-        wait = WebDriverWait(self.driver, 30)
-        self.driver.get('https://www.esbnetworks.ie')
-        logging.info("Accepting cookies")
-        wait.until(EC.visibility_of_element_located((By.ID, "onetrust-accept-btn-handler"))).click()
-        logging.info("Accepted cookies")
-        time.sleep(10)
-        logging.info("Selecting Log in")
-        wait.until(EC.visibility_of_element_located((By.CLASS_NAME, "esb-navbar__navigation-base__login"))).click()
-        logging.info("Selected Log in")
-        logging.info("Opening Login page")
-        logging.info("Filling in username")
-        username_box = wait.until(EC.visibility_of_element_located((By.ID, "signInName")))
-        time.sleep(1)
-        username_box.send_keys(self.username)
-        logging.info("Filled in username")
-        logging.info("Filling in password")
-        wait.until(EC.visibility_of_element_located((By.ID, "password"))).send_keys(self.password)
-        logging.info("Filled in password")
-        logging.info("Clicking Login button")
-        wait.until(EC.visibility_of_element_located((By.ID, "next"))).click()
-        logging.info("Clicked Login button")
-        logging.info("Selecting My energy consumption")
-        wait.until(EC.visibility_of_element_located((By.CLASS_NAME, "icon-dataconsumption"))).click()
-        logging.info("Selected My energy consumption")
-        download_hdf = wait.until(EC.visibility_of_element_located((By.ID, "download-hdf")))
-        logging.info("Scrolling to download element")
-        download_hdf.send_keys("")
-        time.sleep(3)
-        logging.info("Downloading HDF")
-        download_hdf.click()
-        time.sleep(10)
-        logging.info("Downloaded HDF")
-        logging.info("Web collection completed")
-        self.driver.close()
-
-        logging.info("Processing HDF file")
-        # TODO: Wait until HDF is in Downloads
-        hdf_files = [f for f in os.listdir(self.download_file_path) if f.startswith("HDF")]
-        num_files_found = len(hdf_files)
-        if num_files_found != 1:
-            raise ValueError(f"Found {num_files_found} HDF files in {self.download_file_path}")
-        file = os.path.join(self.download_file_path, hdf_files[0])
+        file = self.download_hdf()
         logging.info(f"Processing HDF file: {file}")
         # Get HDF from Downloads
         with open(file, "r") as f:
@@ -184,8 +249,10 @@ class ElectricityUsageCollector():
         self.collected_csv_data = file_contents
         lines = file_contents.splitlines()
         len_lines = len(lines)
+        self.metrics.count(rows=max(len_lines - 1, 0), bytes_read=os.path.getsize(file))
         if len_lines < 4:
-            ValueError(f"HDF file only has {len_lines}")
+            os.remove(file)
+            raise ValueError(f"HDF file only has {len_lines} lines")
         logging.info(f"HDF first two lines of {len_lines}:")
         logging.info(f"{lines[0]}")
         logging.info(f"{lines[1]}")
@@ -196,69 +263,268 @@ class ElectricityUsageCollector():
         os.remove(file)
         logging.info("Removed downloaded HDF file")
 
-    def collected_row_datetime_not_persisted(self, row: str) -> datetime:
+    def collect_streaming(self):
+        # collect and persist in one pass, reading only the rows newer than last_updated_datetime
+        file = self.download_hdf()
+        logging.info(f"Streaming HDF file: {file}")
+        if self.sinks is not None:
+            filename, row_count = self.persisted_in_sinks(
+                self.fan_out(lambda sink: sink.persist_hdf_file_streaming(file)))
+        else:
+            filename, row_count = self.persist_hdf_file_streaming(file)
+        logging.info("Removing downloaded HDF file")
+        os.remove(file)
+        logging.info("Removed downloaded HDF file")
+        return filename, row_count
+
+    @instrumented('filter_data_already_persisted')
+    def filter_series_already_persisted(self) -> UsageSeries:
         # Sample CSV line
         # 10305914213,31774820,0.174000,Active Import Interval (kW),05-04-2023 01:30
-        columns = row.split(',')
-        if len(columns) != 5:
-            raise ValueError(f"Unexpected number of columns in HDF row: {len(columns)}: {columns}")
-        row_datetime = columns[-1]
-        parsed_datetime = datetime.strptime(row_datetime, "%d-%m-%Y %H:%M")
-        if self.last_collected_datetime is None:
-            self.last_collected_datetime = parsed_datetime
-        elif parsed_datetime > self.last_collected_datetime:
-            self.last_collected_datetime = parsed_datetime
-        logging.debug(f"usage_row_to_datetime parsed datetime: {parsed_datetime}")
-        return self.last_updated_datetime is None or parsed_datetime > self.last_updated_datetime
+        series = UsageSeries.from_csv(self.collected_csv_data)
+        self.last_collected_datetime = series.max_timestamp()
+        logging.debug(f"filter_data_already_persisted last collected datetime: {self.last_collected_datetime}")
+        new_series = series.select(series.newer_than(self.last_updated_datetime))
+        self.metrics.count(rows=len(new_series), bytes_read=len(self.collected_csv_data))
+        return new_series
 
     def filter_data_already_persisted(self) -> str:
-        list_of_rows = self.collected_csv_data.splitlines()
-        new_rows = [r for r in list_of_rows[1:] if self.collected_row_datetime_not_persisted(r)]
-        data_to_be_persisted = [list_of_rows[0]] + new_rows
-        return '\n'.join(data_to_be_persisted)
+        return self.filter_series_already_persisted().to_csv()
+
+    @instrumented('validate')
+    def validate_series(self, series, filename):
+        # validates the rows about to be persisted as filename (policies applied) and returns the report
+        report = validate(series, self.last_updated_datetime)
+        report.apply(self.validation_policies, filename)
+        self.metrics.count(rows=len(series))
+        return report
 
     def generate_filename(self):
         # HDF-2022-12-30T2330.csv
-        return self.last_collected_datetime.strftime("HDF-%Y-%m-%dT%H%M.csv")
+        return self.last_collected_datetime.strftime(HDF_FILENAME_FORMAT)
+
+    def index_persisted_file(self, filename, entry, report=None):
+        # time range index (time_range_index.py) entry of a persisted file, with its validation report, added
+        # before the manifest refers to the file
+        if report is not None:
+            entry['validation'] = report.to_dict()
+        TimeRangeIndex(self.archive).add(filename, entry)
+
+    def persist_in_filesystem(self, filename, data_to_be_persisted, report=None):
+        self.archive.write(filename, data_to_be_persisted)
+        self.metrics.count(bytes_written=len(data_to_be_persisted))
+        self.index_persisted_file(filename, index_entry(data_to_be_persisted.encode()), report)
+        self.update_manifest(filename)
+
+    def persist_in_s3(self, filename, data_to_be_persisted, report=None):
+        # compressed when the collector has a compression configured, the manifest is only
+        # updated once the object is complete
+        self.archive.write(filename, data_to_be_persisted, compress=True)
+        self.metrics.count(bytes_written=len(data_to_be_persisted))
+        self.index_persisted_file(filename, index_entry(data_to_be_persisted.encode(), self.archive.compression),
+                                  report)
+        self.update_manifest(filename)
+
+    def persist_lines_in_filesystem(self, filename, lines, report=None):
+        index_builder = IndexEntryBuilder()
+        self.archive.write_lines(filename, index_builder.wrap(lines))
+        self.index_persisted_file(filename, index_builder.entry(), report)
+        self.update_manifest(filename)
 
-    def persist_in_filesystem(self, filename, data_to_be_persisted):
-        file_path = os.path.join(self.storage_path, filename)
-        with open(file_path, "w") as file:
-            file.write(data_to_be_persisted)
+    def persist_lines_in_s3(self, filename, lines, report=None):
+        index_builder = IndexEntryBuilder(self.archive.compression)
+        self.archive.write_lines(filename, index_builder.wrap(lines), compress=True)
+        self.index_persisted_file(filename, index_builder.entry(), report)
+        self.update_manifest(filename)
 
-    def persist_in_s3(self, filename, data_to_be_persisted):
-        s3 = boto3.client('s3')
-        bucket_name, s3_path = self.bucket_and_path()
-        key = s3_path + '/' + filename
-        s3.put_object(Bucket=bucket_name, Key=key, Body=data_to_be_persisted)
+    def write_object(self, relative_path, body):
+        # writes body under the storage path, atomically (S3 PUT, or temporary file + rename)
+        self.archive.write(relative_path, body)
 
+    def persist_columnar(self, filename, series):
+        for relative_path, body in columnar_files(series, filename):
+            logging.info(f"Persisting {relative_path} with {len(body)} bytes in {self.storage_path}")
+            self.write_object(relative_path, body)
+            self.metrics.count(bytes_written=len(body))
+
+    @instrumented('persist_collected_data')
     def persist_collected_data(self):
         # persist only data not previously persisted
-        data_to_be_persisted = self.filter_data_already_persisted()
+        if self.sinks is not None:
+            def persist(sink):
+                sink.collected_csv_data = self.collected_csv_data
+                return sink.persist_collected_data()
+            results = self.fan_out(persist)
+            self.last_collected_datetime = self.sinks[0].last_collected_datetime
+            return self.persisted_in_sinks(results)
+        series_to_be_persisted = self.filter_series_already_persisted()
         filename = self.generate_filename()
-        data_to_be_persisted_rows = data_to_be_persisted.splitlines()
-        row_count = len(data_to_be_persisted_rows)
+        row_count = len(series_to_be_persisted)
+        # catch-up: the series is partitioned as is, the (multi-year) csv of all the rows is never rendered
+        data_to_be_persisted = None
+        if self.backfill is None or self.storage_path is None:
+            data_to_be_persisted = series_to_be_persisted.to_csv()
         if self.storage_path is not None:
-            if row_count > 1:
-                logging.info(f"Persisting {filename} with {row_count} HDF rows in {self.storage_path}")
-                if row_count > 0:
-                    logging.info(f"line 1: {data_to_be_persisted_rows[0]}")
-                if row_count > 1:
-                    logging.info(f"line 2: {data_to_be_persisted_rows[1]}")
-                if row_count > 0:
-                    logging.info(f"last line: {data_to_be_persisted_rows[-1]}")
-                if self.storage_path.startswith("s3://"):
-                    self.persist_in_s3(filename, data_to_be_persisted)
+            if row_count > 0:
+                logging.info(f"Persisting {filename} with {row_count} new HDF rows in {self.storage_path}")
+                if data_to_be_persisted is not None:
+                    # HDF lines are far shorter than 1024 characters, the whole csv is not split to log them
+                    first_lines = data_to_be_persisted[:1024].splitlines()
+                    logging.info(f"line 1: {first_lines[0]}")
+                    logging.info(f"line 2: {first_lines[1]}")
+                    logging.info(f"last line: {data_to_be_persisted[-1024:].splitlines()[-1]}")
+                self.metrics.count(rows=row_count)
+                report = None
+                if self.validation_enabled:
+                    report = self.validate_series(series_to_be_persisted, filename)
+                if self.storage_format in ('columnar', 'both'):
+                    self.persist_columnar(filename, series_to_be_persisted)
+                persisted_files = [filename]
+                if self.storage_format == 'columnar':
+                    self.update_manifest(filename)
+                elif self.backfill is not None:
+                    persisted_files = self.persist_partitions(series_to_be_persisted)
+                elif self.storage_path.startswith("s3://"):
+                    self.persist_in_s3(filename, data_to_be_persisted, report)
                 elif os.path.exists(self.storage_path):
-                    self.persist_in_filesystem(filename, data_to_be_persisted)
+                    self.persist_in_filesystem(filename, data_to_be_persisted, report)
+                if self.update_analytics:
+                    UsageAnalytics(self.archive).update_from_series(series_to_be_persisted, *persisted_files)
             else:
                 logging.info("No new data available for collection")
                 data_to_be_persisted = None
                 filename = None
         return filename, data_to_be_persisted
 
+    def persisted_in_sinks(self, results):
+        # result of the first sink which persisted a file (sinks behind the others persist more rows)
+        return next((result for result in results if result[0] is not None), results[0])
+
+    def persist_partitions(self, series):
+        # Backfill: one HDF file per day or month (named after its latest read) written by a bounded thread
+        # pool, at most 2 partitions per worker are rendered at any time so memory stays flat. Partitions
+        # written by an interrupted run (writes are atomic) are skipped. Returns the partition files.
+        # Every file newer than the watermark holds rows of this backfill: one whose partition has grown
+        # since the interrupted run (e.g. HDF-...T1200.csv of a day now ending HDF-...T2330.csv) is stale and
+        # deleted once its partition is written.
+        if not self.archive.exists():
+            raise RuntimeError(f"persist_partitions Invalid or inexistent storage path: {self.storage_path}")
+        last_updated_datetime = None if self.last_updated_datetime is None else self.last_updated_datetime.isoformat()
+        self.archive.write(BACKFILL_MARKER_FILENAME, json.dumps({'last_updated_datetime': last_updated_datetime}))
+        existing_files = set(self.archive.list_files())
+        index = TimeRangeIndex(self.archive)
+        compress = self.storage_path.startswith("s3://")
+        content_encoding = self.archive.compression if compress else None
+        filenames = []
+
+        def persist_partition(filename, partition):
+            body = partition.to_csv()
+            if filename not in existing_files:
+                self.archive.write(filename, body, compress=compress)
+            entry = None
+            if filename not in index.files:
+                entry = index_entry(body.encode(), content_encoding)
+                if self.validation_enabled:
+                    entry['validation'] = validate(partition).to_dict()
+            return filename, len(body) if filename not in existing_files else 0, entry
+
+        def completed(future):
+            filename, bytes_written, entry = future.result()
+            self.metrics.count(bytes_written=bytes_written)
+            if entry is not None:
+                index.files[filename] = entry
+        with ThreadPoolExecutor(max_workers=self.backfill_workers) as executor:
+            in_flight = collections.deque()
+            for _, partition in series.split_by(BACKFILL_PARTITIONS[self.backfill]):
+                filename = partition.max_timestamp().strftime(HDF_FILENAME_FORMAT)
+                filenames.append(filename)
+                if filename in existing_files and filename in index.files:
+                    continue
+                if len(in_flight) >= 2 * self.backfill_workers:
+                    completed(in_flight.popleft())
+                in_flight.append(executor.submit(persist_partition, filename, partition))
+            while in_flight:
+                completed(in_flight.popleft())
+        logging.info(f"Backfilled {len(filenames)} files ({len(existing_files.intersection(filenames))} already "
+                     f"written) into {self.storage_path}")
+        watermark = self.last_updated_datetime
+        stale_files = [f for f in existing_files.difference(filenames) if not COMPACTED_FILENAME_PATTERN.match(f)
+                       and (watermark is None or hdf_filename_datetime(f) > watermark)]
+        for stale_file in sorted(stale_files):
+            logging.info(f"Deleting {stale_file} superseded by the backfilled partitions")
+            self.archive.delete(stale_file)
+            index.files.pop(stale_file, None)
+        index.save()
+        self.update_manifest(filenames[-1])
+        self.archive.delete(BACKFILL_MARKER_FILENAME)
+        return filenames
 
-def parse_cli_args():
+    @instrumented('persist_hdf_file_streaming')
+    def persist_hdf_file_streaming(self, file, chunk_size=64 * 1024):
+        # Streams the rows of an HDF file newer than last_updated_datetime into the storage path.
+        # HDF rows are grouped per MPRN and read type (each group newest first), so new rows can be
+        # anywhere in the file: a first pass finds the newest new read (the datetime used in the
+        # filename), a second pass streams the new rows. Both passes read the new rows only and skip the
+        # older rows of every group (see iter_rows_newer_than), whatever the history held by the file.
+        def new_rows():
+            with open(file, "rb", buffering=chunk_size) as f:
+                header = f.readline().decode().rstrip('\r\n')
+                if not header:
+                    raise ValueError(f"HDF file {file} is empty")
+                yield header
+                yield from iter_rows_newer_than(f, self.last_updated_datetime, chunk_size)
+        # new rows are also kept for the columnar sink, the analytics rollups and validation (memory
+        # proportional to the new data only), the second pass then reads them instead of the file
+        keep_rows = self.storage_format in ('columnar', 'both') or self.update_analytics or self.validation_enabled
+        new_rows_kept = [] if keep_rows else None
+        rows = new_rows()
+        header = next(rows)
+        row_count = 0
+        byte_count = len(header)
+        newest_key, newest_datetime = None, None
+        for row in rows:
+            row_count += 1
+            byte_count += len(row) + 1
+            read_datetime = row[row.rindex(',') + 1:]
+            if newest_key is None or hdf_datetime_key(read_datetime) > newest_key:
+                newest_key, newest_datetime = hdf_datetime_key(read_datetime), read_datetime
+            if new_rows_kept is not None:
+                new_rows_kept.append(row)
+        if row_count == 0:
+            logging.info("No new data available for collection")
+            return None, 0
+        self.last_collected_datetime = datetime.strptime(newest_datetime, HDF_DATETIME_FORMAT)
+        filename = self.generate_filename()
+        new_series, report = None, None
+        if new_rows_kept is not None:
+            new_series = UsageSeries.from_csv('\n'.join([header] + new_rows_kept))
+        if self.validation_enabled:
+            # before anything is written, so that a failing validation persists nothing
+            report = self.validate_series(new_series, filename)
+        lines_to_be_persisted = itertools.chain([header], new_rows_kept) if new_rows_kept is not None else new_rows()
+        logging.info(f"Streaming {filename} into {self.storage_path}")
+        if self.storage_format != 'columnar':
+            if self.storage_path.startswith("s3://"):
+                self.persist_lines_in_s3(filename, lines_to_be_persisted, report)
+            elif os.path.exists(self.storage_path):
+                self.persist_lines_in_filesystem(filename, lines_to_be_persisted, report)
+            else:
+                raise RuntimeError("persist_hdf_file_streaming Invalid or inexistent "
+                                   + f"storage path: {self.storage_path}")
+        self.metrics.count(rows=row_count, bytes_written=byte_count if self.storage_format != 'columnar' else 0)
+        if new_series is not None:
+            if self.storage_format in ('columnar', 'both'):
+                self.persist_columnar(filename, new_series)
+            if self.update_analytics:
+                UsageAnalytics(self.archive).update_from_series(new_series, filename)
+        if self.storage_format == 'columnar':
+            self.update_manifest(filename)
+        logging.info(f"Persisted {filename} with {row_count} new HDF rows")
+        return filename, row_count
+
+
+def parse_cli_args(argv=None):
+    # Every option defaults to its environment variable, parse_cli_args([]) reads the environment only (Lambda)
     # Create the parser
     parser = argparse.ArgumentParser(description="Collects electricity usage",
                                      epilog="Usage: electricity_usage_extraction.py -u bob@gmail.com -p mypassword")
@@ -267,15 +533,103 @@ def parse_cli_args():
                         help='Username')
     parser.add_argument('-p', '--password', default=os.environ.get('PASSWORD', None),
                         help='Password')
-    parser.add_argument('-s', '--storage-path', default=os.environ.get('STORAGE_PATH', None),
+    parser.add_argument('-s', '--storage-path', action='append', default=None,
                         help='Path where collected data will be stored. examples: ' +
-                        'local/path, ./relative/path, s3://bucket/prefix')
+                        'local/path, ./relative/path, s3://bucket/prefix. Repeat it to persist into several ' +
+                        'storage paths concurrently (STORAGE_PATH: comma separated)')
     parser.add_argument('-d', '--dry-run', default=os.environ.get('DRY_RUN', False) == 'true',
                         action='store_true',
                         help='Collect data but do not store it. Used for testing')
+    parser.add_argument('--download-timeout', type=float,
+                        default=float(os.environ.get('DOWNLOAD_TIMEOUT', DOWNLOAD_TIMEOUT)),
+                        help='Seconds to wait for the HDF download to complete')
+    parser.add_argument('--backend', choices=['selenium', 'http'], default=os.environ.get('BACKEND', 'selenium'),
+                        help='Collect the HDF file with a headless browser (selenium) or with plain HTTP requests')
+    parser.add_argument('--login-url', default=os.environ.get('LOGIN_URL', None),
+                        help='Sign in page used by the http backend')
+    parser.add_argument('--download-url', default=os.environ.get('DOWNLOAD_URL', None),
+                        help='HDF download URL used by the http backend')
+    parser.add_argument('--session-cache', default=os.environ.get('SESSION_CACHE_PATH', None),
+                        help='File where the http backend keeps the session cookies, encrypted with ' +
+                        'the SESSION_CACHE_KEY environment variable')
+    parser.add_argument('--accounts-file', default=os.environ.get('ACCOUNTS_FILE', None),
+                        help='JSON list of accounts ({"username", "password", "storage_path"} plus optional ' +
+                        'backend settings) collected concurrently instead of a single username/password')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 4)),
+                        help='Number of accounts collected concurrently (with --accounts-file)')
+    parser.add_argument('--pool', choices=['thread', 'process'], default=os.environ.get('POOL', 'thread'),
+                        help='Run concurrent account collections in threads or processes (with --accounts-file)')
+    parser.add_argument('--retries', type=int, default=int(os.environ.get('RETRIES', 3)),
+                        help='Attempts per account on transient failures (with --accounts-file)')
+    parser.add_argument('--storage-format', choices=STORAGE_FORMATS, default=os.environ.get('STORAGE_FORMAT', 'csv'),
+                        help='csv: raw HDF-*.csv files, columnar: parquet (npz without pyarrow) partitioned by ' +
+                        'mprn/year/month under columnar/, both: csv for audit plus columnar')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default=os.environ.get('COMPRESSION', 'none'),
+                        help='Compression of the HDF files uploaded to S3 (zstd requires the zstandard package)')
+    parser.add_argument('--s3-max-connections', type=int,
+                        default=int(os.environ.get('S3_MAX_CONNECTIONS', S3_MAX_CONNECTIONS)),
+                        help='Size of the S3 client connection pool')
+    parser.add_argument('--cache-dir', default=os.environ.get('CACHE_DIR', None),
+                        help='Local read-through cache of the objects read from S3 (see archive_cache.py)')
+    parser.add_argument('--multipart-threshold-mb', type=int,
+                        default=int(os.environ.get('MULTIPART_THRESHOLD_MB', MULTIPART_THRESHOLD // 1024 // 1024)),
+                        help='S3 uploads larger than this are sent as multipart uploads')
+    parser.add_argument('--streaming', default=os.environ.get('STREAMING', False) == 'true',
+                        action='store_true',
+                        help='Stream only the HDF rows newer than the last persisted ones straight into ' +
+                        'the storage path instead of loading the whole HDF file in memory')
+    parser.add_argument('--analytics', default=os.environ.get('ANALYTICS', False) == 'true', action='store_true',
+                        help='Update the analytics rollups (see usage_analytics.py) with every persisted file')
+    parser.add_argument('--backfill', choices=list(BACKFILL_PARTITIONS), default=os.environ.get('BACKFILL', None),
+                        help='Catch-up mode: write the new data as one file per day or month, concurrently and ' +
+                        'resumably, instead of a single file (takes precedence over --streaming)')
+    parser.add_argument('--backfill-workers', type=int,
+                        default=int(os.environ.get('BACKFILL_WORKERS', BACKFILL_WORKERS)),
+                        help='Concurrent partition writes in catch-up mode')
+    parser.add_argument('--validation', type=parse_policies, default=os.environ.get('VALIDATION', ''),
+                        help='Validation policies of the collected rows, e.g. gaps=fail,duplicates=ignore ' +
+                        f'(checks: {", ".join(CHECKS)}; policies: fail, warn, ignore) or off')
     # Parse the arguments
-    args = parser.parse_args()
-    return args.username, args.password, args.storage_path, args.dry_run
+    args = parser.parse_args(argv)
+    if args.storage_path is None:
+        args.storage_path = storage_paths(os.environ.get('STORAGE_PATH', None))
+    return args
+
+
+def storage_paths(value):
+    # "local/path,s3://bucket/prefix" -> ['local/path', 's3://bucket/prefix'], a single path is returned as is
+    if value is None or ',' not in value:
+        return value
+    return value.split(',')
+
+
+def collector_options(args) -> dict:
+    # ElectricityUsageCollector keyword arguments shared by a single account, an accounts file and lambda_handler
+    return {'dry_run': args.dry_run, 'download_timeout': args.download_timeout, 'storage_format': args.storage_format,
+            'compression': args.compression, 's3_max_connections': args.s3_max_connections,
+            'multipart_threshold': args.multipart_threshold_mb * 1024 * 1024, 'update_analytics': args.analytics,
+            'backfill': args.backfill, 'backfill_workers': args.backfill_workers,
+            'validation_policies': args.validation, 'cache_dir': args.cache_dir}
+
+
+def create_collector(args, runtime_mode, **kwargs):
+    # collector of the single account (username/password) of the parsed arguments
+    backend = create_backend(args.backend, args.username, args.password, login_url=args.login_url,
+                             download_url=args.download_url, session_cache_path=args.session_cache,
+                             download_timeout=args.download_timeout)
+    return ElectricityUsageCollector(username=args.username, password=args.password, storage_path=args.storage_path,
+                                     runtime_mode=runtime_mode, backend=backend, **collector_options(args), **kwargs)
+
+
+def create_backend(backend, username, password, login_url=None, download_url=None, session_cache_path=None,
+                   download_timeout=DOWNLOAD_TIMEOUT):
+    # None selects the default (selenium) backend of ElectricityUsageCollector
+    if backend == 'http':
+        return HttpBackend(username, password, login_url=login_url, download_url=download_url,
+                           session_cache=create_session_cache(session_cache_path,
+                                                              os.environ.get('SESSION_CACHE_KEY', None)),
+                           timeout=download_timeout)
+    return None
 
 
 # Runtime modes:
@@ -300,19 +654,133 @@ def detect_runtime_mode():
     return runtime_mode
 
 
-runtime_mode = detect_runtime_mode()
-logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
-
-if runtime_mode != RuntimeMode.TEST:
-    username, password, storage_path, dry_run = parse_cli_args()
-    collector = ElectricityUsageCollector(username=username,
-                                          password=password,
-                                          storage_path=storage_path,
-                                          dry_run=dry_run,
-                                          runtime_mode=runtime_mode)
+def run_collection(collector, dry_run, streaming):
     collector.retireve_last_updated_datetime()
-    collector.collect()
     if dry_run:
+        collector.collect()
         logging.info("Dry run. Not persisting collected data")
+        return None
+    elif streaming and collector.backfill is None:
+        filename, _ = collector.collect_streaming()
     else:
-        collector.persist_collected_data()
+        collector.collect()
+        filename, _ = collector.persist_collected_data()
+    if hasattr(collector.archive, 'log_stats'):
+        collector.archive.log_stats()
+    return filename
+
+
+# Errors worth retrying, matched by class name so that selenium/urllib3/botocore need not be imported
+TRANSIENT_ERROR_NAMES = {'OSError', 'TimeoutError', 'ConnectionError', 'WebDriverException', 'TimeoutException',
+                         'HTTPError', 'EndpointConnectionError', 'ConnectionClosedError', 'ReadTimeoutError'}
+
+
+def is_transient_error(error) -> bool:
+    return any(c.__name__ in TRANSIENT_ERROR_NAMES for c in type(error).__mro__)
+
+
+def retry(function, attempts=3, backoff=2.0):
+    # calls function until it succeeds, retrying transient errors with exponential backoff (and jitter)
+    # returns (result, number of attempts)
+    for attempt in range(1, attempts + 1):
+        try:
+            return function(), attempt
+        except Exception as error:
+            if attempt == attempts or not is_transient_error(error):
+                raise
+            delay = backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            logging.warning(f"Attempt {attempt} failed with {type(error).__name__}: {error}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def account_id(username):
+    # stable identifier of an account which does not disclose the username (download directory, metrics)
+    return hashlib.sha256(username.encode()).hexdigest()[:16]
+
+
+def account_download_path(download_root, username):
+    # each account downloads into its own directory so concurrent collections never see each other's HDF
+    path = os.path.join(download_root, account_id(username))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def collect_account(account, download_root, runtime_mode, streaming=False, retries=3, backoff=2.0,
+                    backend_factory=None, **options):
+    # collects one account of an accounts file and returns its outcome (never raises)
+    # options are the ElectricityUsageCollector keyword arguments (see collector_options)
+    backend_factory = create_backend if backend_factory is None else backend_factory
+    options = {'dry_run': False, **options}
+    dry_run = options['dry_run']
+    username = account.get('username')
+    outcome = {'username': username, 'storage_path': account.get('storage_path'), 'status': None,
+               'persisted_file': None, 'attempts': 0, 'error': None}
+    start = time.monotonic()
+
+    def attempt():
+        outcome['attempts'] += 1
+        backend = backend_factory(account.get('backend', 'selenium'), username, account.get('password'),
+                                  login_url=account.get('login_url'), download_url=account.get('download_url'),
+                                  session_cache_path=account.get('session_cache'),
+                                  download_timeout=options.get('download_timeout', DOWNLOAD_TIMEOUT))
+        collector = ElectricityUsageCollector(username=username,
+                                              password=account.get('password'),
+                                              storage_path=account.get('storage_path'),
+                                              runtime_mode=runtime_mode,
+                                              backend=backend,
+                                              download_file_path=account_download_path(download_root, username),
+                                              metrics=RunMetrics.from_environment(
+                                                  dimensions={'account': account_id(username)}),
+                                              **options)
+        return run_collection(collector, dry_run, streaming)
+    try:
+        filename, _ = retry(attempt, attempts=retries, backoff=backoff)
+        outcome['persisted_file'] = filename
+        if dry_run:
+            outcome['status'] = 'dry run'
+        else:
+            outcome['status'] = 'persisted' if filename is not None else 'no new data'
+    except Exception as error:
+        logging.exception(f"Collection failed for {username}")
+        outcome['status'] = 'failed'
+        outcome['error'] = f"{type(error).__name__}: {error}"
+    outcome['duration_seconds'] = round(time.monotonic() - start, 3)
+    return outcome
+
+
+def collect_accounts(accounts, download_root, runtime_mode, workers=4, pool='thread', **options):
+    # collects the accounts concurrently and returns one outcome per account (in accounts order)
+    executor_class = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        futures = [executor.submit(collect_account, account, download_root, runtime_mode, **options)
+                   for account in accounts]
+        return [future.result() for future in futures]
+
+
+def lambda_handler(event, context):
+    # AWS Lambda entry point, configured with the same environment variables as the CLI.
+    # KEEP_DRIVER_WARM=true keeps Chrome alive between invocations of the same container.
+    # The HDF file is downloaded to DOWNLOAD_PATH, by default a new directory under /tmp (/var/task is read-only).
+    args = parse_cli_args([])
+    collector = create_collector(args, RuntimeMode.DOCKER,
+                                 keep_driver_warm=os.environ.get('KEEP_DRIVER_WARM', False) == 'true',
+                                 download_file_path=os.environ.get('DOWNLOAD_PATH') or mkdtemp())
+    filename = run_collection(collector, args.dry_run, args.streaming)
+    return {'persisted_file': filename}
+
+
+runtime_mode = detect_runtime_mode()
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+if runtime_mode != RuntimeMode.TEST:
+    args = parse_cli_args()
+    if args.accounts_file is not None:
+        with open(args.accounts_file) as f:
+            accounts = json.load(f)
+        report = collect_accounts(accounts, download_root=mkdtemp(), runtime_mode=runtime_mode,
+                                  workers=args.workers, pool=args.pool, streaming=args.streaming,
+                                  retries=args.retries, **collector_options(args))
+        print(json.dumps(report, indent=2))
+        sys.exit(1 if any(outcome['status'] == 'failed' for outcome in report) else 0)
+    collector = create_collector(args, runtime_mode)
+    run_collection(collector, args.dry_run, args.streaming)
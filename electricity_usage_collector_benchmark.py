@@ -0,0 +1,241 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from tempfile import mkdtemp
+import numpy as np
+from archive_storage import HDF_FILENAME_FORMAT
+from electricity_usage_collector import ElectricityUsageCollector, RuntimeMode
+from instrumentation import RunMetrics
+from usage_series import HDF_HEADER, format_hdf_datetimes
+
+# Benchmarks of the ingest/filter/persist path over realistic archive sizes:
+# 1, 5 and 15 years of 30-minute rows for several MPRNs, and archives of thousands of HDF files.
+# $ python electricity_usage_collector_benchmark.py --output results.json
+# $ python electricity_usage_collector_benchmark.py --baseline results.json --threshold 1.5
+# Every case reports the best wall time of --repeats runs and the peak traced memory of one more run
+# (tracemalloc slows code down, so it is never enabled while timing). The exit code is 1 when a case is
+# more than --threshold times slower (or bigger) than in the baseline.
+# The default baseline (BASELINE_PATH) is a reference run committed with the code, its platform, machine and
+# cpus tell where it was produced: timings are only comparable on similar machines.
+BENCHMARK_YEARS = [1, 5, 15]
+BENCHMARK_MPRNS = 5
+BENCHMARK_ARCHIVE_FILES = 2000
+INTERVAL = np.timedelta64(30, 'm')
+END_DATETIME = datetime(2024, 1, 1, 23, 30)
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'electricity_usage_collector_benchmark_baseline.json')
+
+
+def mock_hdf_csv(years, mprns=BENCHMARK_MPRNS, end_datetime=END_DATETIME, seed=0):
+    # HDF csv (newest rows first) with years of 30-minute reads for each of mprns meters, built vectorized
+    end = np.datetime64(end_datetime, 'm')
+    intervals = int(years * 365 * 24 * 2)
+    timestamps = end - np.arange(intervals) * INTERVAL
+    formatted_timestamps = format_hdf_datetimes(timestamps)
+    values = np.random.default_rng(seed).gamma(2.0, 0.2, size=(mprns, intervals))
+    rows = []
+    for meter in range(mprns):
+        prefix = f"1030591{4213 + meter:04d},{31774820 + meter},"
+        suffix = np.char.add(',Active Import Interval (kW),', formatted_timestamps)
+        rows.extend(np.char.add(np.char.add(prefix, np.char.mod('%.6f', values[meter])), suffix).tolist())
+    return '\n'.join([HDF_HEADER] + rows)
+
+
+def create_collector(storage_path):
+    return ElectricityUsageCollector(username="benchmark", password="benchmark", storage_path=storage_path,
+                                     dry_run=False, runtime_mode=RuntimeMode.TEST, metrics=RunMetrics(output='off'))
+
+
+def measure(function, setup=None, repeats=3):
+    # (best seconds of repeats runs, peak traced bytes of one extra run); setup() is not measured
+    # and its result is passed to function
+    best = None
+    for _ in range(repeats):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        function(state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    state = setup() if setup is not None else None
+    tracemalloc.start()
+    try:
+        function(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': round(best, 6), 'peak_memory_bytes': peak}
+
+
+def benchmark_filter(csv_data, repeats):
+    # the typical daily run: everything but the last two days was already persisted
+    def run(_):
+        collector = create_collector(None)
+        collector.simulate_last_updated_datetime(END_DATETIME - timedelta(days=2))
+        collector.simulate_collection(csv_data)
+        collector.filter_data_already_persisted()
+    return measure(run, repeats=repeats)
+
+
+def benchmark_persist(csv_data, storage_root, repeats):
+    # first collection of an account: the whole history is persisted
+    def setup():
+        storage_path = new_storage_path(storage_root)
+        collector = create_collector(storage_path)
+        collector.retireve_last_updated_datetime()
+        collector.simulate_collection(csv_data)
+        return collector
+
+    def run(collector):
+        collector.persist_collected_data()
+    return measure(run, setup=setup, repeats=repeats)
+
+
+def benchmark_retrieve(storage_root, archive_files, repeats, use_manifest):
+    storage_path = new_storage_path(storage_root)
+    collector = create_collector(storage_path)
+    latest = END_DATETIME
+    for day in reversed(range(archive_files)):
+        latest = END_DATETIME - timedelta(days=day)
+        collector.archive.write(latest.strftime(HDF_FILENAME_FORMAT), HDF_HEADER)
+    if use_manifest:
+        collector.update_manifest(latest.strftime(HDF_FILENAME_FORMAT))
+
+    def run(_):
+        assert create_collector(storage_path).retireve_last_updated_datetime() == latest
+    return measure(run, repeats=repeats)
+
+
+_storage_paths = 0
+
+
+def new_storage_path(storage_root):
+    global _storage_paths
+    _storage_paths += 1
+    if storage_root.startswith("s3://"):
+        return f"{storage_root}/run{_storage_paths}"
+    path = os.path.join(storage_root, f"run{_storage_paths}")
+    os.makedirs(path)
+    return path
+
+
+def s3_stand_in():
+    # local S3 stand-in (moto), None when moto is not installed
+    try:
+        from moto import mock_aws
+    except ImportError:
+        logging.warning("moto not installed, skipping S3 benchmarks")
+        return None
+    for name, value in [('AWS_DEFAULT_REGION', 'us-east-1'), ('AWS_ACCESS_KEY_ID', 'benchmark'),
+                        ('AWS_SECRET_ACCESS_KEY', 'benchmark')]:
+        os.environ.setdefault(name, value)
+    return mock_aws()
+
+
+def run_benchmarks(years=BENCHMARK_YEARS, mprns=BENCHMARK_MPRNS, archive_files=BENCHMARK_ARCHIVE_FILES,
+                   repeats=3, s3=True):
+    results = {}
+    filesystem_root = mkdtemp()
+    s3_mock = s3_stand_in() if s3 else None
+    try:
+        if s3_mock is not None:
+            s3_mock.start()
+            import boto3
+            boto3.client('s3').create_bucket(Bucket='benchmark')
+        for year_count in years:
+            csv_data = mock_hdf_csv(year_count, mprns)
+            rows = csv_data.count('\n')
+            logging.info(f"Benchmarking {year_count} years x {mprns} MPRNs ({rows} rows, {len(csv_data)} bytes)")
+            results[f"filter_data_already_persisted/{year_count}y"] = {
+                **benchmark_filter(csv_data, repeats), 'rows': rows}
+            results[f"persist_collected_data/filesystem/{year_count}y"] = {
+                **benchmark_persist(csv_data, filesystem_root, repeats), 'rows': rows}
+            if s3_mock is not None:
+                results[f"persist_collected_data/s3/{year_count}y"] = {
+                    **benchmark_persist(csv_data, 's3://benchmark/archive', repeats), 'rows': rows}
+        for storage, storage_root in [('filesystem', filesystem_root), ('s3', 's3://benchmark/archive')]:
+            if storage == 's3' and s3_mock is None:
+                continue
+            logging.info(f"Benchmarking retrieval over {archive_files} files in {storage}")
+            for use_manifest in [False, True]:
+                name = f"retireve_last_updated_datetime/{storage}/{'manifest' if use_manifest else 'listing'}"
+                results[f"{name}/{archive_files}_files"] = {
+                    **benchmark_retrieve(storage_root, archive_files, repeats, use_manifest), 'files': archive_files}
+    finally:
+        if s3_mock is not None:
+            s3_mock.stop()
+        shutil.rmtree(filesystem_root, ignore_errors=True)
+    return {'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'parameters': {'years': years, 'mprns': mprns, 'archive_files': archive_files, 'repeats': repeats},
+            'results': results}
+
+
+def compare_with_baseline(report, baseline, threshold=1.5, min_seconds=0.01):
+    # regressions (case, metric, baseline value, current value) of the cases present in both reports.
+    # Timings below min_seconds are too noisy to compare.
+    regressions = []
+    for case, result in report['results'].items():
+        baseline_result = baseline['results'].get(case)
+        if baseline_result is None:
+            continue
+        for metric in ['seconds', 'peak_memory_bytes']:
+            if metric == 'seconds' and baseline_result[metric] < min_seconds and result[metric] < min_seconds:
+                continue
+            if result[metric] > baseline_result[metric] * threshold:
+                regressions.append((case, metric, baseline_result[metric], result[metric]))
+    return regressions
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the electricity usage collector")
+    parser.add_argument('--years', type=float, nargs='+', default=BENCHMARK_YEARS,
+                        help='Years of 30-minute rows of each benchmarked HDF file')
+    parser.add_argument('--mprns', type=int, default=BENCHMARK_MPRNS, help='Meters (MPRNs) in each HDF file')
+    parser.add_argument('--archive-files', type=int, default=BENCHMARK_ARCHIVE_FILES,
+                        help='HDF files in the archive when benchmarking the last updated datetime retrieval')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs of every case (best is reported)')
+    parser.add_argument('--no-s3', action='store_true', help='Skip the S3 (moto) benchmarks')
+    parser.add_argument('-o', '--output', default=None, help='Write the results (JSON) to this file')
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='Results (JSON) of a previous run to compare with (default: the committed reference run)')
+    parser.add_argument('--no-baseline', action='store_true', help='Do not compare with a baseline')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='Fail when a case takes more than threshold times its baseline time or memory')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+    os.environ.setdefault('COLLECTOR_METRICS', 'off')
+    args = parse_cli_args()
+    years = [int(y) if float(y).is_integer() else y for y in args.years]
+    report = run_benchmarks(years=years, mprns=args.mprns, archive_files=args.archive_files,
+                            repeats=args.repeats, s3=not args.no_s3)
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    if not args.no_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        logging.info(f"Comparing with {args.baseline} ({baseline['platform']}, {baseline.get('cpus')} cpus, "
+                     f"created {baseline['created']})")
+        regressions = []
+        if baseline['parameters']['mprns'] != args.mprns:
+            logging.warning(f"Not compared: the baseline has {baseline['parameters']['mprns']} MPRNs per HDF file")
+        else:
+            regressions = compare_with_baseline(report, baseline, args.threshold)
+        for case, metric, baseline_value, value in regressions:
+            logging.error(f"Regression in {case}: {metric} {baseline_value} -> {value}")
+        sys.exit(1 if regressions else 0)
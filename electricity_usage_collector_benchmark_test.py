@@ -0,0 +1,48 @@
+from electricity_usage_collector_benchmark import mock_hdf_csv, run_benchmarks, compare_with_baseline, \
+    BASELINE_PATH, BENCHMARK_YEARS, BENCHMARK_MPRNS, BENCHMARK_ARCHIVE_FILES
+from usage_series import UsageSeries
+import json
+import numpy as np
+import pytest
+
+
+def test_mock_hdf_csv():
+    series = UsageSeries.from_csv(mock_hdf_csv(0.1, mprns=3))
+    assert len(series) == 3 * int(0.1 * 365 * 48)
+    assert len(series.mprn_categories) == 3
+    assert (np.diff(series.timestamps[:10]) == np.timedelta64(-30, 'm')).all()  # newest first
+
+
+def test_run_benchmarks_small():
+    pytest.importorskip("moto")
+    report = run_benchmarks(years=[0.02], mprns=2, archive_files=20, repeats=1)
+    assert set(report['results']) == {
+        'filter_data_already_persisted/0.02y',
+        'persist_collected_data/filesystem/0.02y',
+        'persist_collected_data/s3/0.02y',
+        'retireve_last_updated_datetime/filesystem/listing/20_files',
+        'retireve_last_updated_datetime/filesystem/manifest/20_files',
+        'retireve_last_updated_datetime/s3/listing/20_files',
+        'retireve_last_updated_datetime/s3/manifest/20_files'}
+    assert all(r['seconds'] > 0 and r['peak_memory_bytes'] > 0 for r in report['results'].values())
+
+
+def test_compare_with_baseline():
+    baseline = {'results': {'a': {'seconds': 1.0, 'peak_memory_bytes': 1000},
+                            'b': {'seconds': 0.001, 'peak_memory_bytes': 1000}}}
+    report = {'results': {'a': {'seconds': 2.0, 'peak_memory_bytes': 1100},
+                          'b': {'seconds': 0.005, 'peak_memory_bytes': 1000},
+                          'c': {'seconds': 9.0, 'peak_memory_bytes': 9000}}}
+    assert compare_with_baseline(report, baseline, threshold=1.5) == [('a', 'seconds', 1.0, 2.0)]
+
+
+def test_committed_baseline_covers_the_default_cases():
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    assert baseline['parameters']['mprns'] == BENCHMARK_MPRNS
+    assert {'platform', 'machine', 'cpus', 'python', 'created'} <= set(baseline)
+    assert set(baseline['results']) == {
+        f"{case}/{years}y" for years in BENCHMARK_YEARS for case in [
+            'filter_data_already_persisted', 'persist_collected_data/filesystem', 'persist_collected_data/s3']} | {
+        f"retireve_last_updated_datetime/{storage}/{mode}/{BENCHMARK_ARCHIVE_FILES}_files"
+        for storage in ['filesystem', 's3'] for mode in ['listing', 'manifest']}
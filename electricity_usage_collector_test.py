@@ -1,8 +1,17 @@
 from datetime import datetime
 from datetime import timedelta
-from electricity_usage_collector import ElectricityUsageCollector, RuntimeMode
+from electricity_usage_collector import ElectricityUsageCollector, RuntimeMode, collect_accounts
+from conftest import create_collector
+import electricity_usage_collector
+from series_validation import parse_policies
+from collection_backends import CollectionBackend
+from archive_storage import FilesystemArchive
+from time_range_index import TimeRangeIndex
+from usage_series import UsageSeries, HDF_HEADER
 import os
 import shutil
+import subprocess
+import sys
 import pytest
 
 
@@ -101,3 +110,243 @@ def test_list_s3_objects():
         len(objects) > 0
     else:
         pytest.fail("AWS Credentials not defined as environment variables")
+
+
+def test_streaming_collection_stops_at_last_persisted_row(tmp_path):
+    storage_path = tmp_path / 'storage'
+    storage_path.mkdir()
+    hdf_file = tmp_path / 'HDF.csv'
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=4, hour=23, minute=30))
+    hdf_file.write_text('\n'.join(collection) + '\n')
+    collector = ElectricityUsageCollector(username="username", password="password", storage_path=str(storage_path),
+                                          dry_run=False, runtime_mode=RuntimeMode.TEST)
+    collector.simulate_last_updated_datetime(datetime(year=2023, month=1, day=2, hour=23, minute=30))
+    filename, row_count = collector.persist_hdf_file_streaming(str(hdf_file), chunk_size=100)
+    expected_persisted_data = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=3, hour=0, minute=0),
+        datetime(year=2023, month=1, day=4, hour=23, minute=30))
+    assert filename == "HDF-2023-01-04T2330.csv"
+    assert row_count == 96
+    assert (storage_path / filename).read_text().splitlines() == expected_persisted_data
+    # nothing newer than the last persisted row
+    collector.simulate_last_updated_datetime(datetime(year=2023, month=1, day=4, hour=23, minute=30))
+    assert collector.persist_hdf_file_streaming(str(hdf_file)) == (None, 0)
+
+
+def test_streaming_collection_over_the_repeated_october_hour(tmp_path):
+    rows = [f"10305914213,31774820,0.100000,Active Import Interval (kW),29-10-2023 {end}"
+            for end in ['03:00', '02:30', '02:00', '01:30', '02:00', '01:30', '01:00']]
+    hdf_file = tmp_path / 'HDF.csv'
+    hdf_file.write_text('\n'.join([HDF_HEADER] + rows))
+    collector = create_collector(str(tmp_path))
+    collector.simulate_last_updated_datetime(datetime(2024, 1, 1, 0, 0))
+    assert collector.persist_hdf_file_streaming(str(hdf_file)) == (None, 0)
+    collector.simulate_collection(hdf_file.read_text())
+    assert collector.persist_collected_data() == (None, None)
+    collector.simulate_last_updated_datetime(datetime(2023, 10, 29, 0, 30))
+    assert collector.persist_hdf_file_streaming(str(hdf_file)) == ("HDF-2023-10-29T0300.csv", 7)
+
+
+@pytest.mark.parametrize('validation', ['', 'off'])
+def test_streaming_collection_of_several_mprns(tmp_path, validation):
+    from electricity_usage_collector_benchmark import mock_hdf_csv
+    # rows are grouped per MPRN: the new rows of the second MPRN follow the old rows of the first one
+    hdf_data = mock_hdf_csv(0.01, mprns=2)
+    hdf_file = tmp_path / 'HDF.csv'
+    hdf_file.write_text(hdf_data)
+    persisted = {}
+    for mode in ['streaming', 'in-memory']:
+        (tmp_path / mode).mkdir()
+        collector = create_collector(str(tmp_path / mode), validation_policies=parse_policies(validation))
+        collector.simulate_last_updated_datetime(datetime(year=2024, month=1, day=1, hour=0, minute=0))
+        if mode == 'streaming':
+            filename, row_count = collector.persist_hdf_file_streaming(str(hdf_file), chunk_size=100)
+            assert row_count == 94
+        else:
+            collector.simulate_collection(hdf_data)
+            filename, _ = collector.persist_collected_data()
+        assert filename == "HDF-2024-01-01T2330.csv"
+        persisted[mode] = (tmp_path / mode / filename).read_text().splitlines()
+    assert persisted['streaming'] == persisted['in-memory']
+    assert {row.split(',')[0] for row in persisted['streaming'][1:]} == {'10305914213', '10305914214'}
+
+
+def test_retrieve_last_updated_datetime_from_manifest(tmp_path):
+    collector = ElectricityUsageCollector(username="username", password="password", storage_path=str(tmp_path),
+                                          dry_run=False, runtime_mode=RuntimeMode.TEST)
+    assert collector.retireve_last_updated_datetime() is None
+    # without manifest the latest file name is used regardless of the directory listing order
+    for filename in ["HDF-2023-01-04T2330.csv", "HDF-2023-01-02T2330.csv", "other.txt"]:
+        (tmp_path / filename).write_text("")
+    assert collector.retireve_last_updated_datetime() == datetime(year=2023, month=1, day=4, hour=23, minute=30)
+    collector.persist_in_filesystem("HDF-2023-01-05T2330.csv", "")
+    collector.persist_in_filesystem("HDF-2023-01-03T2330.csv", "")  # manifest never moves backwards
+    assert collector.read_manifest() == {'latest_file': "HDF-2023-01-05T2330.csv",
+                                         'last_updated_datetime': "2023-01-05T23:30:00"}
+    (tmp_path / "HDF-2023-01-05T2330.csv").unlink()
+    assert collector.retireve_last_updated_datetime() == datetime(year=2023, month=1, day=5, hour=23, minute=30)
+
+
+def test_list_s3_objects_paginates_across_months(monkeypatch):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    import boto3
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='bucket')
+        filenames = [(datetime(year=2021, month=1, day=1, hour=23, minute=30) + timedelta(days=d)).strftime(
+            "HDF-%Y-%m-%dT%H%M.csv") for d in range(1100)]
+        for filename in filenames:
+            s3.put_object(Bucket='bucket', Key=f'usage/{filename}', Body=b'')
+        collector = ElectricityUsageCollector(username="username", password="password",
+                                              storage_path="s3://bucket/usage", dry_run=False,
+                                              runtime_mode=RuntimeMode.TEST)
+        assert collector.list_s3_objects() == filenames
+        assert collector.retireve_last_updated_datetime() == datetime(year=2024, month=1, day=5, hour=23, minute=30)
+        collector.persist_in_s3("HDF-2024-01-06T2330.csv", "")
+        assert collector.read_manifest()['latest_file'] == "HDF-2024-01-06T2330.csv"
+        assert collector.retireve_last_updated_datetime() == datetime(year=2024, month=1, day=6, hour=23, minute=30)
+
+
+def test_import_does_not_load_selenium_nor_boto3():
+    code = "import sys, electricity_usage_collector; print('selenium' in sys.modules, 'boto3' in sys.modules)"
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    assert output.split() == ['False', 'False']
+
+
+class CopyBackend(CollectionBackend):
+    # "downloads" the HDF data given to the backend
+    def __init__(self, hdf_data):
+        self.hdf_data = hdf_data
+
+    def download_hdf(self, download_file_path):
+        assert os.listdir(download_file_path) == []  # downloads are never shared between accounts
+        file = os.path.join(download_file_path, 'HDF_10305914213.csv')
+        with open(file, 'w') as f:
+            f.write(self.hdf_data)
+        return file
+
+
+def test_collect_accounts_concurrently(tmp_path):
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=2, hour=23, minute=30))
+    failures = {'flaky': [TimeoutError("portal timed out")], 'broken': [ValueError("Found 2 HDF files")]}
+
+    def backend_factory(backend, username, password, **kwargs):
+        if failures.get(username):
+            raise failures[username].pop()
+        return CopyBackend('\n'.join(collection))
+    accounts = []
+    for username in ['alice', 'flaky', 'broken']:
+        (tmp_path / username).mkdir()
+        accounts.append({'username': username, 'password': 'password', 'storage_path': str(tmp_path / username)})
+    report = collect_accounts(accounts, download_root=str(tmp_path / 'downloads'), runtime_mode=RuntimeMode.TEST,
+                              workers=3, backoff=0.01, backend_factory=backend_factory)
+    assert [(o['username'], o['status'], o['attempts']) for o in report] == [
+        ('alice', 'persisted', 1), ('flaky', 'persisted', 2), ('broken', 'failed', 1)]
+    assert report[2]['error'] == "ValueError: Found 2 HDF files"
+    for username in ['alice', 'flaky']:
+        assert (tmp_path / username / "HDF-2023-01-02T2330.csv").read_text().splitlines() == collection
+    # second run finds no new data
+    report = collect_accounts(accounts[:1], download_root=str(tmp_path / 'downloads'),
+                              runtime_mode=RuntimeMode.TEST, backend_factory=backend_factory)
+    assert report[0]['status'] == 'no new data'
+
+
+def test_lambda_handler_configured_like_the_cli(tmp_path, monkeypatch):
+    environment = {'USERNAME': 'username', 'PASSWORD': 'password', 'STORAGE_PATH': 's3://bucket/a,s3://bucket/b',
+                   'DRY_RUN': 'true', 'STREAMING': 'true', 'MULTIPART_THRESHOLD_MB': '16', 'BACKFILL': 'month',
+                   'VALIDATION': 'off', 'KEEP_DRIVER_WARM': 'true'}
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+    runs = []
+    monkeypatch.setattr(electricity_usage_collector, 'run_collection',
+                        lambda collector, dry_run, streaming: runs.append((collector, dry_run, streaming)))
+    assert electricity_usage_collector.lambda_handler({}, None) == {'persisted_file': None}
+    collector, dry_run, streaming = runs[0]
+    assert (dry_run, streaming, collector.backfill, collector.validation_enabled) == (True, True, 'month', False)
+    assert [sink.archive.multipart_threshold for sink in collector.sinks] == [16 * 1024 * 1024] * 2
+    assert collector.backend.keep_driver_warm
+    # downloads go to a writable temporary directory, not the read-only /var/task of the function
+    assert collector.download_file_path != '/var/task' and os.access(collector.download_file_path, os.W_OK)
+    monkeypatch.setenv('DOWNLOAD_PATH', str(tmp_path))
+    electricity_usage_collector.lambda_handler({}, None)
+    assert runs[1][0].download_file_path == str(tmp_path)
+
+
+def backfill_collector(storage_path, rows=None, backfill='day'):
+    return create_collector(storage_path, rows, backfill=backfill, backfill_workers=3)
+
+
+def test_backfill_writes_day_partitions_and_resumes(tmp_path, monkeypatch):
+    storage_path = str(tmp_path)
+    collection = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 10, 23, 30))
+    # interrupted after 4 partitions
+    collector = backfill_collector(storage_path, collection)
+    original_write = FilesystemArchive.write
+    writes = []
+    fail_after = [4]
+
+    def failing_write(archive, relative_path, body, compress=False):
+        if relative_path.startswith('HDF-') and relative_path.endswith('.csv'):
+            writes.append(relative_path)
+            if fail_after[0] is not None and len(writes) > fail_after[0]:
+                raise OSError("disk full")
+        original_write(archive, relative_path, body, compress)
+    monkeypatch.setattr(FilesystemArchive, 'write', failing_write)
+    with pytest.raises(OSError):
+        collector.persist_collected_data()
+    assert 4 <= len(collector.list_filesystem_files()) < 10
+    # the restart resumes from the watermark before the backfill and skips the partitions written
+    collector = backfill_collector(storage_path, collection)
+    assert collector.last_updated_datetime is None
+    written_before = set(collector.list_filesystem_files())
+    writes.clear()
+    fail_after[0] = None
+    filename, _ = collector.persist_collected_data()
+    assert filename == "HDF-2023-01-10T2330.csv"
+    assert not written_before.intersection(writes)
+    files = collector.list_filesystem_files()
+    assert files == [f"HDF-2023-01-{day:02d}T2330.csv" for day in range(1, 11)]
+    assert (tmp_path / "HDF-2023-01-03T2330.csv").read_text().splitlines() == \
+        [collection[0]] + [r for r in collection[1:] if '-01-2023' in r and r.split(',')[-1].startswith('03-')]
+    assert sorted(TimeRangeIndex(collector.archive).files) == files
+    assert not (tmp_path / 'backfill.json').exists()
+    assert backfill_collector(storage_path).last_updated_datetime == datetime(2023, 1, 10, 23, 30)
+
+
+def test_backfill_month_partitions(tmp_path):
+    collection = mock_collection_data_as_list(datetime(2023, 1, 30, 0, 0), datetime(2023, 3, 1, 12, 0))
+    collector = backfill_collector(str(tmp_path), collection, backfill='month')
+    collector.persist_collected_data()
+    assert collector.list_filesystem_files() == ["HDF-2023-01-31T2330.csv", "HDF-2023-02-28T2330.csv",
+                                                 "HDF-2023-03-01T1200.csv"]
+
+
+def test_backfill_partitions_series_and_replaces_grown_partitions(tmp_path, monkeypatch):
+    storage_path = str(tmp_path)
+    # interrupted while the last day was still partial (its file is named after 12:00)
+    collector = backfill_collector(storage_path, mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0),
+                                                                              datetime(2023, 1, 5, 12, 0)))
+    original_delete = FilesystemArchive.delete
+    monkeypatch.setattr(FilesystemArchive, 'delete', lambda archive, relative_path: None)
+    collector.persist_collected_data()  # backfill.json is left behind as by an interrupted run
+    monkeypatch.setattr(FilesystemArchive, 'delete', original_delete)
+    assert collector.list_filesystem_files()[-1] == "HDF-2023-01-05T1200.csv"
+    # the resumed run (the day is now complete) partitions the series without rendering all of it
+    rendered = []
+    original_to_csv = UsageSeries.to_csv
+    monkeypatch.setattr(UsageSeries, 'to_csv', lambda series: rendered.append(len(series)) or original_to_csv(series))
+    collector = backfill_collector(storage_path, mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0),
+                                                                              datetime(2023, 1, 6, 23, 30)))
+    assert collector.last_updated_datetime is None
+    assert collector.persist_collected_data() == ("HDF-2023-01-06T2330.csv", None)
+    assert max(rendered) == 48
+    files = collector.list_filesystem_files()
+    assert files == [f"HDF-2023-01-{day:02d}T2330.csv" for day in range(1, 7)]
+    assert sorted(TimeRangeIndex(collector.archive).files) == files
+    assert sorted(os.listdir(tmp_path)) == files + ["index.json", "manifest.json"]
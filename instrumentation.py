@@ -0,0 +1,132 @@
+import functools
+import io
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# Per-stage metrics of a collection run: monotonic duration, row counts, bytes read/written and
+# peak RSS, emitted as one JSON line per stage on stderr (COLLECTOR_METRICS=jsonl, the default), as CloudWatch
+# embedded metric format on stdout (COLLECTOR_METRICS=emf, for Lambda) or not at all (COLLECTOR_METRICS=off).
+# stdout is left to the output of the commands (e.g. the --accounts-file JSON report). EMF is the default in Lambda.
+# COLLECTOR_PROFILE=cprofile|tracemalloc additionally profiles every stage (not meant for production).
+METRICS_OUTPUTS = ('jsonl', 'emf', 'off')
+PROFILERS = ('cprofile', 'tracemalloc')
+METRICS_NAMESPACE = 'ElectricityUsageCollector'
+EMF_METRICS = [('duration_ms', 'Duration', 'Milliseconds'), ('rows', 'Rows', 'Count'),
+               ('bytes_read', 'BytesRead', 'Bytes'), ('bytes_written', 'BytesWritten', 'Bytes'),
+               ('peak_rss_kb', 'PeakRSS', 'Kilobytes')]
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # bytes on macOS, kilobytes on Linux
+
+
+class RunMetrics():
+    def __init__(self, output='jsonl', profile=None, stream=None, dimensions=None):
+        if output not in METRICS_OUTPUTS:
+            raise ValueError(f"Unexpected metrics output {output}")
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError(f"Unexpected profiler {profile}")
+        self.output = output
+        self.profile = profile
+        self.stream = stream
+        self.dimensions = dimensions or {}
+        self.stages = []
+        self._active = []
+
+    @classmethod
+    def from_environment(cls, dimensions=None):
+        default_output = 'emf' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'jsonl'
+        return cls(output=os.environ.get('COLLECTOR_METRICS', default_output),
+                   profile=os.environ.get('COLLECTOR_PROFILE', None) or None,
+                   dimensions=dimensions)
+
+    def count(self, **counters):
+        # adds counters (rows, bytes_read, bytes_written) to the innermost running stage
+        if self._active:
+            record = self._active[-1]
+            for name, value in counters.items():
+                record[name] = record.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        record = {'stage': name, 'parent': self._active[-1]['stage'] if self._active else None,
+                  'rows': 0, 'bytes_read': 0, 'bytes_written': 0, 'status': 'ok'}
+        self._active.append(record)
+        profiler = self.start_profiler()
+        start = time.monotonic()
+        try:
+            yield record
+        except BaseException as error:
+            record['status'] = type(error).__name__
+            raise
+        finally:
+            record['duration_ms'] = round((time.monotonic() - start) * 1000, 3)
+            self.stop_profiler(profiler, record)
+            record['peak_rss_kb'] = peak_rss_kb()
+            self._active.pop()
+            self.stages.append(record)
+            self.emit(record)
+
+    def start_profiler(self):
+        if self.profile == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        elif self.profile == 'tracemalloc':
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        return None
+
+    def stop_profiler(self, profiler, record):
+        if self.profile == 'cprofile':
+            import pstats
+            profiler.disable()
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(15)
+            logging.info(f"Profile of stage {record['stage']}:\n{report.getvalue()}")
+        elif self.profile == 'tracemalloc':
+            import tracemalloc
+            record['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+
+    def emit(self, record):
+        if self.output == 'off':
+            return
+        if self.output == 'emf':
+            metrics = {'Stage': record['stage'], **self.dimensions}
+            metrics.update({metric: record[key] for key, metric, _ in EMF_METRICS if record.get(key) is not None})
+            metrics['_aws'] = {'Timestamp': int(time.time() * 1000), 'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Stage']],
+                'Metrics': [{'Name': metric, 'Unit': unit} for key, metric, unit in EMF_METRICS
+                            if record.get(key) is not None]}]}
+            line = json.dumps(metrics)
+        else:
+            line = json.dumps({**self.dimensions, **record})
+        stream = self.stream
+        if stream is None:
+            stream = sys.stdout if self.output == 'emf' else sys.stderr
+        stream.write(line + '\n')
+        stream.flush()
+
+
+def instrumented(stage):
+    # runs the decorated method as a stage of self.metrics
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,76 @@
+from datetime import datetime
+import io
+import json
+from conftest import create_collector
+from electricity_usage_collector_test import mock_collection_data_as_list
+from instrumentation import RunMetrics
+import pytest
+
+
+def test_stage_records_duration_counters_and_nesting():
+    stream = io.StringIO()
+    metrics = RunMetrics(stream=stream, dimensions={'account': 'a1'})
+    with metrics.stage('persist'):
+        with metrics.stage('filter'):
+            metrics.count(rows=10, bytes_read=100)
+        metrics.count(rows=4, bytes_written=40)
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line['stage'] for line in lines] == ['filter', 'persist']
+    assert lines[0]['parent'] == 'persist' and lines[0]['rows'] == 10 and lines[0]['bytes_read'] == 100
+    assert lines[1]['rows'] == 4 and lines[1]['bytes_written'] == 40 and lines[1]['account'] == 'a1'
+    assert all(line['duration_ms'] >= 0 and line['peak_rss_kb'] > 0 for line in lines)
+
+
+def test_metrics_leave_stdout_to_command_output(capsys, monkeypatch):
+    monkeypatch.delenv('COLLECTOR_METRICS', raising=False)
+    monkeypatch.delenv('AWS_LAMBDA_FUNCTION_NAME', raising=False)
+    with RunMetrics.from_environment().stage('collect'):
+        pass
+    captured = capsys.readouterr()
+    assert captured.out == '' and json.loads(captured.err)['stage'] == 'collect'
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'collector')
+    with RunMetrics.from_environment().stage('collect'):
+        pass
+    assert json.loads(capsys.readouterr().out)['Stage'] == 'collect'
+
+
+def test_stage_records_failures():
+    metrics = RunMetrics(output='off')
+    with pytest.raises(KeyError):
+        with metrics.stage('collect'):
+            raise KeyError('boom')
+    assert metrics.stages[0]['status'] == 'KeyError'
+
+
+def test_embedded_metric_format():
+    stream = io.StringIO()
+    metrics = RunMetrics(output='emf', stream=stream)
+    with metrics.stage('collect'):
+        metrics.count(rows=3)
+    line = json.loads(stream.getvalue())
+    assert line['Stage'] == 'collect' and line['Rows'] == 3
+    directive = line['_aws']['CloudWatchMetrics'][0]
+    assert directive['Dimensions'] == [['Stage']]
+    assert {m['Name'] for m in directive['Metrics']} >= {'Duration', 'Rows', 'BytesWritten', 'PeakRSS'}
+
+
+def test_tracemalloc_profile():
+    metrics = RunMetrics(output='off', profile='tracemalloc')
+    with metrics.stage('allocate'):
+        data = bytearray(1024 * 1024)
+    del data
+    assert metrics.stages[0]['traced_peak_bytes'] >= 1024 * 1024
+
+
+def test_collector_stages(tmp_path):
+    metrics = RunMetrics(output='off')
+    collector = create_collector(str(tmp_path), mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0),
+                                                                             datetime(2023, 1, 2, 23, 30)),
+                                 metrics=metrics)
+    _, csv_data = collector.persist_collected_data()
+    stages = {stage['stage']: stage for stage in metrics.stages}
+    assert list(stages) == ['retrieve_last_updated_datetime', 'filter_data_already_persisted', 'validate',
+                            'persist_collected_data']
+    assert stages['filter_data_already_persisted']['rows'] == 96
+    assert stages['persist_collected_data']['rows'] == 96
+    assert stages['persist_collected_data']['bytes_written'] == len(csv_data)
@@ -0,0 +1,176 @@
+import json
+import logging
+from datetime import date, timedelta
+import numpy as np
+from usage_series import UsageSeries, to_datetime64
+
+# Validation of a parsed series in one vectorized pass (rows are already ordered newest first in HDF files,
+# so no sort is needed unless they are not): missing intervals (gaps), duplicated read datetimes, gaps and
+# duplicates caused by daylight saving time transitions, negative and non finite reads and reads off the
+# 30-minute grid. Every check has a policy: fail (raise ValueError), warn (log) or ignore.
+# The report is stored with the entry of the persisted file in the time range index (index.json, 'validation')
+# so that queries and rollups can tell missing data from zero usage without scanning the files again.
+CHECKS = ('gaps', 'duplicates', 'dst', 'negative', 'non_finite', 'off_grid')
+POLICIES = ('fail', 'warn', 'ignore')
+DEFAULT_POLICIES = {'gaps': 'warn', 'duplicates': 'warn', 'dst': 'warn', 'negative': 'warn', 'non_finite': 'fail',
+                    'off_grid': 'warn'}
+INTERVAL_MINUTES = 30
+_TIMESTAMP_BITS = 40
+
+
+def parse_policies(text) -> dict:
+    # "gaps=fail,duplicates=ignore" -> DEFAULT_POLICIES with those checks replaced, "off" ignores every check
+    policies = dict(DEFAULT_POLICIES)
+    if text in (None, ''):
+        return policies
+    if text == 'off':
+        return {check: 'ignore' for check in CHECKS}
+    for assignment in text.split(','):
+        check, _, policy = assignment.partition('=')
+        if check not in CHECKS or policy not in POLICIES:
+            raise ValueError(f"Unexpected validation policy {assignment}, expected <check>=<policy> with check in "
+                             f"{CHECKS} and policy in {POLICIES}")
+        policies[check] = policy
+    return policies
+
+
+def last_sunday(year, month) -> date:
+    last_day = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last_day - timedelta(days=(last_day.weekday() - 6) % 7)
+
+
+def dst_windows(years):
+    # (start, end] of the local (Irish/EU) read datetimes skipped in spring and repeated in autumn:
+    # clocks go 01:00 -> 02:00 on the last Sunday of March and 02:00 -> 01:00 on the last Sunday of October
+    spring, autumn = [], []
+    for year in years:
+        for windows, month in [(spring, 3), (autumn, 10)]:
+            day = np.datetime64(last_sunday(int(year), month), 'm')
+            windows.append((day + np.timedelta64(60, 'm'), day + np.timedelta64(120, 'm')))
+    return spring, autumn
+
+
+def _in_windows(timestamps, windows):
+    inside = np.zeros(len(timestamps), dtype=bool)
+    for start, end in windows:
+        inside |= (timestamps > start) & (timestamps <= end)
+    return inside
+
+
+class ValidationReport():
+    def __init__(self, rows, gaps, duplicates, dst, negative, non_finite, off_grid):
+        self.rows = rows
+        self.gaps = gaps  # [[mprn, read type, first missing read datetime, last missing read datetime, missing]]
+        self.duplicates = duplicates  # [[mprn, read type, read datetime, rows]]
+        self.dst = dst  # gaps and duplicates explained by a daylight saving time transition
+        self.negative = negative  # [[mprn, read type, read datetime, read value]]
+        self.non_finite = non_finite
+        self.off_grid = off_grid
+
+    def counts(self) -> dict:
+        return {check: len(getattr(self, check)) for check in CHECKS}
+
+    def to_dict(self) -> dict:
+        return {'rows': self.rows, **{check: getattr(self, check) for check in CHECKS}}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(**json.loads(text))
+
+    def apply(self, policies=None, filename=None):
+        # logs the checks with warn policy and raises ValueError for the checks with fail policy
+        policies = DEFAULT_POLICIES if policies is None else policies
+        failed = []
+        for check, count in self.counts().items():
+            if count == 0 or policies.get(check, 'warn') == 'ignore':
+                continue
+            message = f"{filename or 'HDF data'}: {count} {check.replace('_', ' ')}: {getattr(self, check)[:3]}"
+            if policies.get(check, 'warn') == 'fail':
+                failed.append(message)
+            else:
+                logging.warning(message)
+        if failed:
+            raise ValueError(f"HDF validation failed: {'; '.join(failed)}")
+
+
+def validate(series: UsageSeries, previous_watermark=None) -> ValidationReport:
+    # previous_watermark (latest read already persisted) also detects the gap before the oldest read of series
+    count = len(series)
+    groups = series.mprn_codes.astype(np.int64) * max(len(series.read_type_categories), 1) + series.read_type_codes
+    minutes = series.timestamps.astype('datetime64[m]').astype(np.int64)
+    keys = (groups << _TIMESTAMP_BITS) + minutes
+    steps = np.diff(keys)
+    if (steps <= 0).all():  # HDF order: newest first
+        order = np.arange(count)[::-1]
+    elif (steps >= 0).all():
+        order = np.arange(count)
+    else:
+        order = np.argsort(keys, kind='stable')
+    groups, minutes = groups[order], minutes[order]
+    values = series.read_values[order]
+    mprn_codes, read_type_codes = series.mprn_codes[order], series.read_type_codes[order]
+    timestamps = minutes.astype('datetime64[m]')
+    same_group = groups[1:] == groups[:-1]
+    steps = minutes[1:] - minutes[:-1]
+
+    # gaps within a group, and between the previous watermark and the oldest read of every group
+    gap_ends = np.flatnonzero(same_group & (steps > INTERVAL_MINUTES)) + 1
+    gap_first = timestamps[gap_ends - 1] + np.timedelta64(INTERVAL_MINUTES, 'm')
+    if previous_watermark is not None and count > 0:
+        group_starts = np.concatenate([[0], np.flatnonzero(~same_group) + 1])
+        watermark = to_datetime64(previous_watermark).astype('datetime64[m]')
+        late = group_starts[timestamps[group_starts] > watermark + np.timedelta64(INTERVAL_MINUTES, 'm')]
+        gap_ends = np.concatenate([late, gap_ends])
+        gap_first = np.concatenate([np.full(len(late), watermark + np.timedelta64(INTERVAL_MINUTES, 'm')), gap_first])
+    gap_last = timestamps[gap_ends] - np.timedelta64(INTERVAL_MINUTES, 'm')
+    missing = (gap_last - gap_first).astype(np.int64) // INTERVAL_MINUTES + 1
+    # off grid reads (reported separately) can be less than an interval apart; gaps are sorted by group and time
+    gap_order = np.lexsort([gap_first, groups[gap_ends]])
+    gap_order = gap_order[missing[gap_order] > 0]
+    gap_ends, gap_first, gap_last, missing = gap_ends[gap_order], gap_first[gap_order], gap_last[gap_order], \
+        missing[gap_order]
+
+    duplicate_rows = np.flatnonzero(same_group & (steps == 0)) + 1
+    duplicate_keys, duplicate_counts = np.unique(np.stack([groups[duplicate_rows], minutes[duplicate_rows]]),
+                                                 axis=1, return_counts=True) if len(duplicate_rows) \
+        else (np.empty((2, 0), dtype=np.int64), np.empty(0, dtype=np.int64))
+    duplicate_first = np.searchsorted((groups << _TIMESTAMP_BITS) + minutes,
+                                      (duplicate_keys[0] << _TIMESTAMP_BITS) + duplicate_keys[1])
+
+    years = np.unique(timestamps.astype('datetime64[Y]').astype(np.int64) + 1970) if count else []
+    spring, autumn = dst_windows(years)
+    dst_gaps = _in_windows(gap_first, spring) & _in_windows(gap_last, spring)
+    dst_duplicates = _in_windows(timestamps[duplicate_first], autumn)
+
+    def label(rows):
+        return [[str(series.mprn_categories[mprn_codes[r]]), str(series.read_type_categories[read_type_codes[r]])]
+                for r in rows]
+    gaps = [[*g, str(first), str(last), int(m)] for g, first, last, m
+            in zip(label(gap_ends), gap_first, gap_last, missing)]
+    duplicates = [[*g, str(timestamps[r]), int(c) + 1] for g, r, c
+                  in zip(label(duplicate_first), duplicate_first, duplicate_counts)]
+    off_grid_rows = np.flatnonzero(minutes % INTERVAL_MINUTES != 0)
+    negative_rows = np.flatnonzero(values < 0)
+    non_finite_rows = np.flatnonzero(~np.isfinite(values))
+    return ValidationReport(
+        rows=count,
+        gaps=[g for g, dst in zip(gaps, dst_gaps) if not dst],
+        duplicates=[d for d, dst in zip(duplicates, dst_duplicates) if not dst],
+        dst=[g for g, dst in zip(gaps, dst_gaps) if dst] + [d for d, dst in zip(duplicates, dst_duplicates) if dst],
+        negative=[[*g, str(timestamps[r]), float(values[r])] for g, r in zip(label(negative_rows), negative_rows)],
+        non_finite=[[*g, str(timestamps[r]), str(values[r])] for g, r in zip(label(non_finite_rows), non_finite_rows)],
+        off_grid=[[*g, str(timestamps[r])] for g, r in zip(label(off_grid_rows), off_grid_rows)])
+
+
+def gaps_between(reports, start, end, mprn=None):
+    # gaps [mprn, read type, first missing, last missing, missing] of the reports overlapping [start, end)
+    start, end = str(to_datetime64(start).astype('datetime64[m]')), str(to_datetime64(end).astype('datetime64[m]'))
+    gaps = []
+    for report in reports:
+        if report is not None:
+            # daylight saving time gaps are not missing data: those read datetimes do not exist
+            gaps.extend(g for g in report.gaps if g[2] < end and g[3] >= start and (mprn is None or g[0] == mprn))
+    return sorted(gaps)
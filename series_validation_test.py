@@ -0,0 +1,130 @@
+from datetime import datetime
+import logging
+import numpy as np
+import os
+from archive_compaction import compact_archive
+from archive_storage import open_archive
+from conftest import create_collector, collect
+from electricity_usage_collector_test import mock_collection_data_as_list
+from series_validation import validate, parse_policies, ValidationReport, DEFAULT_POLICIES
+from time_range_index import TimeRangeIndex
+from usage_series import UsageSeries, HDF_HEADER
+import pytest
+
+
+def hdf_series(*rows):
+    return UsageSeries.from_csv('\n'.join([HDF_HEADER] + [
+        f"{mprn},31774820,{value},Active Import Interval (kW),{read}" for mprn, value, read in rows]))
+
+
+def test_clean_series():
+    series = UsageSeries.from_csv('\n'.join(mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0),
+                                                                         datetime(2023, 1, 2, 23, 30))))
+    report = validate(series, previous_watermark=datetime(2022, 12, 31, 23, 30))
+    assert report.rows == 96
+    assert report.counts() == {check: 0 for check in report.counts()}
+    report.apply({check: 'fail' for check in DEFAULT_POLICIES})
+
+
+def test_gaps_duplicates_and_bad_reads():
+    series = hdf_series(('1', '0.5', '02-01-2023 10:00'), ('1', '0.5', '02-01-2023 09:00'),
+                        ('1', '0.7', '02-01-2023 09:00'), ('1', '-0.1', '02-01-2023 08:30'),
+                        ('1', 'nan', '02-01-2023 08:00'), ('1', '0.2', '02-01-2023 07:45'),
+                        ('2', '0.1', '02-01-2023 10:00'))
+    report = validate(series, previous_watermark=datetime(2023, 1, 2, 7, 0))
+    # the off grid read 07:45 is less than an interval after the watermark: no gap before it
+    assert report.gaps == [['1', 'Active Import Interval (kW)', '2023-01-02T09:30', '2023-01-02T09:30', 1],
+                           ['2', 'Active Import Interval (kW)', '2023-01-02T07:30', '2023-01-02T09:30', 5]]
+    assert report.duplicates == [['1', 'Active Import Interval (kW)', '2023-01-02T09:00', 2]]
+    assert report.negative == [['1', 'Active Import Interval (kW)', '2023-01-02T08:30', -0.1]]
+    assert report.non_finite == [['1', 'Active Import Interval (kW)', '2023-01-02T08:00', 'nan']]
+    assert report.off_grid == [['1', 'Active Import Interval (kW)', '2023-01-02T07:45']]
+    assert ValidationReport.from_json(report.to_json()).to_dict() == report.to_dict()
+
+
+def test_daylight_saving_time_transitions():
+    # clocks go forward on 26-03-2023 (01:30 and 02:00 do not exist) and back on 29-10-2023 (01:30 twice)
+    series = hdf_series(('1', '0.1', '29-10-2023 02:00'), ('1', '0.1', '29-10-2023 01:30'),
+                        ('1', '0.1', '29-10-2023 01:30'), ('1', '0.1', '29-10-2023 01:00'),
+                        ('1', '0.1', '26-03-2023 02:30'), ('1', '0.1', '26-03-2023 01:00'))
+    report = validate(series)
+    assert report.dst == [['1', 'Active Import Interval (kW)', '2023-03-26T01:30', '2023-03-26T02:00', 2],
+                          ['1', 'Active Import Interval (kW)', '2023-10-29T01:30', 2]]
+    assert report.duplicates == []
+    assert [g[2:] for g in report.gaps] == [['2023-03-26T03:00', '2023-10-29T00:30', 10412]]
+
+
+def test_policies(caplog):
+    report = validate(hdf_series(('1', '0.5', '02-01-2023 10:00'), ('1', '0.5', '02-01-2023 09:00')))
+    with caplog.at_level(logging.WARNING):
+        report.apply(parse_policies(''), 'HDF-2023-01-02T1000.csv')
+    assert 'HDF-2023-01-02T1000.csv: 1 gaps' in caplog.text
+    report.apply(parse_policies('off'))
+    with pytest.raises(ValueError, match='1 gaps'):
+        report.apply(parse_policies('gaps=fail,duplicates=ignore'))
+    with pytest.raises(ValueError, match='Unexpected validation policy'):
+        parse_policies('gaps=abort')
+
+
+def test_collector_stores_validation_reports(tmp_path):
+    storage_path = str(tmp_path)
+    first = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 1, 23, 30))
+    assert collect(storage_path, first) == 'HDF-2023-01-01T2330.csv'
+    # the HDF file of the next run misses the last read of the first day and 2 reads of the third day
+    rows = mock_collection_data_as_list(datetime(2023, 1, 2, 0, 30), datetime(2023, 1, 3, 23, 30))
+    rows = [r for r in rows if not r.endswith('03-01-2023 12:00') and not r.endswith('03-01-2023 12:30')]
+    assert collect(storage_path, rows) == 'HDF-2023-01-03T2330.csv'
+    archive = open_archive(storage_path)
+    assert archive.list_files() == ['HDF-2023-01-01T2330.csv', 'HDF-2023-01-03T2330.csv']
+    assert sorted(os.listdir(storage_path)) == ['HDF-2023-01-01T2330.csv', 'HDF-2023-01-03T2330.csv', 'index.json',
+                                                'manifest.json']  # reports are kept in the index entries
+    index = TimeRangeIndex(archive)
+    assert index.validation('HDF-2023-01-01T2330.csv').counts()['gaps'] == 0
+    assert [g[2:] for g in index.validation('HDF-2023-01-03T2330.csv').gaps] == \
+        [['2023-01-02T00:00', '2023-01-02T00:00', 1], ['2023-01-03T12:00', '2023-01-03T12:30', 2]]
+    assert [g[2:] for g in index.gaps(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 2, 12, 0))] == \
+        [['2023-01-02T00:00', '2023-01-02T00:00', 1]]
+    assert index.gaps(datetime(2023, 1, 3, 13, 0), datetime(2023, 1, 4, 0, 0), mprn='10305914213') == []
+    # compaction rewrites the reports of the merged files
+    compact_archive(archive)
+    index = TimeRangeIndex(archive)
+    assert list(index.files) == ['HDF-2023-01-03T2330-M10305914213.csv']
+    assert index.validation('HDF-2023-01-03T2330-M10305914213.csv').gaps == \
+        [['10305914213', 'Active Import Interval (kW)', '2023-01-02T00:00', '2023-01-02T00:00', 1],
+         ['10305914213', 'Active Import Interval (kW)', '2023-01-03T12:00', '2023-01-03T12:30', 2]]
+
+
+def test_failing_validation_persists_nothing(tmp_path):
+    rows = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 1, 23, 30))
+    rows[5] = rows[5].replace(rows[5].split(',')[2], '-1.000000')
+    with pytest.raises(ValueError, match='1 negative'):
+        collect(str(tmp_path), rows, validation_policies=parse_policies('negative=fail'))
+    assert open_archive(str(tmp_path)).list_files() == []
+    assert collect(str(tmp_path), rows, validation_policies=parse_policies('off')) == 'HDF-2023-01-01T2330.csv'
+    assert TimeRangeIndex(open_archive(str(tmp_path))).validation('HDF-2023-01-01T2330.csv') is None
+
+
+def test_failing_validation_persists_nothing_when_streaming(tmp_path):
+    rows = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 1, 23, 30))
+    rows[5] = rows[5].replace(rows[5].split(',')[2], '-1.000000')
+    (tmp_path / 'HDF.csv').write_text('\n'.join(rows))
+    storage_path = tmp_path / 'storage'
+    storage_path.mkdir()
+    collector = create_collector(str(storage_path), validation_policies=parse_policies('negative=fail'))
+    with pytest.raises(ValueError, match='1 negative'):
+        collector.persist_hdf_file_streaming(str(tmp_path / 'HDF.csv'))
+    assert os.listdir(storage_path) == []
+
+
+def test_missing_read_values_are_non_finite(tmp_path):
+    rows = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 1, 23, 30))
+    rows[5] = rows[5].replace(rows[5].split(',')[2], '')
+    assert np.isnan(UsageSeries.from_csv('\n'.join(rows)).read_values[4])
+    with pytest.raises(ValueError, match='1 non finite'):
+        collect(str(tmp_path), rows)
+    assert open_archive(str(tmp_path)).list_files() == []
+    assert collect(str(tmp_path), rows, validation_policies=parse_policies('non_finite=warn')) == \
+        'HDF-2023-01-01T2330.csv'
+    assert open_archive(str(tmp_path)).read('HDF-2023-01-01T2330.csv').decode().splitlines() == rows
+    index = TimeRangeIndex(open_archive(str(tmp_path)))
+    assert index.validation('HDF-2023-01-01T2330.csv').non_finite[0][3] == 'nan'
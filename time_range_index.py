@@ -0,0 +1,175 @@
+import json
+import logging
+from datetime import datetime
+import numpy as np
+from series_validation import ValidationReport, gaps_between
+from usage_series import (UsageSeries, parse_hdf_datetimes, to_datetime64, byte_offsets, byte_fields,
+                          HDF_DATETIME_LENGTH, HDF_HEADER)
+
+# Index of the persisted HDF files (index.json under the storage path), updated on every persist:
+# {"files": {"HDF-2023-01-02T2330.csv": {"min_timestamp": "2023-01-01T00:00", "max_timestamp": "2023-01-02T23:30",
+#   "rows": 96, "mprns": ["10305914213"], "size": 7270, "content_encoding": null,
+#   "days": [["2023-01-02", 70, 3712], ["2023-01-01", 3713, 7270]], "validation": {"rows": 96, "gaps": [], ...}}}}
+# days holds the byte range [start, end) of every run of rows with the same read date (rows are newest first,
+# so a day is a single run per MPRN). Queries only open the files overlapping the requested range and only
+# read the byte ranges of the requested days: memory-mapped locally and ranged GETs in S3. Compressed
+# objects (S3 --compression) cannot be read by range and are read whole.
+# validation is the report of series_validation.py of the file (absent when persisted without validation).
+INDEX_FILENAME = 'index.json'
+
+
+def _segments(days, row_starts, row_ends):
+    # [[day, start, end], ...] of the runs of consecutive rows with the same day
+    if len(days) == 0:
+        return []
+    changes = np.flatnonzero(days[1:] != days[:-1]) + 1
+    run_starts = np.concatenate([[0], changes])
+    run_ends = np.concatenate([changes, [len(days)]])
+    return [[str(days[s]), int(row_starts[s]), int(row_ends[e - 1])] for s, e in zip(run_starts, run_ends)]
+
+
+def index_entry(body: bytes, content_encoding=None) -> dict:
+    # index entry of an (uncompressed) HDF file body, computed in a vectorized pass over the bytes
+    data = np.frombuffer(body, dtype=np.uint8)
+    newlines = byte_offsets(data, ord('\n'))
+    row_starts = newlines + 1
+    row_ends = np.concatenate([newlines[1:], [len(body)]]).astype(newlines.dtype)
+    non_empty = row_ends > row_starts
+    row_starts, row_ends = row_starts[non_empty], row_ends[non_empty]
+    row_ends = row_ends - (data[row_ends - 1] == ord('\r'))  # crlf
+    timestamps = parse_hdf_datetimes(byte_fields(data, row_ends - HDF_DATETIME_LENGTH, row_ends))
+    commas = byte_offsets(data, ord(','))
+    mprn_ends = np.clip(commas[np.minimum(np.searchsorted(commas, row_starts), max(len(commas) - 1, 0))]
+                        if len(commas) > 0 else row_ends, row_starts, row_ends)
+    mprns = sorted(m.decode() for m in np.unique(byte_fields(data, row_starts, mprn_ends)))
+    return {'min_timestamp': str(timestamps.min()) if len(timestamps) else None,
+            'max_timestamp': str(timestamps.max()) if len(timestamps) else None,
+            'rows': len(timestamps), 'mprns': mprns, 'size': len(body), 'content_encoding': content_encoding,
+            'days': _segments(timestamps.astype('datetime64[D]'), row_starts, row_ends)}
+
+
+class IndexEntryBuilder():
+    # Builds the index entry of lines (header first) while they are streamed into storage:
+    # persist(filename, builder.wrap(lines)) then builder.entry()
+    def __init__(self, content_encoding=None):
+        self.content_encoding = content_encoding
+        self.offset = None
+        self.rows = 0
+        self.mprns = set()
+        self.min_timestamp = None
+        self.max_timestamp = None
+        self.days = []
+
+    def wrap(self, lines):
+        for line in lines:
+            self.add(line)
+            yield line
+
+    def add(self, line):
+        if self.offset is None:  # header
+            self.offset = len(line.encode())
+            return
+        start = self.offset + 1
+        self.offset = start + len(line.encode())
+        self.rows += 1
+        self.mprns.add(line.split(',', 1)[0])
+        # "dd-mm-YYYY HH:MM" -> "YYYY-mm-ddTHH:MM" (sortable)
+        read_datetime = line[-HDF_DATETIME_LENGTH:]
+        timestamp = f"{read_datetime[6:10]}-{read_datetime[3:5]}-{read_datetime[0:2]}T{read_datetime[11:16]}"
+        self.min_timestamp = timestamp if self.min_timestamp is None else min(self.min_timestamp, timestamp)
+        self.max_timestamp = timestamp if self.max_timestamp is None else max(self.max_timestamp, timestamp)
+        day = timestamp[:10]
+        if self.days and self.days[-1][0] == day:
+            self.days[-1][2] = self.offset
+        else:
+            self.days.append([day, start, self.offset])
+
+    def entry(self) -> dict:
+        return {'min_timestamp': self.min_timestamp, 'max_timestamp': self.max_timestamp, 'rows': self.rows,
+                'mprns': sorted(self.mprns), 'size': self.offset or 0, 'content_encoding': self.content_encoding,
+                'days': self.days}
+
+
+def _merge_ranges(ranges):
+    # merges byte ranges which are adjacent (separated by a newline) or overlapping
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class TimeRangeIndex():
+    def __init__(self, archive):
+        self.archive = archive
+        body = archive.read(INDEX_FILENAME)
+        self.files = {} if body is None else json.loads(body)['files']
+
+    def save(self):
+        self.archive.write(INDEX_FILENAME, json.dumps({'files': self.files}, separators=(',', ':')))
+
+    def add(self, filename, entry):
+        self.files[filename] = entry
+        self.save()
+
+    def remove(self, filenames):
+        for filename in filenames:
+            self.files.pop(filename, None)
+        self.save()
+
+    def update(self):
+        # indexes the archive files persisted before the index existed, returns them
+        missing = [f for f in self.archive.list_files() if f not in self.files]
+        for filename in missing:
+            logging.info(f"Indexing {filename}")
+            self.files[filename] = index_entry(self.archive.read(filename))
+        if missing:
+            self.save()
+        return missing
+
+    def files_overlapping(self, start: datetime, end: datetime, mprn=None):
+        # files with rows in [start, end) (of mprn), newest first
+        start, end = to_datetime64(start), to_datetime64(end)
+        return sorted((f for f, e in self.files.items()
+                       if e['rows'] > 0 and np.datetime64(e['min_timestamp']) < end
+                       and np.datetime64(e['max_timestamp']) >= start
+                       and (mprn is None or mprn in e['mprns'])), reverse=True)
+
+    def read_file_range(self, filename, start: datetime, end: datetime) -> UsageSeries:
+        # rows of the days of filename overlapping [start, end), read by byte range
+        entry = self.files[filename]
+        first_day, last_day = str(start.date()), str(end.date())
+        ranges = _merge_ranges([(s, e) for day, s, e in entry['days'] if first_day <= day <= last_day])
+        if entry['content_encoding'] is not None:
+            body = self.archive.read(filename)
+            chunks = [body[s:e] for s, e in ranges]
+        else:
+            chunks = [self.archive.read_range(filename, s, e) for s, e in ranges]
+        rows = b'\n'.join(chunk.strip(b'\n') for chunk in chunks).decode()
+        return UsageSeries.from_csv('\n'.join([HDF_HEADER, rows]) if rows else HDF_HEADER)
+
+    def query(self, start: datetime, end: datetime, mprn=None) -> UsageSeries:
+        # rows with read datetime in [start, end) (of mprn), newest file first; a row present in more than
+        # one file is taken from the newest one
+        series = UsageSeries.merge([self.read_file_range(f, start, end)
+                                    for f in self.files_overlapping(start, end, mprn)])
+        mask = (series.timestamps >= to_datetime64(start)) & (series.timestamps < to_datetime64(end))
+        if mprn is not None:
+            mask &= series.mprns == mprn
+        return series.select(mask)
+
+    def validation(self, filename):
+        # validation report of filename, None for files persisted without validation
+        report = self.files[filename].get('validation')
+        return None if report is None else ValidationReport(**report)
+
+    def gaps(self, start: datetime, end: datetime, mprn=None):
+        # missing reads in [start, end) (of mprn) from the validation reports of the files; a gap is
+        # reported by the file following it, so files are only bounded by their latest read
+        first = to_datetime64(start)
+        filenames = [f for f, e in self.files.items()
+                     if e['rows'] > 0 and np.datetime64(e['max_timestamp']) >= first
+                     and (mprn is None or mprn in e['mprns'])]
+        return gaps_between([self.validation(f) for f in filenames], start, end, mprn)
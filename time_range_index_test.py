@@ -0,0 +1,84 @@
+from datetime import datetime
+from archive_storage import open_archive, FilesystemArchive
+from conftest import create_collector, collect
+from electricity_usage_collector_test import mock_collection_data_as_list
+from time_range_index import TimeRangeIndex, IndexEntryBuilder, index_entry, INDEX_FILENAME
+import pytest
+
+
+def collection_until(day):
+    return mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, day, 23, 30), fixed_usage=False)
+
+
+def persist_collections(storage_path, days, streaming_from=None, compression=None, tmp_path=None):
+    # one collection per entry of days (2023-01-01 until that day), streamed from the streaming_from-th one
+    for number, day in enumerate(days):
+        if streaming_from is not None and number >= streaming_from:
+            hdf_file = tmp_path / f'HDF-{number}.csv'
+            hdf_file.write_text('\n'.join(collection_until(day)))
+            create_collector(storage_path, compression=compression).persist_hdf_file_streaming(str(hdf_file))
+        else:
+            collect(storage_path, collection_until(day), compression=compression)
+
+
+def expected_rows(start, end):
+    return [r for r in collection_until(31)[1:] if start <= datetime.strptime(r[-16:], "%d-%m-%Y %H:%M") < end]
+
+
+def test_index_entry_matches_streamed_entry():
+    lines = collection_until(3)
+    entry = index_entry('\n'.join(lines).encode())
+    builder = IndexEntryBuilder()
+    assert list(builder.wrap(lines)) == lines
+    assert builder.entry() == entry
+    assert entry['rows'] == 144 and entry['mprns'] == ['10305914213']
+    assert entry['min_timestamp'] == '2023-01-01T00:00' and entry['max_timestamp'] == '2023-01-03T23:30'
+    body = '\n'.join(lines).encode()
+    assert [day for day, _, _ in entry['days']] == ['2023-01-03', '2023-01-02', '2023-01-01']
+    assert body[entry['days'][1][1]:entry['days'][1][2]].decode().splitlines() == lines[49:97]
+
+
+def test_query_reads_only_overlapping_ranges(tmp_path, monkeypatch):
+    storage_path = str(tmp_path / 'storage')
+    (tmp_path / 'storage').mkdir()
+    persist_collections(storage_path, [5, 12, 20], streaming_from=2, tmp_path=tmp_path)
+    index = TimeRangeIndex(open_archive(storage_path))
+    assert sorted(index.files) == ['HDF-2023-01-05T2330.csv', 'HDF-2023-01-12T2330.csv', 'HDF-2023-01-20T2330.csv']
+    start, end = datetime(2023, 1, 11, 12, 0), datetime(2023, 1, 13, 6, 0)
+    assert index.files_overlapping(start, end) == ['HDF-2023-01-20T2330.csv', 'HDF-2023-01-12T2330.csv']
+    read_ranges = []
+    original_read_range = FilesystemArchive.read_range
+
+    def read_range(archive, relative_path, range_start, range_end):
+        read_ranges.append((relative_path, range_end - range_start))
+        return original_read_range(archive, relative_path, range_start, range_end)
+    monkeypatch.setattr(FilesystemArchive, 'read_range', read_range)
+    monkeypatch.setattr(FilesystemArchive, 'read', lambda archive, relative_path: pytest.fail("full read"))
+    series = index.query(start, end, mprn='10305914213')
+    assert series.format_rows() == expected_rows(start, end)
+    assert {path for path, _ in read_ranges} == {'HDF-2023-01-20T2330.csv', 'HDF-2023-01-12T2330.csv'}
+    assert sum(size for _, size in read_ranges) < 4 * 48 * 80
+    assert len(index.query(start, end, mprn='00000000000')) == 0
+
+
+def test_query_deduplicates_overlapping_files_and_indexes_legacy_files(tmp_path):
+    archive = open_archive(str(tmp_path))
+    archive.write('HDF-2023-01-03T2330.csv', '\n'.join(collection_until(3)))
+    archive.write('HDF-2023-01-04T2330.csv', '\n'.join(collection_until(4)))
+    index = TimeRangeIndex(archive)
+    assert index.update() == ['HDF-2023-01-03T2330.csv', 'HDF-2023-01-04T2330.csv']
+    assert TimeRangeIndex(archive).update() == []
+    start, end = datetime(2023, 1, 2), datetime(2023, 1, 5)
+    assert index.query(start, end).format_rows() == expected_rows(start, end)
+
+
+def test_query_s3_ranged_and_compressed(s3_bucket, tmp_path):
+    persist_collections("s3://bucket/plain", [5, 9])
+    persist_collections("s3://bucket/gzip", [5, 9], streaming_from=1, compression='gzip', tmp_path=tmp_path)
+    start, end = datetime(2023, 1, 4, 22, 0), datetime(2023, 1, 6, 3, 0)
+    for storage_path, content_encoding in [("s3://bucket/plain", None), ("s3://bucket/gzip", 'gzip')]:
+        archive = open_archive(storage_path, compression=content_encoding)
+        index = TimeRangeIndex(archive)
+        assert {e['content_encoding'] for e in index.files.values()} == {content_encoding}
+        assert index.query(start, end).format_rows() == expected_rows(start, end)
+    assert s3_bucket.head_object(Bucket='bucket', Key=f'plain/{INDEX_FILENAME}')['ContentLength'] > 0
@@ -0,0 +1,249 @@
+import argparse
+import io
+import json
+import logging
+import numpy as np
+from archive_cache import read_series
+from archive_storage import open_archive
+from usage_series import UsageSeries
+
+# Analytics over the persisted archive.
+# HDF read values are the average demand (kW) of the 30 minutes ending at the read datetime,
+# so the energy of an interval is kW * 0.5 kWh and belongs to the day (and half hour) it started in.
+# Rollups are materialized as a (days x 48 half hours) kWh matrix per MPRN in analytics/rollups.npz
+# and updated incrementally with every new persisted file, daily/weekly/monthly totals, time-of-use
+# costs and demand stats are derived from the matrices without reading the HDF files again.
+ROLLUPS_PATH = 'analytics/rollups.npz'
+ACTIVE_IMPORT_READ_TYPE = 'Active Import Interval (kW)'
+INTERVAL_MINUTES = 30
+SLOTS_PER_DAY = 24 * 60 // INTERVAL_MINUTES
+PERIODS = ('day', 'week', 'month')
+
+
+def load_archive(archive, files=None) -> UsageSeries:
+    # all rows of the HDF files of the archive (or of the given files) as one series
+    files = archive.list_files() if files is None else files
+    logging.info(f"Loading {len(files)} HDF files")
+    return UsageSeries.concatenate(read_series(archive, f) for f in files)
+
+
+def interval_slots(timestamps):
+    # (day, half hour of the day) in which each 30-minute interval ending at timestamps started
+    starts = timestamps.astype('datetime64[m]') - np.timedelta64(INTERVAL_MINUTES, 'm')
+    days = starts.astype('datetime64[D]')
+    slots = ((starts - days) // np.timedelta64(INTERVAL_MINUTES, 'm')).astype(np.int64)
+    return days, slots
+
+
+def period_starts(days, period):
+    # first day of the day/week (ISO, starting on Monday)/month each day belongs to
+    if period == 'day':
+        return days
+    elif period == 'week':
+        return days - ((days.astype(np.int64) + 3) % 7).astype('timedelta64[D]')  # 1970-01-01 was a Thursday
+    elif period == 'month':
+        return days.astype('datetime64[M]').astype('datetime64[D]')
+    raise ValueError(f"Unexpected period {period}")
+
+
+def _half_hour(value: str) -> int:
+    hours, minutes = value.split(':')
+    return (int(hours) * 60 + int(minutes)) // INTERVAL_MINUTES
+
+
+class Tariff():
+    # Time-of-use tariff: price per kWh of each band and the periods ("HH:MM" start/end, local time,
+    # may wrap midnight) where a band applies, default_band applies outside every period.
+    # Tariff({'day': 0.35, 'night': 0.18, 'peak': 0.40}) uses the usual night 23:00-08:00 / peak 17:00-19:00
+    def __init__(self, rates, periods=None, default_band='day', standing_charge_per_day=0.0):
+        periods = {'night': [('23:00', '08:00')], 'peak': [('17:00', '19:00')]} if periods is None else periods
+        if default_band not in rates:
+            raise ValueError(f"Tariff has no rate for the default band {default_band}")
+        self.rates = rates
+        self.periods = periods
+        self.default_band = default_band
+        self.standing_charge_per_day = standing_charge_per_day
+        self.bands = list(rates)
+        self.slot_bands = np.full(SLOTS_PER_DAY, self.bands.index(default_band))
+        for band, band_periods in periods.items():
+            if band not in rates:
+                raise ValueError(f"Tariff has no rate for band {band}")
+            for start, end in band_periods:
+                slots = np.arange(_half_hour(start), _half_hour(end) + (SLOTS_PER_DAY if end <= start else 0))
+                self.slot_bands[slots % SLOTS_PER_DAY] = self.bands.index(band)
+
+    @classmethod
+    def from_json(cls, text):
+        # {"rates": {"day": 0.35, "night": 0.18, "peak": 0.40}, "periods": {"night": [["23:00", "08:00"]]}, ...}
+        return cls(**json.loads(text))
+
+    def band_matrix(self) -> np.ndarray:
+        # (48 half hours x bands) one-hot matrix of the band of every half hour
+        return (self.slot_bands[:, np.newaxis] == np.arange(len(self.bands))).astype(np.float64)
+
+
+class UsageRollups():
+    # Half-hourly kWh per MPRN: first_days[mprn] is the day of row 0 of kwh[mprn] (days x 48, NaN when there
+    # is no read) and processed_files the archive files already included.
+    def __init__(self, first_days=None, kwh=None, processed_files=None):
+        self.first_days = {} if first_days is None else first_days
+        self.kwh = {} if kwh is None else kwh
+        self.processed_files = set() if processed_files is None else processed_files
+
+    @property
+    def mprns(self):
+        return sorted(self.kwh)
+
+    def add(self, series: UsageSeries, filename=None):
+        # includes the active import reads of series, a read of an interval already included replaces it
+        # (so re-processing a file, or overlapping files, never double counts)
+        active_import = np.flatnonzero(series.read_type_categories == ACTIVE_IMPORT_READ_TYPE)
+        series = series.select(np.isin(series.read_type_codes, active_import))
+        days, slots = interval_slots(series.timestamps)
+        energy = series.read_values * (INTERVAL_MINUTES / 60)
+        for mprn_code, mprn in enumerate(series.mprn_categories.tolist()):
+            rows = np.flatnonzero(series.mprn_codes == mprn_code)
+            if rows.size == 0:
+                continue
+            first_day, last_day = days[rows].min(), days[rows].max()
+            if mprn in self.kwh:
+                first_day = min(first_day, self.first_days[mprn])
+                last_day = max(last_day, self.first_days[mprn] + np.timedelta64(len(self.kwh[mprn]) - 1, 'D'))
+            kwh = np.full(((last_day - first_day).astype(np.int64) + 1, SLOTS_PER_DAY), np.nan)
+            if mprn in self.kwh:
+                offset = (self.first_days[mprn] - first_day).astype(np.int64)
+                kwh[offset:offset + len(self.kwh[mprn])] = self.kwh[mprn]
+            kwh[(days[rows] - first_day).astype(np.int64), slots[rows]] = energy[rows]
+            self.first_days[mprn], self.kwh[mprn] = first_day, kwh
+        if filename is not None:
+            self.processed_files.add(filename)
+
+    def days(self, mprn) -> np.ndarray:
+        return self.first_days[mprn] + np.arange(len(self.kwh[mprn])).astype('timedelta64[D]')
+
+    def totals(self, mprn, period='day', matrix=None):
+        # (period first days, kWh per period) of the periods with at least one read.
+        # matrix (48 x n) splits the totals in n columns (e.g. tariff bands)
+        kwh = self.kwh[mprn]
+        has_reads = ~np.isnan(kwh).all(axis=1)
+        days, kwh = self.days(mprn)[has_reads], np.nan_to_num(kwh[has_reads])
+        values = kwh.sum(axis=1) if matrix is None else kwh @ matrix
+        starts, inverse = np.unique(period_starts(days, period), return_inverse=True)
+        totals = np.zeros((len(starts),) + values.shape[1:])
+        np.add.at(totals, inverse, values)
+        return starts, totals
+
+    def cost(self, mprn, tariff: Tariff, period='month'):
+        # (period first days, kWh per band, cost per band, total cost including standing charges)
+        starts, band_kwh = self.totals(mprn, period, tariff.band_matrix())
+        band_cost = band_kwh * np.array([tariff.rates[band] for band in tariff.bands])
+        has_reads = ~np.isnan(self.kwh[mprn]).all(axis=1)
+        _, day_counts = np.unique(period_starts(self.days(mprn)[has_reads], period), return_counts=True)
+        return starts, band_kwh, band_cost, band_cost.sum(axis=1) + day_counts * tariff.standing_charge_per_day
+
+    def demand_stats(self, mprn):
+        # peak demand (kW and the end of its interval), baseload (median of the daily minimum demand),
+        # mean demand and load factor (mean / peak)
+        demand = self.kwh[mprn] * (60 / INTERVAL_MINUTES)
+        if np.isnan(demand).all():
+            return None
+        peak = np.nanargmax(demand)
+        day, slot = divmod(int(peak), SLOTS_PER_DAY)
+        peak_at = self.first_days[mprn] + np.timedelta64(day, 'D') + np.timedelta64((slot + 1) * INTERVAL_MINUTES, 'm')
+        daily_minimum = np.nanmin(demand[~np.isnan(demand).all(axis=1)], axis=1)
+        mean_kw = float(np.nanmean(demand))
+        peak_kw = float(demand.flat[peak])
+        return {'peak_kw': peak_kw, 'peak_at': str(peak_at), 'baseload_kw': float(np.median(daily_minimum)),
+                'mean_kw': mean_kw, 'load_factor': mean_kw / peak_kw if peak_kw > 0 else None}
+
+    def to_bytes(self) -> bytes:
+        arrays = {'mprns': np.array(self.mprns, dtype=str),
+                  'processed_files': np.array(sorted(self.processed_files), dtype=str)}
+        for index, mprn in enumerate(self.mprns):
+            arrays[f'first_day_{index}'] = np.array(self.first_days[mprn])
+            arrays[f'kwh_{index}'] = self.kwh[mprn]
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        with np.load(io.BytesIO(data)) as arrays:
+            mprns = arrays['mprns'].tolist()
+            return cls(first_days={m: arrays[f'first_day_{i}'][()] for i, m in enumerate(mprns)},
+                       kwh={m: arrays[f'kwh_{i}'] for i, m in enumerate(mprns)},
+                       processed_files=set(arrays['processed_files'].tolist()))
+
+
+class UsageAnalytics():
+    # Materialized rollups of an archive (see open_archive), loaded once and kept up to date incrementally
+    def __init__(self, archive):
+        self.archive = archive
+        data = archive.read(ROLLUPS_PATH)
+        self.rollups = UsageRollups() if data is None else UsageRollups.from_bytes(data)
+
+    def save(self):
+        self.archive.write(ROLLUPS_PATH, self.rollups.to_bytes())
+
+    def update_from_series(self, series: UsageSeries, *filenames):
+        # called by the collector with the series it just persisted as filenames (no read back)
+        if all(filename in self.rollups.processed_files for filename in filenames):
+            return
+        self.rollups.add(series)
+        self.rollups.processed_files.update(filenames)
+        self.save()
+
+    def update(self):
+        # includes the archive files not processed yet, returns them
+        new_files = [f for f in self.archive.list_files() if f not in self.rollups.processed_files]
+        for filename in new_files:
+            logging.info(f"Updating rollups with {filename}")
+            self.rollups.add(read_series(self.archive, filename), filename)
+        if new_files:
+            self.save()
+        return new_files
+
+    def usage_report(self, period='month', tariff: Tariff = None):
+        # {mprn: {'demand': {...}, 'usage': [{'period': '2023-01-01', 'kwh': ..., 'cost': ..., ...}, ...]}}
+        report = {}
+        for mprn in self.rollups.mprns:
+            starts, kwh = self.rollups.totals(mprn, period)
+            usage = [{'period': str(start), 'kwh': round(float(total), 3)} for start, total in zip(starts, kwh)]
+            if tariff is not None:
+                _, band_kwh, band_cost, cost = self.rollups.cost(mprn, tariff, period)
+                for entry, kwh_by_band, cost_by_band, total_cost in zip(usage, band_kwh, band_cost, cost):
+                    entry.update({f'{band}_kwh': round(float(k), 3) for band, k in zip(tariff.bands, kwh_by_band)})
+                    entry.update({f'{band}_cost': round(float(c), 2) for band, c in zip(tariff.bands, cost_by_band)})
+                    entry['cost'] = round(float(total_cost), 2)
+            report[mprn] = {'demand': self.rollups.demand_stats(mprn), 'usage': usage}
+        return report
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(description="Electricity usage analytics over the persisted HDF files",
+                                     epilog="Usage: usage_analytics.py -s ./local_storage --period month "
+                                            "--tariff tariff.json")
+    parser.add_argument('-s', '--storage-path', required=True, help='Storage path of the HDF files')
+    parser.add_argument('--period', choices=PERIODS, default='month', help='Aggregation period')
+    parser.add_argument('--tariff', default=None,
+                        help='JSON file with the tariff, e.g. {"rates": {"day": 0.35, "night": 0.18, "peak": 0.40}}')
+    parser.add_argument('--no-update', action='store_true',
+                        help='Report the materialized rollups without including new archive files')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Local read-through cache of the objects read from S3 (see archive_cache.py)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+    args = parse_cli_args()
+    analytics = UsageAnalytics(open_archive(args.storage_path, cache_dir=args.cache_dir))
+    if not args.no_update:
+        analytics.update()
+    tariff = None
+    if args.tariff is not None:
+        with open(args.tariff) as f:
+            tariff = Tariff.from_json(f.read())
+    print(json.dumps(analytics.usage_report(args.period, tariff), indent=2))
+    if args.cache_dir is not None and hasattr(analytics.archive, 'log_stats'):
+        analytics.archive.log_stats()
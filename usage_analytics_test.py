@@ -0,0 +1,78 @@
+from datetime import datetime
+from archive_storage import open_archive
+from conftest import collect
+from electricity_usage_collector_test import mock_collection_data_as_list
+from usage_analytics import Tariff, UsageAnalytics, UsageRollups, load_archive, period_starts, ROLLUPS_PATH
+from usage_series import UsageSeries
+import numpy as np
+import pytest
+
+
+def two_days_series():
+    # 1 kW (fixed usage 1.000001) over the intervals of 2023-01-01 and 2023-01-02
+    return UsageSeries.from_csv('\n'.join(mock_collection_data_as_list(datetime(2023, 1, 1, 0, 30),
+                                                                       datetime(2023, 1, 3, 0, 0))))
+
+
+def test_daily_weekly_monthly_totals():
+    rollups = UsageRollups()
+    rollups.add(two_days_series())
+    days, kwh = rollups.totals('10305914213', 'day')
+    assert [str(d) for d in days] == ['2023-01-01', '2023-01-02']
+    assert kwh == pytest.approx([24.000024, 24.000024])
+    weeks, kwh = rollups.totals('10305914213', 'week')
+    assert [str(w) for w in weeks] == ['2022-12-26', '2023-01-02']  # ISO weeks start on Monday
+    months, kwh = rollups.totals('10305914213', 'month')
+    assert [str(m) for m in months] == ['2023-01-01'] and kwh == pytest.approx([48.000048])
+
+
+def test_period_starts():
+    days = np.array(['2023-01-01', '2023-01-02', '2023-01-08', '2023-02-15'], dtype='datetime64[D]')
+    assert [str(d) for d in period_starts(days, 'week')] == ['2022-12-26', '2023-01-02', '2023-01-02', '2023-02-13']
+    assert [str(d) for d in period_starts(days, 'month')] == ['2023-01-01', '2023-01-01', '2023-01-01', '2023-02-01']
+
+
+def test_time_of_use_cost():
+    tariff = Tariff({'day': 0.30, 'night': 0.20, 'peak': 0.50}, standing_charge_per_day=0.5)
+    assert np.bincount(tariff.slot_bands).tolist() == [26, 18, 4]  # day, night (23:00-08:00), peak (17:00-19:00)
+    rollups = UsageRollups()
+    rollups.add(two_days_series())
+    days, band_kwh, band_cost, cost = rollups.cost('10305914213', tariff, 'day')
+    assert band_kwh[0] == pytest.approx([13, 9, 2], rel=1e-5)
+    assert cost == pytest.approx([13 * 0.3 + 9 * 0.2 + 2 * 0.5 + 0.5] * 2, rel=1e-5)
+
+
+def test_demand_stats_and_idempotent_updates():
+    rollups = UsageRollups()
+    series = two_days_series()
+    series.read_values[10] = 4.0  # interval ending 2023-01-02 19:00
+    rollups.add(series, 'HDF-2023-01-03T0000.csv')
+    rollups.add(series, 'HDF-2023-01-03T0000.csv')
+    _, kwh = rollups.totals('10305914213', 'month')
+    assert kwh == pytest.approx([48.000048 + 1.5])
+    stats = rollups.demand_stats('10305914213')
+    assert stats['peak_kw'] == 4.0 and stats['peak_at'] == '2023-01-02T19:00'
+    assert stats['baseload_kw'] == pytest.approx(1.000001)
+    restored = UsageRollups.from_bytes(rollups.to_bytes())
+    assert restored.processed_files == {'HDF-2023-01-03T0000.csv'}
+    assert np.array_equal(restored.kwh['10305914213'], rollups.kwh['10305914213'], equal_nan=True)
+
+
+def test_incremental_rollups_match_full_rescan(tmp_path):
+    storage_path = str(tmp_path)
+    collection = mock_collection_data_as_list(datetime(2023, 1, 1, 0, 30), datetime(2023, 2, 3, 0, 0),
+                                              fixed_usage=False)
+    for end_day in [10, 34]:
+        rows = [r for r in collection[1:] if datetime.strptime(r[-16:], "%d-%m-%Y %H:%M").toordinal()
+                <= datetime(2023, 1, 1).toordinal() + end_day - 1]
+        collect(storage_path, [collection[0]] + rows, update_analytics=True)
+    archive = open_archive(storage_path)
+    incremental = UsageAnalytics(archive)
+    assert len(incremental.rollups.processed_files) == 2
+    assert incremental.update() == []
+    archive.delete(ROLLUPS_PATH)
+    rescanned = UsageAnalytics(archive)
+    assert len(rescanned.update()) == 2
+    assert incremental.usage_report('week') == rescanned.usage_report('week')
+    _, kwh = rescanned.rollups.totals('10305914213', 'month')
+    assert kwh.sum() == pytest.approx(load_archive(archive).read_values.sum() / 2)
@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs, unquote
+import numpy as np
+from archive_cache import read_series
+from archive_storage import open_archive, MANIFEST_FILENAME
+from usage_analytics import UsageRollups, ACTIVE_IMPORT_READ_TYPE, PERIODS
+from usage_series import UsageSeries
+
+# HTTP (asyncio) query service over the persisted archive, for dashboards:
+# $ python usage_query_service.py -s s3://bucket/prefix --port 8080
+# GET /mprns                                               MPRNs of the archive
+# GET /mprns/<mprn>/reads?start=2023-01-01&end=2023-01-02  reads in [start, end) ([read datetime, value])
+# GET /mprns/<mprn>/usage?period=day&start=...&end=...     kWh per day/week/month starting in [start, end)
+# GET /mprns/<mprn>/latest                                 latest read
+# GET /health, POST /reload                                loaded files and rows, reload now
+# (reads and latest accept &read_type=..., Active Import Interval (kW) by default)
+# The archive is parsed once and kept resident: per MPRN and read type the read datetimes (int32 minutes since
+# epoch, sorted) and values (float64), plus the half-hourly kWh rollups of usage_analytics for aggregates.
+# The manifest (rewritten on every persist) is polled every --reload-interval seconds and only the new files are
+# parsed and merged (a read present in more than one file is taken from the newest). Files removed by compaction
+# hold the same reads as the compacted files, so their reads stay resident.
+# Responses are cached (LRU) until the next reload.
+DEFAULT_PORT = 8080
+RELOAD_INTERVAL = 30
+RESPONSE_CACHE_SIZE = 1024
+MAX_HEADER_LINES = 100
+
+
+class QueryError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_datetime(value, name) -> np.datetime64:
+    # "2023-01-02" or "2023-01-02T10:30"
+    try:
+        return np.datetime64(value, 'm')
+    except ValueError:
+        raise QueryError(HTTPStatus.BAD_REQUEST, f"Unexpected {name} datetime {value}")
+
+
+def merge_reads(newer, older):
+    # (minutes, values) of both, sorted by read datetime, reads of newer replacing those of older (a read
+    # datetime repeated within newer or older, when the clocks go back, is kept)
+    replaced = np.isin(older[0], newer[0])
+    minutes = np.concatenate([newer[0], older[0][~replaced]])
+    values = np.concatenate([newer[1], older[1][~replaced]])
+    order = np.argsort(minutes, kind='stable')
+    return minutes[order], values[order]
+
+
+class ResidentArchive():
+    def __init__(self, archive):
+        self.archive = archive
+        # replaced as a whole on every reload, so that a query never sees half of a reload
+        self.state = {'version': 0, 'manifest': None, 'files': frozenset(), 'reads': {}, 'rollups': UsageRollups(),
+                      'rows': 0}
+
+    def reload(self, force=False):
+        # parses and merges the files persisted since the last reload, returns them
+        manifest = self.archive.read(MANIFEST_FILENAME)
+        state = self.state
+        if not force and state['version'] > 0 and manifest == state['manifest']:
+            return []
+        files = self.archive.list_files()
+        new_files = [f for f in files if f not in state['files']]
+        logging.info(f"Loading {len(new_files)} new HDF files")
+        # arrays are never modified in place, new dicts of the same arrays are enough for the new state
+        reads = dict(state['reads'])
+        rollups = UsageRollups(dict(state['rollups'].first_days), dict(state['rollups'].kwh))
+        if new_files:
+            # newest file first so that deduplication keeps its reads
+            series = UsageSeries.merge(read_series(self.archive, f) for f in sorted(new_files, reverse=True))
+            minutes = series.timestamps.astype('datetime64[m]').astype(np.int64).astype(np.int32)
+            groups = series.mprn_codes.astype(np.int64) * len(series.read_type_categories) + series.read_type_codes
+            order = np.argsort(groups, kind='stable')
+            boundaries = np.flatnonzero(np.diff(groups[order])) + 1
+            for rows in np.split(order, boundaries):
+                if rows.size == 0:
+                    continue
+                key = (str(series.mprn_categories[series.mprn_codes[rows[0]]]),
+                       str(series.read_type_categories[series.read_type_codes[rows[0]]]))
+                empty = (np.empty(0, dtype=np.int32), np.empty(0))
+                reads[key] = merge_reads((minutes[rows], series.read_values[rows]), reads.get(key, empty))
+            rollups.add(series)
+        self.state = {'version': state['version'] + 1, 'manifest': manifest, 'files': frozenset(files),
+                      'reads': reads, 'rollups': rollups, 'rows': sum(len(m) for m, _ in reads.values())}
+        return new_files
+
+
+class QueryService():
+    def __init__(self, resident: ResidentArchive, reload_interval=RELOAD_INTERVAL,
+                 response_cache_size=RESPONSE_CACHE_SIZE):
+        self.resident = resident
+        self.reload_interval = reload_interval
+        self.response_cache_size = response_cache_size
+        self.responses = OrderedDict()  # (version, target) -> body, least recently used first
+        self.stats = {'requests': 0, 'cache_hits': 0}
+        self.reload_lock = None
+        self.server = None
+        self.poller = None
+
+    async def reload(self, force=False):
+        # parsing runs in a thread so that queries are answered meanwhile
+        async with self.reload_lock:
+            new_files = await asyncio.get_running_loop().run_in_executor(None, self.resident.reload, force)
+        if new_files:
+            self.responses.clear()
+        return new_files
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.reload()
+            except Exception:
+                logging.exception("Reload failed")
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.reload_lock = asyncio.Lock()
+        await self.reload(force=True)
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.poller = asyncio.create_task(self.poll()) if self.reload_interval else None
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        if self.poller is not None:
+            self.poller.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                for _ in range(MAX_HEADER_LINES):
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get('content-length', 0) or 0) > 0:
+                    await reader.readexactly(int(headers['content-length']))
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    status, body, cached = HTTPStatus.BAD_REQUEST, json.dumps({'error': 'Bad request line'}), False
+                    keep_alive = False
+                else:
+                    method, target, version = parts
+                    status, body, cached = await self.respond(method, target)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                body = body.encode() if isinstance(body, str) else body
+                writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\nX-Cache: {'hit' if cached else 'miss'}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target):
+        # (status, body, served from the response cache)
+        self.stats['requests'] += 1
+        try:
+            if method == 'POST' and target == '/reload':
+                return HTTPStatus.OK, json.dumps({'new_files': await self.reload(force=True)}), False
+            if method != 'GET':
+                raise QueryError(HTTPStatus.METHOD_NOT_ALLOWED, f"Unexpected method {method}")
+            state = self.resident.state
+            key = (state['version'], target)
+            body = self.responses.get(key)
+            if body is not None:
+                self.responses.move_to_end(key)
+                self.stats['cache_hits'] += 1
+                return HTTPStatus.OK, body, True
+            body = json.dumps(self.query(state, target), separators=(',', ':')).encode()
+            if target != '/health':
+                self.responses[key] = body
+                if len(self.responses) > self.response_cache_size:
+                    self.responses.popitem(last=False)
+            return HTTPStatus.OK, body, False
+        except QueryError as error:
+            return error.status, json.dumps({'error': str(error)}), False
+        except Exception as error:
+            logging.exception(f"{method} {target} failed")
+            return HTTPStatus.INTERNAL_SERVER_ERROR, json.dumps({'error': f"{type(error).__name__}: {error}"}), False
+
+    def query(self, state, target):
+        url = urlsplit(target)
+        path = [unquote(p) for p in url.path.strip('/').split('/')]
+        parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if path == ['health']:
+            return {'version': state['version'], 'files': len(state['files']), 'rows': state['rows'],
+                    **self.stats}
+        if path == ['mprns']:
+            return {'mprns': sorted({mprn for mprn, _ in state['reads']})}
+        if len(path) != 3 or path[0] != 'mprns' or path[2] not in ('reads', 'usage', 'latest'):
+            raise QueryError(HTTPStatus.NOT_FOUND, f"Unexpected path {url.path}")
+        mprn, query = path[1], path[2]
+        if query == 'usage':
+            return self.usage(state, mprn, parameters)
+        read_type = parameters.get('read_type', ACTIVE_IMPORT_READ_TYPE)
+        if (mprn, read_type) not in state['reads']:
+            raise QueryError(HTTPStatus.NOT_FOUND, f"No {read_type} reads of MPRN {mprn}")
+        minutes, values = state['reads'][(mprn, read_type)]
+        if query == 'latest':
+            return {'mprn': mprn, 'read_type': read_type,
+                    'read_datetime': str(minutes[-1].astype(np.int64).astype('datetime64[m]')),
+                    'read_value': float(values[-1])}
+        start = parse_datetime(parameters.get('start', '1970-01-01'), 'start').astype(np.int64)
+        end = parse_datetime(parameters.get('end', '9999-12-31'), 'end').astype(np.int64)
+        first, last = np.searchsorted(minutes, [start, end])
+        timestamps = minutes[first:last].astype(np.int64).astype('datetime64[m]').astype(str)
+        return {'mprn': mprn, 'read_type': read_type,
+                'reads': list(zip(timestamps.tolist(), values[first:last].tolist()))}
+
+    def usage(self, state, mprn, parameters):
+        rollups = state['rollups']
+        period = parameters.get('period', 'day')
+        if period not in PERIODS:
+            raise QueryError(HTTPStatus.BAD_REQUEST, f"Unexpected period {period}, expected one of {PERIODS}")
+        if mprn not in rollups.kwh:
+            raise QueryError(HTTPStatus.NOT_FOUND, f"No usage of MPRN {mprn}")
+        starts, kwh = rollups.totals(mprn, period)
+        selected = (starts >= parse_datetime(parameters.get('start', '1970-01-01'), 'start').astype('datetime64[D]')) \
+            & (starts < parse_datetime(parameters.get('end', '9999-12-31'), 'end').astype('datetime64[D]'))
+        return {'mprn': mprn, 'period': period,
+                'usage': [{'period': str(start), 'kwh': round(float(total), 3)}
+                          for start, total in zip(starts[selected], kwh[selected])]}
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(description="HTTP query service over the persisted HDF files",
+                                     epilog="Usage: usage_query_service.py -s s3://bucket/prefix --port 8080")
+    parser.add_argument('-s', '--storage-path', required=True, help='Storage path of the HDF files')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on (0: any free port)')
+    parser.add_argument('--reload-interval', type=float, default=RELOAD_INTERVAL,
+                        help='Seconds between checks for newly persisted files (0: never)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Local read-through cache of the objects read from S3 (see archive_cache.py)')
+    return parser.parse_args()
+
+
+async def serve(args):
+    service = QueryService(ResidentArchive(open_archive(args.storage_path, cache_dir=args.cache_dir)),
+                           reload_interval=args.reload_interval)
+    host, port = await service.start(args.host, args.port)
+    # printed (and flushed) so that a parent process, e.g. the load test, can find the port
+    print(f"Listening on http://{host}:{port}", flush=True)
+    await service.server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+    asyncio.run(serve(parse_cli_args()))
@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+from tempfile import mkdtemp
+from urllib.parse import urlsplit
+import numpy as np
+from archive_storage import open_archive, HDF_FILENAME_FORMAT
+from electricity_usage_collector_benchmark import mock_hdf_csv, END_DATETIME
+
+# Load test of the query service (usage_query_service.py): concurrent keep-alive clients sending a mix of
+# range, usage and latest queries for --duration seconds, reporting throughput and latency percentiles.
+# $ python usage_query_service_benchmark.py                       # local instance over a generated archive
+# $ python usage_query_service_benchmark.py --url http://127.0.0.1:8080 --concurrency 64
+LOAD_CONCURRENCY = 32
+LOAD_DURATION = 10
+LOAD_YEARS = 5
+LOAD_MPRNS = 5
+QUERY_WEIGHTS = {'reads': 0.5, 'usage': 0.3, 'latest': 0.2}
+
+
+async def request(reader, writer, method, target):
+    # (status, decoded JSON body, headers) of one request over an open keep-alive connection
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\n\r\n".encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers['content-length']))
+    return status, json.loads(body), headers
+
+
+def random_target(rng, mprns, first_day, last_day):
+    query = rng.choices(list(QUERY_WEIGHTS), weights=list(QUERY_WEIGHTS.values()))[0]
+    mprn = rng.choice(mprns)
+    if query == 'latest':
+        return query, f"/mprns/{mprn}/latest"
+    day = first_day + np.timedelta64(rng.randrange(max((last_day - first_day).astype(int), 1)), 'D')
+    if query == 'reads':
+        return query, f"/mprns/{mprn}/reads?start={day}&end={day + np.timedelta64(rng.choice([1, 7]), 'D')}"
+    period = rng.choice(['day', 'week', 'month'])
+    return query, f"/mprns/{mprn}/usage?period={period}&start={day}&end={day + np.timedelta64(31, 'D')}"
+
+
+async def load(url, concurrency=LOAD_CONCURRENCY, duration=LOAD_DURATION, seed=0):
+    # report of concurrency clients querying url for duration seconds
+    host, port = urlsplit(url).hostname, urlsplit(url).port
+    reader, writer = await asyncio.open_connection(host, port)
+    _, body, _ = await request(reader, writer, 'GET', '/mprns')
+    mprns = body['mprns']
+    _, body, _ = await request(reader, writer, 'GET', f"/mprns/{mprns[0]}/usage?period=day")
+    first_day, last_day = np.datetime64(body['usage'][0]['period']), np.datetime64(body['usage'][-1]['period'])
+    writer.close()
+    latencies = {query: [] for query in QUERY_WEIGHTS}
+    errors = []
+    deadline = time.monotonic() + duration
+
+    async def client(number):
+        rng = random.Random(seed + number)
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while time.monotonic() < deadline:
+                query, target = random_target(rng, mprns, first_day, last_day)
+                start = time.perf_counter()
+                status, _, _ = await request(reader, writer, 'GET', target)
+                latencies[query].append(time.perf_counter() - start)
+                if status != 200:
+                    errors.append((status, target))
+        finally:
+            writer.close()
+    start = time.monotonic()
+    await asyncio.gather(*[client(n) for n in range(concurrency)])
+    elapsed = time.monotonic() - start
+    all_latencies = np.concatenate([np.array(v) for v in latencies.values()])
+
+    def percentiles(values):
+        values = np.array(values) * 1000
+        return {f'p{p}_ms': round(float(np.percentile(values, p)), 3) for p in (50, 95, 99)} if len(values) else {}
+    return {'created': datetime.now().isoformat(timespec='seconds'), 'url': url, 'concurrency': concurrency,
+            'duration_seconds': round(elapsed, 3), 'requests': len(all_latencies), 'errors': len(errors),
+            'requests_per_second': round(len(all_latencies) / elapsed, 1), **percentiles(all_latencies),
+            'queries': {query: {'requests': len(v), **percentiles(v)} for query, v in latencies.items()}}
+
+
+def generate_archive(storage_path, years=LOAD_YEARS, mprns=LOAD_MPRNS):
+    open_archive(storage_path).write(END_DATETIME.strftime(HDF_FILENAME_FORMAT), mock_hdf_csv(years, mprns))
+
+
+def start_local_instance(storage_path):
+    # (process, url) of a query service started over storage_path on a free port
+    service = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usage_query_service.py')
+    process = subprocess.Popen([sys.executable, service, '-s', storage_path, '--port', '0', '--reload-interval', '0'],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('Listening on '):
+        process.kill()
+        raise RuntimeError("Query service did not start")
+    return process, line.split()[-1]
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(description="Load test of the usage query service")
+    parser.add_argument('--url', default=None,
+                        help='Service to load, by default a local instance over a generated archive')
+    parser.add_argument('--years', type=float, default=LOAD_YEARS, help='Years of reads of the generated archive')
+    parser.add_argument('--mprns', type=int, default=LOAD_MPRNS, help='Meters (MPRNs) of the generated archive')
+    parser.add_argument('--concurrency', type=int, default=LOAD_CONCURRENCY, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=LOAD_DURATION, help='Seconds of load')
+    parser.add_argument('-o', '--output', default=None, help='Write the JSON report to this file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+    args = parse_cli_args()
+    process, storage_path, url = None, None, args.url
+    try:
+        if url is None:
+            storage_path = mkdtemp()
+            logging.info(f"Generating {args.years} years x {args.mprns} MPRNs in {storage_path}")
+            generate_archive(storage_path, args.years, args.mprns)
+            process, url = start_local_instance(storage_path)
+        report = asyncio.run(load(url, args.concurrency, args.duration))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if storage_path is not None:
+            shutil.rmtree(storage_path, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
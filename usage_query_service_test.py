@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime
+from archive_storage import open_archive
+from conftest import collect
+from electricity_usage_collector_test import mock_collection_data_as_list
+from usage_query_service import QueryService, ResidentArchive, merge_reads
+from usage_query_service_benchmark import request, load
+import numpy as np
+
+
+def collection(start, end):
+    return mock_collection_data_as_list(start, end, fixed_usage=False)
+
+
+def run_with_service(storage_path, scenario):
+    async def main():
+        service = QueryService(ResidentArchive(open_archive(storage_path)), reload_interval=0)
+        host, port = await service.start(port=0)
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            return await scenario(service, f"http://{host}:{port}",
+                                  lambda method, target: request(reader, writer, method, target))
+        finally:
+            writer.close()
+            await service.stop()
+    return asyncio.run(main())
+
+
+def test_queries_and_incremental_reload(tmp_path):
+    storage_path = str(tmp_path)
+    collect(storage_path, collection(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 2, 23, 30)))
+
+    async def scenario(service, url, get):
+        status, body, _ = await get('GET', '/mprns')
+        assert (status, body) == (200, {'mprns': ['10305914213']})
+        status, body, headers = await get('GET', '/mprns/10305914213/reads?start=2023-01-02T10:00&end=2023-01-02T11:00')
+        assert [read[0] for read in body['reads']] == ['2023-01-02T10:00', '2023-01-02T10:30']
+        assert headers['x-cache'] == 'miss'
+        _, cached, headers = await get('GET', '/mprns/10305914213/reads?start=2023-01-02T10:00&end=2023-01-02T11:00')
+        assert cached == body and headers['x-cache'] == 'hit'
+        _, body, _ = await get('GET', '/mprns/10305914213/usage?period=day')
+        assert [u['period'] for u in body['usage']] == ['2022-12-31', '2023-01-01', '2023-01-02']
+        _, body, _ = await get('GET', '/mprns/10305914213/latest')
+        assert body['read_datetime'] == '2023-01-02T23:30'
+        # a new persisted file is loaded on reload, cached responses are dropped
+        collect(storage_path, collection(datetime(2023, 1, 1, 0, 0), datetime(2023, 1, 3, 23, 30)))
+        assert await service.reload() == ['HDF-2023-01-03T2330.csv']
+        assert await service.reload() == []
+        _, body, headers = await get('GET', '/mprns/10305914213/latest')
+        assert body['read_datetime'] == '2023-01-03T23:30' and headers['x-cache'] == 'miss'
+        _, body, _ = await get('GET', '/health')
+        assert body['files'] == 2 and body['rows'] == 3 * 48
+        assert (await get('GET', '/mprns/1/latest'))[0] == 404
+        assert (await get('GET', '/mprns/10305914213/usage?period=year'))[0] == 400
+        assert (await get('GET', '/mprns/10305914213/reads?start=yesterday'))[0] == 400
+        assert (await get('DELETE', '/mprns'))[0] == 405
+    run_with_service(storage_path, scenario)
+
+
+def test_load_script(tmp_path):
+    collect(str(tmp_path), collection(datetime(2023, 1, 1, 0, 0), datetime(2023, 2, 28, 23, 30)))
+
+    async def scenario(service, url, get):
+        return await load(url, concurrency=4, duration=0.3)
+    report = run_with_service(str(tmp_path), scenario)
+    assert report['requests'] > 0 and report['errors'] == 0
+    assert set(report['queries']) == {'reads', 'usage', 'latest'}
+
+
+def test_merge_reads_keeps_repeated_read_datetimes():
+    older = (np.array([60, 90, 90, 120, 120], dtype=np.int32), np.array([1.0, 2.0, 3.0, 4.0, 5.0]))
+    newer = (np.array([120, 150], dtype=np.int32), np.array([6.0, 7.0]))
+    minutes, values = merge_reads(newer, older)
+    assert minutes.tolist() == [60, 90, 90, 120, 150]
+    assert values.tolist() == [1.0, 2.0, 3.0, 6.0, 7.0]
@@ -0,0 +1,364 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+
+# HDF (Harmonised Downloadable File) sample:
+# MPRN,Meter Serial Number,Read Value,Read Type,Read Date and End Time
+# 10305914213,31774820,0.174000,Active Import Interval (kW),05-04-2023 01:30
+HDF_HEADER = 'MPRN,Meter Serial Number,Read Value,Read Type,Read Date and End Time'
+HDF_COLUMNS = 5
+HDF_DATETIME_FORMAT = "%d-%m-%Y %H:%M"
+HDF_DATETIME_LENGTH = 16
+DST_HOUR = timedelta(hours=1)  # local end times repeated when the clocks go back
+
+# Character positions that rearrange "dd-mm-YYYY HH:MM" into "YYYY-mm-ddTHH:MM"
+# (and back) so that timestamps can be converted by numpy in a single vectorized pass
+_HDF_TO_ISO = np.array([6, 7, 8, 9, 2, 3, 4, 5, 0, 1, 10, 11, 12, 13, 14, 15])
+_ISO_TO_HDF = np.array([8, 9, 4, 5, 6, 7, 0, 1, 2, 3, 10, 11, 12, 13, 14, 15])
+
+
+def _categorical(values):
+    # dictionary-encode a column: (categories, codes) where categories[codes] == values
+    categories, codes = np.unique(values, return_inverse=True)
+    return categories, codes.astype(np.min_scalar_type(max(len(categories) - 1, 0)))
+
+
+def parse_hdf_datetimes(values) -> np.ndarray:
+    # vectorized equivalent of datetime.strptime(value, HDF_DATETIME_FORMAT), of str or bytes (S) values
+    raw = np.asarray(values)
+    if raw.dtype.kind != 'S':
+        raw = raw.astype(str)
+    if raw.size == 0:
+        return np.array([], dtype='datetime64[m]')
+    lengths = np.char.str_len(raw)
+    if raw.dtype.itemsize != HDF_DATETIME_LENGTH * (1 if raw.dtype.kind == 'S' else 4) \
+            or (lengths != HDF_DATETIME_LENGTH).any():
+        bad = raw[lengths != HDF_DATETIME_LENGTH][0]
+        raise ValueError(f"Unexpected HDF datetime: {bad.decode() if isinstance(bad, bytes) else bad}")
+    chars = raw.view(np.uint8 if raw.dtype.kind == 'S' else np.uint32).reshape(-1, HDF_DATETIME_LENGTH)
+    chars = chars[:, _HDF_TO_ISO]
+    chars[:, 10] = ord('T')
+    iso = np.ascontiguousarray(chars).view(f'{raw.dtype.kind}{HDF_DATETIME_LENGTH}').ravel()
+    return iso.astype('datetime64[m]')
+
+
+def format_hdf_datetimes(timestamps: np.ndarray) -> np.ndarray:
+    # vectorized equivalent of datetime.strftime(HDF_DATETIME_FORMAT)
+    iso = np.asarray(timestamps, dtype='datetime64[m]').astype(f'U{HDF_DATETIME_LENGTH}')
+    if iso.size == 0:
+        return iso
+    chars = iso.view(np.uint32).reshape(-1, HDF_DATETIME_LENGTH)[:, _ISO_TO_HDF]
+    chars[:, 10] = ord(' ')
+    return np.ascontiguousarray(chars).view(f'U{HDF_DATETIME_LENGTH}').ravel()
+
+
+def byte_offsets(buffer, byte, chunk_size=1024 * 1024) -> np.ndarray:
+    # offsets of every occurrence of byte in buffer, searched chunk_size bytes at a time
+    dtype = np.int32 if len(buffer) < 2 ** 31 else np.int64
+    return np.concatenate([(np.flatnonzero(buffer[first:first + chunk_size] == byte) + first).astype(dtype)
+                           for first in range(0, len(buffer), chunk_size)] + [np.array([], dtype=dtype)])
+
+
+def byte_fields(buffer, starts, ends, chunk_rows=16 * 1024) -> np.ndarray:
+    # the bytes buffer[start:end] of every row as a fixed width (S) array, gathered chunk_rows rows at a time
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1) if len(lengths) > 0 else 1
+    fields = np.zeros((len(starts), width), dtype=np.uint8)
+    offsets = np.arange(width)
+    for first in range(0, len(starts), chunk_rows):
+        indices = np.minimum(starts[first:first + chunk_rows, None] + offsets, len(buffer) - 1)
+        chunk = buffer[indices]
+        chunk[offsets >= lengths[first:first + chunk_rows, None]] = 0
+        fields[first:first + chunk_rows] = chunk
+    return fields.view(f'S{width}').ravel()
+
+
+class HdfRows():
+    # The original rows of a series as (start, end) byte offsets into the csv data they were parsed from,
+    # so that they are rendered as read without keeping a Python string per row.
+    def __init__(self, buffers, buffer_ids, starts, ends):
+        self.buffers = buffers
+        self.buffer_ids = buffer_ids
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, mask):
+        return HdfRows(self.buffers, self.buffer_ids[mask], self.starts[mask], self.ends[mask])
+
+    @classmethod
+    def concatenate(cls, rows_list):
+        buffers, buffer_ids = [], []
+        for rows in rows_list:
+            buffer_ids.append(rows.buffer_ids.astype(np.int64) + len(buffers))
+            buffers.extend(rows.buffers)
+        return cls(buffers, np.concatenate(buffer_ids), np.concatenate([rows.starts for rows in rows_list]),
+                   np.concatenate([rows.ends for rows in rows_list]))
+
+    def tolist(self) -> list:
+        return [self.buffers[b][start:end].decode()
+                for b, start, end in zip(self.buffer_ids.tolist(), self.starts.tolist(), self.ends.tolist())]
+
+    def join(self, chunk_rows=4 * 1024) -> np.ndarray:
+        # the bytes of the rows separated by newlines, gathered chunk_rows rows (of one buffer) at a time
+        lengths = self.ends - self.starts + 1
+        joined = np.empty(int(lengths.sum()), dtype=np.uint8)
+        offsets = np.cumsum(lengths) - lengths  # of every row in joined
+        bounds = np.union1d(np.flatnonzero(np.diff(self.buffer_ids)) + 1, np.arange(0, len(self), chunk_rows))
+        for first, last in zip(bounds.tolist(), bounds[1:].tolist() + [len(self)]):
+            buffer = np.frombuffer(self.buffers[self.buffer_ids[first]], dtype=np.uint8)
+            rows = np.repeat(np.arange(first, last), lengths[first:last])
+            positions = np.arange(offsets[first], offsets[first] + len(rows))
+            joined[positions] = buffer[np.minimum(self.starts[rows] + positions - offsets[rows], len(buffer) - 1)]
+        joined[offsets + lengths - 1] = ord('\n')
+        return joined[:-1]
+
+
+def to_datetime64(value: datetime) -> np.datetime64:
+    return np.datetime64(value, 'm') if value.second == 0 and value.microsecond == 0 else np.datetime64(value)
+
+
+def hdf_datetime_key(value) -> str:
+    # "dd-mm-YYYY HH:MM" -> "YYYYmmddHHMM", ordered like the datetimes
+    if len(value) != HDF_DATETIME_LENGTH:
+        raise ValueError(f"Unexpected HDF datetime: {value}")
+    return value[6:10] + value[3:5] + value[0:2] + value[11:13] + value[14:16]
+
+
+def _row_group(line):
+    # (MPRN, read type) of an HDF row, None when it is not one
+    columns = line.split(',')
+    return (columns[0], columns[3]) if len(columns) == HDF_COLUMNS else None
+
+
+def _seek_next_group(f, group, chunk_size):
+    # positions the binary file f at the first row after the current one which is not of group (or at its end).
+    # The rows of a group are contiguous: the start of the next group is found by binary search (a few seeks
+    # and reads of one row each) and the last chunk_size bytes are scanned
+    lo = f.tell()
+    hi = f.seek(0, os.SEEK_END)
+    while hi - lo > chunk_size:
+        f.seek((lo + hi) // 2)
+        f.readline()
+        start = f.tell()
+        if start >= hi:
+            break
+        line = f.readline()
+        if _row_group(line.decode().rstrip('\r\n')) == group:
+            lo = f.tell()
+        else:
+            hi = start
+    f.seek(lo)
+    while True:
+        start = f.tell()
+        line = f.readline()
+        if not line or _row_group(line.decode().rstrip('\r\n')) != group:
+            f.seek(start)
+            return
+
+
+def iter_rows_newer_than(f, watermark, chunk_size=64 * 1024):
+    # Yields the rows newer than watermark of the binary HDF file f, positioned after the header.
+    # HDF rows are grouped per (MPRN, read type) and every group is ordered newest first, so the rows
+    # of a group are new up to its first row which is not newer than watermark: the older rows of the group
+    # are skipped without being read (see _seek_next_group) and later groups may still have new rows.
+    # Within a group the (local) end time only goes up when the clocks go back in October (01:30, 02:00
+    # repeated), a group going up by more than that hour is not ordered newest first and raises ValueError.
+    watermark_key = None if watermark is None else watermark.strftime('%Y%m%d%H%M')
+    group, previous_key = None, None
+    for line in iter(f.readline, b''):
+        row = line.decode().rstrip('\r\n')
+        if not row:
+            continue
+        columns = row.split(',')
+        if len(columns) != HDF_COLUMNS:
+            raise ValueError(f"Unexpected number of columns in HDF row: {len(columns)}: {columns}")
+        key = hdf_datetime_key(columns[-1])
+        if (columns[0], columns[3]) == group and key > previous_key and \
+                datetime.strptime(key, '%Y%m%d%H%M') - datetime.strptime(previous_key, '%Y%m%d%H%M') > DST_HOUR:
+            raise ValueError(f"HDF rows of MPRN {columns[0]} {columns[3]} are not ordered newest first: {row}")
+        group, previous_key = (columns[0], columns[3]), key
+        if watermark_key is None or key > watermark_key:
+            yield row
+        else:
+            _seek_next_group(f, group, chunk_size)
+
+
+class UsageSeries():
+    # Column oriented representation of an HDF file.
+    # mprn, meter serial and read type are dictionary-encoded (categories + codes),
+    # read values are float64 and timestamps datetime64[m].
+    # The original rows are kept (as HdfRows) so that to_csv() reproduces the input bytes exactly.
+    def __init__(self, mprn_categories, mprn_codes, serial_categories, serial_codes, read_values,
+                 read_type_categories, read_type_codes, timestamps, rows=None, header=HDF_HEADER):
+        self.mprn_categories = mprn_categories
+        self.mprn_codes = mprn_codes
+        self.serial_categories = serial_categories
+        self.serial_codes = serial_codes
+        self.read_values = read_values
+        self.read_type_categories = read_type_categories
+        self.read_type_codes = read_type_codes
+        self.timestamps = timestamps
+        self.rows = rows
+        self.header = header
+
+    @classmethod
+    def from_csv(cls, csv_data):
+        # csv_data (str or bytes) is parsed column by column from the byte offsets of its lines and commas,
+        # without splitting it into a Python string per row or field
+        data = csv_data.encode() if isinstance(csv_data, str) else bytes(csv_data)
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        newlines = byte_offsets(buffer, ord('\n'))
+        starts = np.concatenate([[0], newlines + 1])
+        ends = np.concatenate([newlines, [len(data)]])
+        if len(data) == 0 or data.endswith(b'\n'):
+            starts, ends = starts[:-1], ends[:-1]
+        if len(starts) == 0:
+            raise ValueError("HDF data has no header")
+        ends -= (ends > starts) & (buffer[np.maximum(ends - 1, 0)] == ord('\r'))
+        header = data[starts[0]:ends[0]].decode()
+        starts, ends = starts[1:], ends[1:]
+        commas = byte_offsets(buffer, ord(','))
+        commas = commas[commas >= (starts[0] if len(starts) > 0 else len(data))]  # not the header's
+        column_counts = np.searchsorted(commas, ends) - np.searchsorted(commas, starts) + 1
+        bad_rows = np.flatnonzero(column_counts != HDF_COLUMNS)
+        if bad_rows.size > 0:
+            columns = data[starts[bad_rows[0]]:ends[bad_rows[0]]].decode().split(',')
+            raise ValueError(f"Unexpected number of columns in HDF row: {len(columns)}: {columns}")
+        commas = commas.reshape(-1, HDF_COLUMNS - 1)
+
+        def column(i):
+            # bytes of the i-th field of every row, between the commas around it
+            return byte_fields(buffer, starts if i == 0 else commas[:, i - 1] + 1,
+                               ends if i == HDF_COLUMNS - 1 else commas[:, i])
+
+        def categorical(i):
+            categories, codes = _categorical(column(i))
+            return categories.astype(str), codes
+        mprn_categories, mprn_codes = categorical(0)
+        serial_categories, serial_codes = categorical(1)
+        read_values = column(2)
+        read_values = np.where(read_values == b'', b'nan', read_values).astype(np.float64)  # missing reads
+        read_type_categories, read_type_codes = categorical(3)
+        timestamps = parse_hdf_datetimes(column(4))
+        return cls(mprn_categories, mprn_codes, serial_categories, serial_codes, read_values,
+                   read_type_categories, read_type_codes, timestamps,
+                   rows=HdfRows([data], np.zeros(len(starts), dtype=np.int64), starts, ends), header=header)
+
+    @classmethod
+    def concatenate(cls, series_list):
+        # one series with the rows of every series (categories are merged and codes re-mapped)
+        series_list = list(series_list)
+        if len(series_list) == 0:
+            return cls.from_csv(HDF_HEADER)
+        columns = []
+        for categories_name, codes_name in [('mprn_categories', 'mprn_codes'), ('serial_categories', 'serial_codes'),
+                                            ('read_type_categories', 'read_type_codes')]:
+            categories = np.unique(np.concatenate([getattr(s, categories_name).astype(str) for s in series_list]))
+            codes = np.concatenate([np.searchsorted(categories, getattr(s, categories_name).astype(str))
+                                    [getattr(s, codes_name)] for s in series_list])
+            columns.append((categories, codes.astype(np.min_scalar_type(max(len(categories) - 1, 0)))))
+        (mprn_categories, mprn_codes), (serial_categories, serial_codes), (read_type_categories, read_type_codes) = \
+            columns
+        rows = None
+        if all(s.rows is not None for s in series_list):
+            rows = HdfRows.concatenate([s.rows for s in series_list])
+        return cls(mprn_categories, mprn_codes, serial_categories, serial_codes,
+                   np.concatenate([s.read_values for s in series_list]),
+                   read_type_categories, read_type_codes,
+                   np.concatenate([s.timestamps for s in series_list]), rows=rows, header=series_list[0].header)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def mprns(self) -> np.ndarray:
+        return self.mprn_categories[self.mprn_codes]
+
+    @property
+    def meter_serials(self) -> np.ndarray:
+        return self.serial_categories[self.serial_codes]
+
+    @property
+    def read_types(self) -> np.ndarray:
+        return self.read_type_categories[self.read_type_codes]
+
+    def newer_than(self, watermark) -> np.ndarray:
+        # boolean mask of rows with timestamp strictly after watermark (all rows if watermark is None)
+        if watermark is None:
+            return np.ones(len(self), dtype=bool)
+        return self.timestamps > to_datetime64(watermark)
+
+    def select(self, mask):
+        # new series with the rows selected by a boolean mask or index array (categories are shared)
+        return UsageSeries(self.mprn_categories, self.mprn_codes[mask],
+                           self.serial_categories, self.serial_codes[mask],
+                           self.read_values[mask],
+                           self.read_type_categories, self.read_type_codes[mask],
+                           self.timestamps[mask],
+                           rows=None if self.rows is None else self.rows[mask],
+                           header=self.header)
+
+    def compacted(self):
+        # same series without the categories no longer referenced by any row
+        columns = []
+        for categories, codes in [(self.mprn_categories, self.mprn_codes), (self.serial_categories, self.serial_codes),
+                                  (self.read_type_categories, self.read_type_codes)]:
+            used, compact_codes = np.unique(codes, return_inverse=True)
+            columns.append((categories[used], compact_codes.astype(np.min_scalar_type(max(len(used) - 1, 0)))))
+        (mprn_categories, mprn_codes), (serial_categories, serial_codes), (read_type_categories, read_type_codes) = \
+            columns
+        return UsageSeries(mprn_categories, mprn_codes, serial_categories, serial_codes, self.read_values,
+                           read_type_categories, read_type_codes, self.timestamps, rows=self.rows, header=self.header)
+
+    def split_by(self, unit):
+        # yields (start, series) of every day (unit 'D') or month ('M') with rows, oldest first,
+        # keeping the row order; partitions are selected lazily
+        if len(self) == 0:
+            return
+        starts, inverse = np.unique(self.timestamps.astype(f'datetime64[{unit}]'), return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        boundaries = np.flatnonzero(np.diff(inverse[order])) + 1
+        for start, indices in zip(starts, np.split(order, boundaries)):
+            yield start, self.select(indices)
+
+    @classmethod
+    def merge(cls, series_list):
+        # one series with the rows of series_list (newest file first) where the reads of an (MPRN, read type,
+        # read datetime) present in several series are taken from the first of them only. Repeats within a
+        # series are kept: the end times 01:30 and 02:00 are read twice when the clocks go back in October
+        series_list = list(series_list)
+        series = cls.concatenate(series_list)
+        if len(series) == 0:
+            return series
+        sources = np.repeat(np.arange(len(series_list)), [len(s) for s in series_list])
+        keys = ((series.mprn_codes.astype(np.int64) * len(series.read_type_categories) + series.read_type_codes)
+                * (2 ** 40) + series.timestamps.astype(np.int64))
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        return series.select(sources == sources[first][inverse.ravel()])
+
+    def max_timestamp(self):
+        if len(self) == 0:
+            return None
+        return self.timestamps.max().astype(datetime)
+
+    def min_timestamp(self):
+        if len(self) == 0:
+            return None
+        return self.timestamps.min().astype(datetime)
+
+    def format_rows(self) -> list:
+        # rows rendered from the columns (used when the series did not originate from csv)
+        if self.rows is not None:
+            return self.rows.tolist()
+        values = np.char.mod('%.6f', self.read_values)
+        timestamps = format_hdf_datetimes(self.timestamps)
+        return [','.join(r) for r in zip(self.mprns.tolist(), self.meter_serials.tolist(), values.tolist(),
+                                         self.read_types.tolist(), timestamps.tolist())]
+
+    def to_csv(self) -> str:
+        if self.rows is not None and len(self.rows) > 0:
+            return self.header + '\n' + str(memoryview(self.rows.join()), 'utf-8')
+        return '\n'.join([self.header] + self.format_rows())
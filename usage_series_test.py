@@ -0,0 +1,125 @@
+from datetime import datetime
+from electricity_usage_collector_test import mock_collection_data_as_list
+from usage_series import UsageSeries, parse_hdf_datetimes, format_hdf_datetimes, iter_rows_newer_than, HDF_HEADER
+import io
+import numpy as np
+import pytest
+
+
+def test_parse_and_format_hdf_datetimes():
+    values = ['05-04-2023 01:30', '31-12-2022 23:00', '01-01-2023 00:00']
+    timestamps = parse_hdf_datetimes(values)
+    assert timestamps.tolist() == [datetime.strptime(v, "%d-%m-%Y %H:%M") for v in values]
+    assert format_hdf_datetimes(timestamps).tolist() == values
+
+
+def test_usage_series_columns():
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=2, hour=23, minute=30), fixed_usage=False)
+    series = UsageSeries.from_csv('\n'.join(collection))
+    assert len(series) == 96
+    assert series.read_values.dtype == np.float64
+    assert series.timestamps.dtype == np.dtype('datetime64[m]')
+    assert series.mprn_categories.tolist() == ['10305914213']
+    assert series.read_type_categories.tolist() == ['Active Import Interval (kW)']
+    assert series.max_timestamp() == datetime(year=2023, month=1, day=2, hour=23, minute=30)
+    assert series.min_timestamp() == datetime(year=2023, month=1, day=1, hour=0, minute=0)
+
+
+def test_usage_series_newer_than_round_trips_csv():
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=4, hour=23, minute=30), fixed_usage=False)
+    series = UsageSeries.from_csv('\n'.join(collection))
+    assert series.to_csv() == '\n'.join(collection)
+    newer = series.select(series.newer_than(datetime(year=2023, month=1, day=2, hour=23, minute=30)))
+    assert newer.to_csv().splitlines() == collection[:97]  # 2023-01-03 to 2023-01-04, newest first
+    # rows rendered from the columns match the original csv
+    newer.rows = None
+    assert newer.to_csv().splitlines()[1:] == collection[1:97]
+
+
+def test_usage_series_from_csv_bytes():
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=1, hour=23, minute=30), fixed_usage=False)
+    series = UsageSeries.from_csv(('\r\n'.join(collection) + '\r\n').encode())
+    assert series.to_csv() == '\n'.join(collection)
+    assert series.format_rows() == UsageSeries.from_csv('\n'.join(collection)).format_rows()
+    assert series.timestamps.tolist() == [datetime.strptime(r.split(',')[4], "%d-%m-%Y %H:%M")
+                                          for r in collection[1:]]
+    assert len(UsageSeries.from_csv(collection[0].encode())) == 0
+
+
+def test_usage_series_rejects_unexpected_columns():
+    collection = mock_collection_data_as_list(
+        datetime(year=2023, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=1, hour=1, minute=0))
+    collection[2] = collection[2] + ',extra'
+    with pytest.raises(ValueError):
+        UsageSeries.from_csv('\n'.join(collection))
+
+
+class CountingFile(io.BytesIO):
+    # HDF file in memory (positioned after its header) counting the bytes of the rows read
+    def __init__(self, lines):
+        super().__init__('\n'.join(lines).encode())
+        super().readline()
+        self.bytes_read = 0
+
+    def readline(self, size=-1):
+        line = super().readline(size)
+        self.bytes_read += len(line)
+        return line
+
+
+def test_iter_rows_newer_than_skips_rows_older_than_watermark():
+    collection = mock_collection_data_as_list(
+        datetime(year=2021, month=1, day=1, hour=0, minute=0),
+        datetime(year=2023, month=1, day=4, hour=23, minute=30))
+    # a second MPRN after the first one: its new rows follow old rows of the first MPRN
+    collection += [r.replace('10305914213', '10305914200') for r in collection[1:]]
+    f = CountingFile(collection)
+    rows = list(iter_rows_newer_than(f, datetime(year=2023, month=1, day=3, hour=23, minute=30), chunk_size=4096))
+    group_rows = (len(collection) - 1) // 2
+    assert rows == collection[1:49] + collection[group_rows + 1:group_rows + 49]
+    # the years of older rows are skipped, not read
+    assert f.bytes_read < len(f.getvalue()) / 20
+    f = CountingFile(collection)
+    assert list(iter_rows_newer_than(f, None)) == collection[1:]
+    with pytest.raises(ValueError, match='not ordered newest first'):
+        list(iter_rows_newer_than(CountingFile(collection[:1] + collection[49:97] + collection[1:49]), None))
+
+
+def test_iter_rows_newer_than_accepts_the_repeated_october_hour():
+    # 29-10-2023 02:00 -> 01:00: the end times 02:00 and 01:30 are read twice
+    rows = [f"10305914213,31774820,0.100000,Active Import Interval (kW),29-10-2023 {end}"
+            for end in ['03:00', '02:30', '02:00', '01:30', '02:00', '01:30', '01:00']]
+    assert list(iter_rows_newer_than(CountingFile([HDF_HEADER] + rows), datetime(2024, 1, 1, 0, 0))) == []
+    assert list(iter_rows_newer_than(CountingFile([HDF_HEADER] + rows), datetime(2023, 10, 29, 0, 30))) == rows
+    with pytest.raises(ValueError, match='not ordered newest first'):
+        list(iter_rows_newer_than(CountingFile([HDF_HEADER] + rows[:3] + [rows[3].replace('01:30', '03:30')]),
+                                  None))
+
+
+def test_concatenate_merges_categories():
+    first = UsageSeries.from_csv('\n'.join(mock_collection_data_as_list(datetime(2023, 1, 1, 0, 0),
+                                                                        datetime(2023, 1, 1, 1, 0))))
+    second_rows = mock_collection_data_as_list(datetime(2023, 1, 2, 0, 0), datetime(2023, 1, 2, 1, 0))
+    second_rows = [second_rows[0]] + [r.replace('10305914213', '10305914200') for r in second_rows[1:]]
+    second = UsageSeries.from_csv('\n'.join(second_rows))
+    series = UsageSeries.concatenate([first, second])
+    assert series.mprn_categories.tolist() == ['10305914200', '10305914213']
+    assert series.mprns.tolist() == first.mprns.tolist() + second.mprns.tolist()
+    assert series.to_csv() == '\n'.join([first.to_csv()] + second.format_rows())
+
+
+def test_merge_keeps_the_newest_file_and_repeated_october_hours():
+    # 29-10-2023 02:00 -> 01:00: the end times 02:00 and 01:30 are read twice
+    rows = [f"10305914213,31774820,0.{i}00000,Active Import Interval (kW),29-10-2023 {end}"
+            for i, end in enumerate(['03:00', '02:30', '02:00', '01:30', '02:00', '01:30', '01:00'])]
+    older = UsageSeries.from_csv('\n'.join([HDF_HEADER] + rows))
+    newer = UsageSeries.from_csv('\n'.join([HDF_HEADER, rows[1].replace('0.100000', '0.900000')]))
+    assert UsageSeries.merge([older]).to_csv() == older.to_csv()
+    assert UsageSeries.merge([newer, older]).format_rows() == newer.format_rows() + rows[:1] + rows[2:]